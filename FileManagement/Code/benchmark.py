@@ -0,0 +1,558 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import file_system_components
+
+SAVE_EVERY = 100  # 每多少次操作提交一次日志
+
+
+# 测试随磁盘占用率升高, WriteFile每块的平均耗时
+def bench_write_per_block(block_num=2 ** 16, file_blocks=64, samples=50, seed=0):
+    fs = file_system_components.FileSystem(None, block_num)
+    block_size = fs.disk.block_size
+    rng = random.Random(seed)
+    root = fs.file_tree
+    data = "x" * (file_blocks * block_size)
+
+    count = 0
+    results = []
+    for occupancy in (0.0, 0.25, 0.5, 0.75, 0.9):
+        # 先填充到目标占用率, 随机删掉一部分制造碎片
+        while fs.free_space.bitmap.count(1) < occupancy * block_num:
+            name = f"fill{count}"
+            count += 1
+            File = fs.createFile(root, name, datetime.now())
+            fs.WriteFile(File, data[:rng.randint(1, len(data))])
+            if rng.random() < 0.3:
+                fs.DeleteFile(root, root.FileNode[rng.randrange(len(root.FileNode))])
+
+        elapsed = 0.0
+        for i in range(samples):
+            sample = fs.createFile(root, f"sample{i}", datetime.now())
+            start = time.perf_counter()
+            fs.WriteFile(sample, data)
+            elapsed += time.perf_counter() - start
+        for sample in [f for f in root.FileNode if f.file_name.startswith("sample")]:
+            fs.DeleteFile(root, sample)
+
+        per_block = elapsed / (samples * file_blocks) * 1e6
+        results.append((occupancy, per_block))
+        print(f"occupancy {occupancy:4.0%}: {per_block:8.3f} us/block")
+    return results
+
+
+# 按操作名记录每次调用的耗时
+class Recorder:
+    def __init__(self, fs):
+        self.fs = fs
+        self.samples = defaultdict(list)
+        self.ops = 0
+
+    def time(self, op, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.samples[op].append(time.perf_counter() - start)
+        self.ops += 1
+        if self.ops % SAVE_EVERY == 0:
+            self.time("SaveSystemState", self.fs.SaveSystemState)
+        return result
+
+    def Summary(self):
+        summary = {}
+        for op, samples in sorted(self.samples.items()):
+            samples.sort()
+            total = sum(samples)
+            summary[op] = {
+                "count": len(samples),
+                "ops_per_sec": len(samples) / total if total > 0 else None,
+                "p50_us": percentile(samples, 0.50) * 1e6,
+                "p90_us": percentile(samples, 0.90) * 1e6,
+                "p99_us": percentile(samples, 0.99) * 1e6,
+                "max_us": samples[-1] * 1e6,
+            }
+        return summary
+
+
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+
+# 随机内容, 长文件重复同一段以免生成数据本身成为瓶颈
+def payload(rng, length):
+    return (bytes(rng.getrandbits(8) for _ in range(min(length, 256))) * (length // 256 + 1))[:length]
+
+
+# 以下各负载的规模都按磁盘容量换算, scale调节整体的操作次数
+# 大量小文件: 每个1~2块
+def workload_small_files(fs, rec, rng, scale):
+    root = fs.file_tree
+    capacity = fs.free_space.free_count
+    count = min(int(2000 * scale), capacity // 2)
+    files = []
+    for i in range(count):
+        File = rec.time("createFile", fs.createFile, root, f"s{i}", datetime.now())
+        rec.time("WriteFile", fs.WriteFile, File, payload(rng, rng.randint(1, 2 * fs.disk.block_size)))
+        files.append(File)
+    for File in files:
+        rec.time("ReadFile", fs.ReadFile, File)
+    rng.shuffle(files)
+    for File in files:
+        rec.time("DeleteFile", fs.DeleteFile, root, File)
+
+
+# 少量大文件: 每个约占磁盘的1/8
+def workload_huge_files(fs, rec, rng, scale):
+    root = fs.file_tree
+    size = fs.free_space.free_count // 8 * fs.disk.block_size
+    for round_ in range(max(1, int(4 * scale))):
+        files = []
+        for i in range(6):
+            File = rec.time("createFile", fs.createFile, root, f"h{round_}_{i}", datetime.now())
+            rec.time("WriteFile", fs.WriteFile, File, payload(rng, size))
+            files.append(File)
+        for File in files:
+            rec.time("ReadFile", fs.ReadFile, File)
+        for File in files:
+            rec.time("DeleteFile", fs.DeleteFile, root, File)
+
+
+# 深目录: 一条很长的路径, 每层一个小文件, 最后从顶层整棵删除
+# 元数据库按目录各存一条记录, 树的遍历都用显式栈, 400层只是为了控制运行时间;
+# 衡量逐层建目录写文件、周期性SaveSystemState写回深路径上的脏目录以及整棵删除的开销,
+# scale只改变棵数
+def workload_deep_tree(fs, rec, rng, scale):
+    depth = min(400, fs.free_space.free_count)
+    for level in range(max(1, int(2 * scale))):
+        top = node = rec.time("createDir", fs.createDir, fs.file_tree, f"deep{level}", datetime.now())
+        for i in range(depth):
+            File = rec.time("createFile", fs.createFile, node, "f", datetime.now())
+            rec.time("WriteFile", fs.WriteFile, File, payload(rng, fs.disk.block_size))
+            node = rec.time("createDir", fs.createDir, node, f"d{i}", datetime.now())
+        rec.time("ClearDir", fs.deleteDir, top)
+
+
+# 宽目录: 一个文件夹下大量文件, 最后整个清空
+def workload_wide_dir(fs, rec, rng, scale):
+    count = min(int(5000 * scale), fs.free_space.free_count)
+    for level in range(max(1, int(2 * scale))):
+        wide = rec.time("createDir", fs.createDir, fs.file_tree, f"wide{level}", datetime.now())
+        for i in range(count):
+            File = rec.time("createFile", fs.createFile, wide, f"w{i}", datetime.now())
+            rec.time("WriteFile", fs.WriteFile, File, payload(rng, fs.disk.block_size))
+        for File in wide.FileNode[::max(1, count // 200)]:
+            rec.time("ReadFile", fs.ReadFile, File)
+        rec.time("ClearDir", fs.deleteDir, wide)
+
+
+# 碎片化: 先填到约70%, 再反复随机删除和写入大小不一的文件
+def workload_churn(fs, rec, rng, scale):
+    root = fs.file_tree
+    block_size = fs.disk.block_size
+    block_num = len(fs.free_space.bitmap)
+    max_blocks = max(1, block_num // 256)
+    files = []
+    count = 0
+    while fs.free_space.free_count > block_num * 0.3:
+        File = rec.time("createFile", fs.createFile, root, f"c{count}", datetime.now())
+        rec.time("WriteFile", fs.WriteFile, File, payload(rng, rng.randint(1, max_blocks) * block_size))
+        files.append(File)
+        count += 1
+    for _ in range(int(2000 * scale)):
+        File = files.pop(rng.randrange(len(files)))
+        rec.time("DeleteFile", fs.DeleteFile, root, File)
+        File = rec.time("createFile", fs.createFile, root, f"c{count}", datetime.now())
+        rec.time("WriteFile", fs.WriteFile, File, payload(rng, rng.randint(1, max_blocks) * block_size))
+        files.append(File)
+        count += 1
+        if rng.random() < 0.1:
+            rec.time("ReadFile", fs.ReadFile, files[rng.randrange(len(files))])
+
+
+WORKLOADS = {
+    "small_files": workload_small_files,
+    "huge_files": workload_huge_files,
+    "deep_tree": workload_deep_tree,
+    "wide_dir": workload_wide_dir,
+    "churn": workload_churn,
+}
+
+
+# 多线程压力测试: 每个线程在自己的文件夹下反复建, 写, 读, 删文件与子树, 同时往共享文件夹里的公共文件追加带编号的记录,
+# 另有一个线程不停地保存. 结束后检查: 每条记录恰好出现一次(没有丢失的更新), 各文件内容与写入的一致,
+# fsck没有问题, 重新打开(重放日志)后内容不变. 返回发现的问题列表
+def stress(threads=8, ops=500, block_num=2 ** 16, block_size=64, seed=0):
+    problems = []
+    interval = sys.getswitchinterval()
+    # 缩短线程切换间隔, 让操作尽量交错
+    sys.setswitchinterval(1e-5)
+    with tempfile.TemporaryDirectory() as tmp:
+        save_file = os.path.join(tmp, "stress.save")
+        fs = file_system_components.FileSystem(save_file, block_num, block_size)
+        shared = fs.createDir(fs.file_tree, "shared", datetime.now())
+        logs = [fs.createFile(shared, f"log{i}", datetime.now()) for i in range(4)]
+        homes = [fs.createDir(fs.file_tree, f"t{n}", datetime.now()) for n in range(threads)]
+        expected = [{} for _ in range(threads)]
+        records = [[] for _ in range(threads)]
+        done = threading.Event()
+
+        def worker(n):
+            rng = random.Random(seed * 1000 + n)
+            home = homes[n]
+            files = expected[n]
+            try:
+                for i in range(ops):
+                    op = rng.random()
+                    if op < 0.3:
+                        record = f"{n}:{i};"
+                        fs.AppendFile(logs[rng.randrange(len(logs))], record)
+                        records[n].append(record)
+                    elif op < 0.6:
+                        name = f"f{rng.randrange(20)}"
+                        File = home.GetFile(name) or fs.createFile(home, name, datetime.now())
+                        data = payload(rng, rng.randint(0, 8 * block_size))
+                        fs.WriteFile(File, data)
+                        files[name] = data
+                    elif op < 0.65:
+                        # 建一棵小子树再整个删掉, 删除时独占整卷
+                        sub = fs.createDir(home, "sub", datetime.now())
+                        fs.WriteFile(fs.createFile(sub, "x", datetime.now()), payload(rng, 4 * block_size))
+                        fs.deleteDir(sub)
+                    elif op < 0.7 and files:
+                        name = rng.choice(sorted(files))
+                        fs.DeleteFile(home, home.GetFile(name))
+                        del files[name]
+                    elif op < 0.85 and files:
+                        name = rng.choice(sorted(files))
+                        if fs.ReadAt(home.GetFile(name), 0) != files[name]:
+                            problems.append(f"thread {n}: {name} read back wrong contents")
+                    else:
+                        # 读别的线程的文件, 可能正好被删掉
+                        other = homes[rng.randrange(threads)].FileNode
+                        if other:
+                            try:
+                                fs.ReadAt(other[rng.randrange(len(other))], 0)
+                            except (ValueError, IndexError):
+                                pass
+            except Exception as e:
+                problems.append(f"thread {n}: {e!r}")
+
+        def saver():
+            while not done.is_set():
+                fs.SaveSystemState()
+                time.sleep(0.001)
+
+        workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+        background = threading.Thread(target=saver)
+        start = time.perf_counter()
+        background.start()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        done.set()
+        background.join()
+        sys.setswitchinterval(interval)
+
+        def check(fs, when):
+            appended = sorted(record for thread_records in records for record in thread_records)
+            found = sorted(record + ";" for log in fs.resolve("shared").FileNode
+                           for record in fs.ReadAt(log, 0).decode(errors="replace").split(";") if record)
+            if found != appended:
+                problems.append(f"{when}: {len(found)} log records, expected {len(appended)}")
+            for n in range(threads):
+                home = fs.resolve(f"t{n}")
+                if sorted(File.file_name for File in home.FileNode) != sorted(expected[n]):
+                    problems.append(f"{when}: files in t{n} differ")
+                    continue
+                for name, data in expected[n].items():
+                    if fs.ReadAt(home.GetFile(name), 0) != data:
+                        problems.append(f"{when}: t{n}/{name} has wrong contents")
+            problems.extend(f"{when}: {problem}" for problem in fs.Fsck())
+
+        check(fs, "live")
+        fs.SaveSystemState()
+        fs.CloseVolume()
+        try:
+            reopened = file_system_components.FileSystem(save_file)
+        except Exception as e:
+            problems.append(f"replaying the journal failed: {e!r}")
+        else:
+            check(reopened, "reopened")
+            reopened.CloseVolume()
+    print(f"stress: {threads} threads x {ops} ops in {elapsed:.3f}s, "
+          f"{threads * ops / elapsed:.0f} ops/s, {len(problems)} problems", file=sys.stderr)
+    return problems
+
+
+# 冷启动: 建一个有files个文件(每个文件夹per_dir个, 分两层)的卷并做检查点, 再在新进程中打开它
+# 报告打开的耗时与内存, 以及第一次访问某个深层文件夹的耗时
+def cold_start(files, per_dir=1000, block_num=2 ** 14):
+    with tempfile.TemporaryDirectory() as tmp:
+        save_file = os.path.join(tmp, "cold.save")
+        fs = file_system_components.FileSystem(save_file, block_num)
+        start = time.perf_counter()
+        dirs = (files + per_dir - 1) // per_dir
+        for n in range(dirs):
+            if n % per_dir == 0:
+                group = fs.createDir(fs.file_tree, f"g{n // per_dir}", datetime.now())
+            node = fs.createDir(group, f"d{n}", datetime.now())
+            for i in range(min(per_dir, files - n * per_dir)):
+                fs.createFile(node, f"f{i}", datetime.now())
+            if n % 100 == 0:
+                fs.SaveSystemState()
+        fs.SaveSystemState()
+        fs.Checkpoint()
+        build = time.perf_counter() - start
+        fs.CloseVolume()
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--cold-worker",
+                                 json.dumps([save_file, f"g{(dirs - 1) // per_dir}/d{dirs - 1}"])],
+                                check=True, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        result = json.loads(output.splitlines()[-1])
+        result.update(files=files, dirs=dirs, build_s=build,
+                      meta_bytes=sum(os.path.getsize(os.path.join(tmp, name))
+                                     for name in os.listdir(tmp) if name.endswith(".meta")))
+    print(f"cold start with {files} files: open {result['open_s'] * 1000:.1f}ms "
+          f"(+{result['open_rss_kb']}KB), first lookup {result['lookup_s'] * 1000:.1f}ms", file=sys.stderr)
+    return result
+
+
+# 当前的常驻内存(KB); 子进程的ru_maxrss从fork时父进程的内存算起, 这里不能用
+def rss_kb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def cold_worker(save_file, path):
+    rss = rss_kb()
+    start = time.perf_counter()
+    fs = file_system_components.FileSystem(save_file)
+    opened = time.perf_counter()
+    open_rss = rss_kb()
+    node = fs.resolve(path)
+    count = len(node.FileNode)
+    looked_up = time.perf_counter()
+    result = {
+        "open_s": opened - start,
+        "open_rss_kb": open_rss - rss,
+        "lookup_s": looked_up - opened,
+        "lookup_rss_kb": rss_kb() - open_rss,
+        "lookup_files": count,
+    }
+    fs.CloseVolume()
+    return result
+
+
+# 类似文本的内容: 从一个小词表中随机取词, 可压缩
+WORDS = [word.encode() for word in (
+    "the of and to in is that for it as with was on be by at this from or have an are not but which "
+    "file system block chain table directory journal cache snapshot extent index write read free used "
+    "0 1 2 3 4 5 6 7 8 9 \n").split(" ")]
+
+
+def text_payload(rng, length):
+    parts = []
+    size = 0
+    while size < length:
+        word = WORDS[rng.randrange(len(WORDS))]
+        parts.append(word + b" ")
+        size += len(word) + 1
+    return b"".join(parts)[:length]
+
+
+# 压缩: 同样块数的卷上, 不压缩/zlib/lzma各能存下多少文本, 以及写入, 顺序读与4KB随机读的速度
+def bench_compression(block_num=2 ** 14, block_size=512, file_size=2 ** 16, seed=0):
+    # 卷很小时每个文件至多占1/16
+    file_size = min(file_size, block_num * block_size // 16)
+    results = []
+    for codec in (None, "zlib", "lzma"):
+        rng = random.Random(seed)
+        fs = file_system_components.FileSystem(None, block_num, block_size, compression=codec)
+        root = fs.file_tree
+        files = []
+        written = 0
+        write_s = 0.0
+        # 写到空间不足为止
+        while True:
+            data = text_payload(rng, file_size)
+            File = fs.createFile(root, f"t{len(files)}", datetime.now())
+            start = time.perf_counter()
+            try:
+                fs.WriteFile(File, data)
+            except AssertionError:
+                fs.DeleteFile(root, File)
+                break
+            finally:
+                write_s += time.perf_counter() - start
+            files.append(File)
+            written += len(data)
+        start = time.perf_counter()
+        for File in files:
+            fs.ReadAt(File, 0)
+        read_s = time.perf_counter() - start
+        reads = 2000
+        start = time.perf_counter()
+        for _ in range(reads):
+            File = files[rng.randrange(len(files))]
+            fs.ReadAt(File, rng.randrange(File.length), 4096)
+        random_s = time.perf_counter() - start
+        result = {
+            "codec": codec or "none",
+            "stored_mb": written / 2 ** 20,
+            "capacity_ratio": written / (block_num * block_size),
+            "write_mb_s": written / 2 ** 20 / write_s,
+            "read_mb_s": written / 2 ** 20 / read_s,
+            "random_4k_ops_s": reads / random_s,
+        }
+        results.append(result)
+        print(f"{result['codec']:5} stored {result['stored_mb']:7.1f}MB ({result['capacity_ratio']:.2f}x capacity)  "
+              f"write {result['write_mb_s']:6.1f}MB/s  read {result['read_mb_s']:6.1f}MB/s  "
+              f"random 4KB {result['random_4k_ops_s']:7.0f}/s", file=sys.stderr)
+    return results
+
+
+# 在当前进程中跑一组配置, 峰值内存只对单独的进程有意义, 由run_suite为每组配置起一个子进程
+def run_config(workload, block_num, block_size, seed=0, scale=1.0):
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        fs = file_system_components.FileSystem(os.path.join(tmp, "bench.save"), block_num, block_size)
+        rec = Recorder(fs)
+        start = time.perf_counter()
+        WORKLOADS[workload](fs, rec, rng, scale)
+        rec.time("SaveSystemState", fs.SaveSystemState)
+        wall = time.perf_counter() - start
+        cache = fs.disk.Stats()
+        fs.CloseVolume()
+    return {
+        "workload": workload,
+        "block_num": block_num,
+        "block_size": block_size,
+        "seed": seed,
+        "scale": scale,
+        "wall_s": wall,
+        # Linux下ru_maxrss以KB计
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "ops": rec.Summary(),
+        "cache": cache,
+    }
+
+
+def run_suite(workloads, block_nums, block_sizes, seed=0, scale=1.0):
+    results = []
+    for workload in workloads:
+        for block_num in block_nums:
+            for block_size in block_sizes:
+                config = json.dumps([workload, block_num, block_size, seed, scale])
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", config],
+                                        check=True, capture_output=True, text=True,
+                                        cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+                result = json.loads(output.splitlines()[-1])
+                results.append(result)
+                print(f"{workload:12} blocks={block_num:<8} size={block_size:<5} "
+                      f"{result['wall_s']:8.3f}s  rss={result['peak_rss_kb']}KB", file=sys.stderr)
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "results": results,
+    }
+
+
+# 与基准结果对比, 列出ops/sec下降超过threshold的项
+def compare(baseline, current, threshold=0.1):
+    def key(result):
+        return result["workload"], result["block_num"], result["block_size"], result["seed"], result["scale"]
+    old = {key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        base = old.get(key(result))
+        if base is None:
+            continue
+        for op, stats in result["ops"].items():
+            before = base["ops"].get(op, {}).get("ops_per_sec")
+            after = stats["ops_per_sec"]
+            if before and after and after < before * (1 - threshold):
+                regressions.append((key(result), op, before, after))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FAT file system benchmarks")
+    parser.add_argument("--workload", action="append", choices=sorted(WORKLOADS),
+                        help="要跑的负载, 可重复, 默认全部")
+    parser.add_argument("--block-num", type=int, action="append", help="块数, 可重复")
+    parser.add_argument("--block-size", type=int, action="append", help="块大小, 可重复")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--scale", type=float, default=1.0, help="操作次数的倍率")
+    parser.add_argument("--output", help="结果JSON写入的文件, 默认输出到标准输出")
+    parser.add_argument("--baseline", help="与之前的结果JSON对比")
+    parser.add_argument("--occupancy", type=int, metavar="BLOCK_NUM",
+                        help="只跑按占用率统计的WriteFile耗时")
+    parser.add_argument("--stress", type=int, metavar="THREADS",
+                        help="只跑多线程压力测试, 有问题时返回1")
+    parser.add_argument("--stress-ops", type=int, default=500, help="压力测试中每个线程的操作数")
+    parser.add_argument("--cold-start", type=int, metavar="FILES",
+                        help="只测打开有FILES个文件的卷的耗时")
+    parser.add_argument("--compression", type=int, metavar="BLOCK_NUM",
+                        help="只比较各压缩方式在BLOCK_NUM块的卷上的容量与读写速度")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--cold-worker", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        print(json.dumps(run_config(*json.loads(args.worker))))
+        return 0
+    if args.cold_worker:
+        print(json.dumps(cold_worker(*json.loads(args.cold_worker))))
+        return 0
+    if args.cold_start:
+        print(json.dumps(cold_start(args.cold_start), indent=2))
+        return 0
+    if args.compression:
+        print(json.dumps(bench_compression(args.compression, args.block_size[0] if args.block_size else 512),
+                         indent=2))
+        return 0
+    if args.occupancy:
+        bench_write_per_block(args.occupancy)
+        return 0
+    if args.stress:
+        problems = stress(args.stress, args.stress_ops, seed=args.seed)
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        return 1 if problems else 0
+
+    report = run_suite(args.workload or list(WORKLOADS),
+                       args.block_num or [2 ** 14, 2 ** 16],
+                       args.block_size or [4, 512],
+                       args.seed, args.scale)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), report)
+        for (workload, block_num, block_size, _, _), op, before, after in regressions:
+            print(f"regression {workload} blocks={block_num} size={block_size} {op}: "
+                  f"{before:.0f} -> {after:.0f} ops/s", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+import lzma
+import zlib
+from array import array
+from bisect import bisect_right
+
+EXTENT_SIZE = 2 ** 15  # 每段压缩前的字节数, 随机读最多解压这么多
+ZLIB_LEVEL = 6
+# lzma用不带文件头的原始格式: 每段单独压缩, 省下xz的头尾, 字典也不必比一段大
+LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 6, "dict_size": EXTENT_SIZE}]
+
+
+def _zlib_compress(data):
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+def _lzma_compress(data):
+    return lzma.compress(data, lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+
+
+def _lzma_decompress(data):
+    return lzma.decompress(data, lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+
+
+# 压缩方式 -> (压缩, 解压)
+CODECS = {
+    "zlib": (_zlib_compress, zlib.decompress),
+    "lzma": (_lzma_compress, _lzma_decompress),
+}
+
+
+# 压缩文件的段索引: 文件内容每EXTENT_SIZE字节一段, 各段分别压缩后依次存入FAT链, ends是各段在存储内容中的结束位置
+# 读任意位置只要解压它所在的一段; 改写只重新压缩涉及的段, 后面的段原样搬移
+# 压缩后没有变小的段原样存放, 存储的字节数不小于段长即为原样存放
+# 索引不可变, 改写时换成新的索引, 随FCB一起写入元数据
+class ExtentIndex:
+    __slots__ = ("codec", "length", "ends")
+
+    def __init__(self, codec, length=0, ends=None):
+        if codec not in CODECS:
+            raise ValueError(f"unknown compression: {codec}")
+        self.codec = codec
+        # 解压后的文件长度
+        self.length = length
+        self.ends = array("q") if ends is None else ends
+
+    def __reduce__(self):
+        return ExtentIndex, (self.codec, self.length, self.ends)
+
+    def __len__(self):
+        return len(self.ends)
+
+    # 存储的字节数, 即FAT链中的内容长度
+    @property
+    def stored(self):
+        return self.ends[-1] if self.ends else 0
+
+    # 第i段在存储内容中的[start, end)
+    def Span(self, i):
+        return (self.ends[i - 1] if i else 0), self.ends[i]
+
+    # 第i段解压后的字节数
+    def Size(self, i):
+        return min(EXTENT_SIZE, self.length - i * EXTENT_SIZE)
+
+    def Encode(self, data):
+        packed = CODECS[self.codec][0](data)
+        return packed if len(packed) < len(data) else data
+
+    def Decode(self, i, stored):
+        if len(stored) >= self.Size(i):
+            return stored
+        return CODECS[self.codec][1](stored)
+
+    # 从第first段起换成新压缩的packed, 原来第keep段及之后的段接在后面; 返回新的索引
+    def Replace(self, first, packed, keep, length):
+        ends = self.ends[:first]
+        pos = ends[-1] if first else 0
+        for data in packed:
+            pos += len(data)
+            ends.append(pos)
+        shift = pos - (self.ends[keep - 1] if keep else 0)
+        ends.extend(end + shift for end in self.ends[keep:])
+        return ExtentIndex(self.codec, length, ends)
+
+    # FAT链只剩前stored字节时还完整的段, fsck修复时用
+    def Cut(self, stored):
+        count = bisect_right(self.ends, stored)
+        return ExtentIndex(self.codec, min(self.length, count * EXTENT_SIZE), self.ends[:count])
@@ -0,0 +1,421 @@
+import itertools
+import threading
+import weakref
+from collections import deque
+
+import numpy as np
+
+MAX_INDEXED_BYTES = 4 * 2 ** 20  # 超过这个大小的文件不建索引, 查询时直接读出比对
+MERGE_MIN_POSTINGS = 2 ** 16  # 增量部分超过这个大小且超过主索引的1/4时合并进主索引
+ID_MASK = np.uint64(0xFFFFFFFF)
+BACKGROUND_BATCH = 256  # 后台线程每次读出建索引的文件数
+
+
+# 数据中出现过的所有三元组(连续三个字节编成一个整数), 去重并排好序
+# 排序后去掉相邻的重复项, 比np.unique快几倍
+def trigrams(data):
+    a = np.frombuffer(data, dtype=np.uint8)
+    if len(a) < 3:
+        return np.empty(0, dtype=np.uint32)
+    a = a.astype(np.uint32)
+    grams = (a[:-2] << 16) | (a[1:-1] << 8) | a[2:]
+    grams.sort()
+    return grams[np.concatenate(([True], grams[1:] != grams[:-1]))]
+
+
+# 主索引展开成 (三元组<<32)|编号 的键, 与新加的各部分接在一起排好序
+def _combine(base_grams, base_starts, base_ids, parts):
+    base = (np.repeat(base_grams, np.diff(base_starts)).astype(np.uint64) << np.uint64(32)) | \
+        base_ids.astype(np.uint64)
+    keys = np.concatenate([base] + parts)
+    keys.sort()
+    return keys
+
+
+# 排好序的键拆成主索引(三元组, 各组起点, 编号), 三元组已有序, 不必再用np.unique排一遍
+def _split(keys):
+    grams = (keys >> np.uint64(32)).astype(np.uint32)
+    first = np.ones(len(grams), dtype=np.bool_)
+    first[1:] = grams[1:] != grams[:-1]
+    starts = np.flatnonzero(first)
+    return grams[starts], np.append(starts, len(grams)).astype(np.int64), (keys & ID_MASK).astype(np.uint32)
+
+
+# 新加的倒排项按位置插进有序的增量部分, 只排新加的那些
+def _insert(delta, parts):
+    added = np.concatenate(parts)
+    added.sort()
+    return np.insert(delta, np.searchsorted(delta, added), added)
+
+
+# 文件内容的三元组倒排索引: 三元组 -> 含有它的文件, 查询时取各三元组的文件集合的交集, 再读出候选文件核对
+# 每个建过索引的文件有一个编号; 内容变了就作废旧编号, 按新内容换一个新编号, 旧的倒排项留到合并时才清掉
+# 主索引是按三元组分组的编号数组(三元组 -> 有序的编号), 新加的倒排项先放在增量部分((三元组<<32)|编号 的有序数组),
+# 编号只增不减, 所以同一个三元组的编号把两部分接起来仍然有序; 增量变大或作废的项太多时合并并重新编号
+# 按FCB对象索引, 文件与文件夹改名不必更新; 文件是否在某个目录之下沿父结点判断
+# 写入只把文件标记为过期, 由后台线程读出内容重建, 不拖慢写入; 后台线程在锁外合并, 写入不用等它
+# 文件夹第一次被查询到时加入索引(称为已覆盖), 之后在其中新建的文件随之加入; 只读入查询用到的文件夹与文件
+# 后台线程只重建已覆盖的文件夹中过期的文件, 没事可做就退出, 有新的改动时再启动
+# background为True时卷打开后后台线程还从根目录起逐个文件夹覆盖, 要读遍整个卷, 换来第一次查询不用等
+# 查询时还没轮到的文件夹与过期的文件由查询自己补上, 后台线程正在读的文件查询也要读出比对, 不会漏掉
+class ContentIndex:
+    def __init__(self, file_system, background=False):
+        self.fs = file_system
+        self.lock = threading.Lock()
+        # 是否在后台覆盖整个卷
+        self.background = background
+        # Start之后才在后台建索引, 打开卷时重放日志期间不动
+        self.started = False
+        self.closed = False
+        self.worker = None
+        # 每次清空加一, 清空之前读出的内容不再加入
+        self.generation = 0
+        # 读出文件时在文件锁内取的序号, 序号大的读到的内容不会更旧
+        self.reads = itertools.count()
+        self._reset()
+
+    def _reset(self):
+        # 文件 -> 编号, 编号 -> 文件(作废的为None), 每个编号的倒排项数, 读出序号与是否有效
+        self.ids = {}
+        self.files = []
+        self.counts = []
+        self.seqs = []
+        self.alive = bytearray()
+        self.live_postings = 0
+        self.dead_postings = 0
+        self.base_grams = np.empty(0, dtype=np.uint32)
+        self.base_starts = np.zeros(1, dtype=np.int64)
+        self.base_ids = np.empty(0, dtype=np.uint32)
+        self.delta = np.empty(0, dtype=np.uint64)
+        self.pending = []
+        # 太大而没建索引的文件 -> 读出序号, 查询时总要读出比对
+        self.large = {}
+        # 内容改过, 要重建的文件
+        self.stale = set()
+        self.covered = weakref.WeakSet()
+        # 正在读出建索引(后台线程或查询取走了), 还没加入索引的文件 -> 取走的次数
+        self.indexing = {}
+        # 后台线程待覆盖的文件夹, None表示从根目录开始; 换了目录树(格式化, 回滚)时随索引一起清空
+        self.folders = None
+        self.generation += 1
+
+    # 卷打开之后开始在后台建索引
+    def Start(self):
+        with self.lock:
+            self.started = True
+            self._wake()
+
+    # 关闭卷之前停下后台线程
+    def Close(self):
+        with self.lock:
+            self.closed = True
+            worker = self.worker
+        if worker is not None:
+            worker.join()
+
+    # 文件新建或内容改变
+    def Changed(self, File):
+        with self.lock:
+            if File in self.ids or File in self.large or File in self.indexing or File.parent in self.covered:
+                self.stale.add(File)
+                self._wake()
+
+    # 已覆盖的文件夹中新建的文件夹是空的, 直接算作已覆盖
+    def DirCreated(self, folder):
+        with self.lock:
+            if folder.parent in self.covered:
+                self.covered.add(folder)
+
+    # 文件挪到了别的文件夹: 已建的索引按FCB对象, 不用动; 还没进索引的挪进已覆盖的文件夹时要补上
+    def Moved(self, File):
+        with self.lock:
+            if File not in self.ids and File not in self.large and File.parent in self.covered:
+                self.stale.add(File)
+                self._wake()
+
+    # 文件夹挪进了已覆盖的文件夹, 子树中可能有没覆盖的文件夹, 交给后台线程
+    def DirMoved(self, folder):
+        with self.lock:
+            if folder.parent in self.covered and self.folders is not None:
+                self.folders.append(folder)
+                self._wake()
+
+    # 要有后台线程在跑, 调用者持有self.lock
+    def _wake(self):
+        if self.started and not self.closed and self.worker is None:
+            self.worker = threading.Thread(target=self._run, name="content-index", daemon=True)
+            self.worker.start()
+
+    # 遍历文件夹时给整卷加读锁, 与检查点改写未读入的文件夹等整卷操作错开
+    def _run(self):
+        volume_lock = self.fs.volume_lock
+        while True:
+            volume_lock.acquire_read()
+            try:
+                with self.lock:
+                    files = [] if self.closed else self._next_batch()
+                    if not files and (self.closed or not self.pending):
+                        self.worker = None
+                        return
+                    self._hold(files)
+                    generation = self.generation
+            finally:
+                volume_lock.release_read()
+            if not files:
+                # 空闲了, 把剩下的倒排项也并进去
+                self._compact(force=True)
+                continue
+            try:
+                self._reindex(files, generation)
+            finally:
+                self._release(files, generation)
+            self._compact()
+
+    # 记下取走的文件, 调用者持有self.lock; 别的查询看到这些文件时自己读出比对, 不依赖还没更新的索引
+    def _hold(self, files):
+        for File in files:
+            self.indexing[File] = self.indexing.get(File, 0) + 1
+
+    def _release(self, files, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            for File in files:
+                count = self.indexing.get(File, 0) - 1
+                if count > 0:
+                    self.indexing[File] = count
+                else:
+                    self.indexing.pop(File, None)
+
+    # 后台线程下一批要建索引的文件: 先是过期的文件, background时再按广度优先覆盖文件夹; 调用者持有self.lock
+    def _next_batch(self):
+        if self.stale:
+            files = []
+            while self.stale and len(files) < BACKGROUND_BATCH:
+                files.append(self.stale.pop())
+            return files
+        if not self.background:
+            return []
+        if self.folders is None:
+            self.folders = deque([self.fs.file_tree])
+        files = []
+        while self.folders and len(files) < BACKGROUND_BATCH:
+            folder = self.folders.popleft()
+            if folder.removed:
+                continue
+            self.folders.extend(folder.DirNode)
+            if folder not in self.covered:
+                self.covered.add(folder)
+                files.extend(folder.FileNode)
+        return files
+
+    def Removed(self, files):
+        with self.lock:
+            for File in files:
+                self._kill(File)
+                self.stale.discard(File)
+
+    def Clear(self):
+        with self.lock:
+            self._reset()
+            self._wake()
+
+    def _kill(self, File):
+        self.large.pop(File, None)
+        file_id = self.ids.pop(File, None)
+        if file_id is not None:
+            self.files[file_id] = None
+            self.alive[file_id] = 0
+            self.live_postings -= self.counts[file_id]
+            self.dead_postings += self.counts[file_id]
+
+    def _add(self, File, grams, seq):
+        file_id = len(self.files)
+        self.ids[File] = file_id
+        self.files.append(File)
+        self.counts.append(len(grams))
+        self.seqs.append(seq)
+        self.alive.append(1)
+        self.live_postings += len(grams)
+        self.pending.append((grams.astype(np.uint64) << np.uint64(32)) | np.uint64(file_id))
+
+    # 新加的倒排项并入增量部分, 必要时合并进主索引
+    def _flush(self):
+        parts = self.pending + [self.delta]
+        self.pending = []
+        if sum(map(len, parts)) > max(MERGE_MIN_POSTINGS, len(self.base_ids) // 4) or \
+                self.dead_postings > max(MERGE_MIN_POSTINGS, self.live_postings):
+            self._merge(parts)
+        elif len(parts) > 1:
+            self.delta = _insert(self.delta, parts[:-1])
+
+    # 后台线程在锁外把新加的倒排项并入, 不去掉作废的倒排项(编号不变), 写文件时不用等合并;
+    # 期间新加的留在pending, 索引被查询合并过或清空过就丢掉这次的结果
+    def _compact(self, force=False):
+        with self.lock:
+            pending, delta, base_ids = list(self.pending), self.delta, self.base_ids
+            base = self.base_grams, self.base_starts, base_ids
+        if sum(map(len, pending)) + len(delta) > max(MERGE_MIN_POSTINGS, len(base_ids) // 4):
+            base = _split(_combine(*base, pending + [delta]))
+            merged = np.empty(0, dtype=np.uint64)
+        elif force and pending:
+            merged = _insert(delta, pending)
+        else:
+            return
+        with self.lock:
+            if self.delta is not delta or self.base_ids is not base_ids:
+                return
+            self.base_grams, self.base_starts, self.base_ids = base
+            self.delta = merged
+            self.pending = self.pending[len(pending):]
+
+    # 主索引与增量部分合成新的主索引, 去掉作废的倒排项, 有效的编号按原顺序重新从0编起
+    def _merge(self, parts):
+        keys = _combine(self.base_grams, self.base_starts, self.base_ids, parts)
+        if self.dead_postings:
+            ids = (keys & ID_MASK).astype(np.intp)
+            alive = np.frombuffer(self.alive, dtype=np.bool_)
+            keep = alive[ids]
+            renumber = np.cumsum(alive, dtype=np.intp) - 1
+            keys = (keys[keep] & ~ID_MASK) | renumber[ids[keep]].astype(np.uint64)
+            self.files = [File for File in self.files if File is not None]
+            self.counts = [count for count, live in zip(self.counts, self.alive) if live]
+            self.seqs = [seq for seq, live in zip(self.seqs, self.alive) if live]
+            self.ids = {File: file_id for file_id, File in enumerate(self.files)}
+            self.alive = bytearray(b"\x01") * len(self.files)
+            self.dead_postings = 0
+        self.base_grams, self.base_starts, self.base_ids = _split(keys)
+        self.delta = np.empty(0, dtype=np.uint64)
+
+    # 含有三元组gram的所有编号(可能有作废的), 有序
+    def _posting(self, gram):
+        parts = []
+        i = np.searchsorted(self.base_grams, gram)
+        if i < len(self.base_grams) and self.base_grams[i] == gram:
+            parts.append(self.base_ids[self.base_starts[i]:self.base_starts[i + 1]])
+        lo, hi = np.searchsorted(self.delta, [np.uint64(gram) << np.uint64(32), np.uint64(gram + 1) << np.uint64(32)])
+        if hi > lo:
+            parts.append((self.delta[lo:hi] & ID_MASK).astype(np.uint32))
+        if not parts:
+            return np.empty(0, dtype=np.uint32)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    # 有效的候选文件: 含有pattern的全部三元组
+    def _candidates(self, pattern):
+        if len(pattern) < 3:
+            return set(self.ids)
+        postings = sorted((self._posting(gram) for gram in trigrams(pattern).tolist()), key=len)
+        ids = postings[0]
+        for posting in postings[1:]:
+            if len(ids) == 0:
+                break
+            ids = np.intersect1d(ids, posting, assume_unique=True)
+        alive = np.frombuffer(self.alive, dtype=np.bool_)
+        ids = ids[alive[ids]] if len(ids) else ids
+        files = self.files
+        return {files[file_id] for file_id in ids.tolist()}
+
+    @staticmethod
+    def _under(File, node):
+        parent = File.parent
+        while parent is not None:
+            if parent is node:
+                return True
+            parent = parent.parent
+        return False
+
+    # 读出整个文件与这次读出的序号, 文件已被删除时返回None
+    def _read(self, File):
+        try:
+            with self.fs.Locked(File):
+                return b"".join(self.fs.OpenFile(File).chunks()), next(self.reads)
+        except ValueError:
+            return None, None
+
+    # 已加入索引的内容的读出序号, 没有时为-1; 调用者持有self.lock
+    def _indexed_seq(self, File):
+        file_id = self.ids.get(File)
+        if file_id is not None:
+            return self.seqs[file_id]
+        return self.large.get(File, -1)
+
+    # 覆盖node之下还没覆盖的文件夹, 返回要(重新)建索引的文件: 这些文件夹中的文件和node之下过期或正被别处读出的文件
+    # 先标记覆盖再取文件列表, 之后新建的文件一定会经Changed进入stale; 返回的文件记为取走, 连同当时的代数一起返回
+    def _collect(self, node):
+        todo = []
+        with self.lock:
+            stack = [node]
+            while stack:
+                folder = stack.pop()
+                if folder not in self.covered:
+                    self.covered.add(folder)
+                    todo.extend(folder.FileNode)
+                stack.extend(folder.DirNode)
+            stale = [File for File in self.stale if self._under(File, node)]
+            self.stale.difference_update(stale)
+            stale += [File for File in self.indexing if self._under(File, node)]
+            files = todo + stale
+            self._hold(files)
+            return files, self.generation
+
+    # 读出内容更新索引, 返回读到的内容供这次查询直接比对
+    # 读出之后文件又被改写的话, Changed会再次把它标记为过期; 其间索引被清空(换了目录树)的话不再加入
+    # 查询与后台线程可能同时读同一个文件, 别处后读出的已经加入时不能用这次读到的旧内容覆盖
+    def _reindex(self, files, generation):
+        contents = {}
+        for File in files:
+            if self.closed:
+                break
+            data, seq = self._read(File)
+            if data is None:
+                self.Removed([File])
+                continue
+            contents[File] = data
+            grams = None if len(data) > MAX_INDEXED_BYTES else trigrams(data)
+            with self.lock:
+                if generation != self.generation:
+                    break
+                if self._indexed_seq(File) > seq:
+                    continue
+                self._kill(File)
+                if grams is None:
+                    self.large[File] = seq
+                else:
+                    self._add(File, grams, seq)
+        return contents
+
+    # node之下内容含有pattern(bytes)的文件
+    def Search(self, pattern, node):
+        files, generation = self._collect(node)
+        try:
+            contents = self._reindex(files, generation)
+        finally:
+            self._release(files, generation)
+        with self.lock:
+            self._flush()
+            candidates = self._candidates(pattern) | self.large.keys()
+        results = []
+        for File in candidates:
+            if not self._under(File, node):
+                continue
+            data = contents.get(File)
+            if data is None:
+                data, _ = self._read(File)
+                if data is None:
+                    self.Removed([File])
+                    continue
+            if pattern in data:
+                results.append(File)
+        return results
+
+    def Stats(self):
+        with self.lock:
+            return {
+                "files": len(self.ids),
+                "large": len(self.large),
+                "stale": len(self.stale),
+                "postings": self.live_postings,
+                "dead_postings": self.dead_postings,
+                "index_bytes": self.base_grams.nbytes + self.base_starts.nbytes + self.base_ids.nbytes +
+                               self.delta.nbytes,
+            }
@@ -0,0 +1,103 @@
+from file_system_components import FAT_END, FCB, FileSystem
+
+DEFRAG_STEP_BLOCKS = 4096  # 每次step最多搬动的块数
+
+
+# 在线碎片整理: 每次step只搬动少量文件, 可以穿插在正常操作之间, 随时停下
+# 先把分成多段的文件搬进一段连续的空闲区间,
+# compact时再按地址从低到高把文件挪进它前面的空洞, 让空闲空间连成一片
+class Defragmenter:
+    def __init__(self, file_system: FileSystem, compact=True):
+        self.fs = file_system
+        self.compact = compact
+        self.phase = "defrag"
+        self.queue = None
+        self.moved_files = 0
+        self.moved_blocks = 0
+
+    def _files(self):
+        files = []
+        stack = [self.fs.file_tree]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.DirNode)
+            files.extend(File for File in node.FileNode if File.start_address is not None)
+        return files
+
+    # 待处理的文件, 从列表末尾取
+    def _queue(self):
+        if self.phase == "defrag":
+            return self._files()
+        # 起点地址低的先挪
+        return sorted(self._files(), key=lambda File: File.start_address, reverse=True)
+
+    # 整理期间文件可能已被删除
+    def _alive(self, File: FCB):
+        return File.parent is not None and File.parent.GetFile(File.file_name) is File \
+            and self.fs.resolve(self.fs.PathOf(File.parent)) is File.parent
+
+    # 最多搬动budget个块(至少一个文件), 还有剩余工作时返回True
+    # 每步期间独占整卷, 步与步之间其他线程照常读写
+    def step(self, budget=DEFRAG_STEP_BLOCKS):
+        with self.fs.Exclusive():
+            return self._step(budget)
+
+    def _step(self, budget):
+        if self.queue is None:
+            self.queue = self._queue()
+        moved = 0
+        while moved < budget:
+            if not self.queue:
+                if self.phase == "defrag" and self.compact:
+                    self.phase = "compact"
+                    self.queue = self._queue()
+                    continue
+                return False
+            File = self.queue.pop()
+            if self._alive(File):
+                moved += self._process(File)
+        return True
+
+    def run(self):
+        while self.step():
+            pass
+
+    def _process(self, File: FCB):
+        extents = self.fs.Extents(File)
+        count = sum(length for _, length in extents)
+        if self.phase == "defrag":
+            if len(extents) <= 1:
+                return 0
+            start = self.fs.free_space.AllocateContiguous(count)
+        else:
+            if len(extents) != 1 or not self._next_to_free(extents[0][0], count):
+                return 0
+            start = self.fs.free_space.AllocateContiguous(count, before=extents[0][0])
+        if start is None:
+            return 0
+        self.Relocate(File, start, count)
+        return count
+
+    # 两侧都被占用的文件挪走后只会多出一个空洞, 不挪
+    def _next_to_free(self, start, count):
+        bitmap = self.fs.free_space.bitmap
+        end = start + count
+        return (start > 0 and not bitmap[start - 1]) or (end < len(bitmap) and not bitmap[end])
+
+    # 把文件的内容按链的顺序复制到从start开始的count个已分配的块, 再释放原来的链
+    def Relocate(self, File: FCB, start, count):
+        fs = self.fs
+        block_size = fs.disk.block_size
+        pointer = File.start_address
+        for block in range(start, start + count):
+            fs.disk.write(block, fs.disk.read(pointer, block_size), new=True)
+            fs.fat.Set(block, block + 1)
+            pointer = fs.fat.table[pointer]
+        fs.fat.Set(start + count - 1, FAT_END)
+        old = File.start_address
+        File.start_address = start
+        fs.FreeChain(old)
+        fs.LogMeta("attr", File.parent, File.file_name, File.start_address, File.length, File.modify_time,
+                   File.extents)
+        self.moved_files += 1
+        self.moved_blocks += count
@@ -1,10 +1,31 @@
 import pickle
+import hashlib
 import os
+import io
+import mmap
+import struct
+import sys
+import threading
+import weakref
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from datetime import datetime
+from array import array
 from bitarray import bitarray
+from bitarray.util import zeros
+import numpy as np
 
+from compression import CODECS, EXTENT_SIZE, ExtentIndex
+from content_index import ContentIndex
+from journal import Journal
+from locks import RWLock
+from metastore import ROOT_ID, MetaStore, ReadHeader, WriteHeader, from_stamp, to_stamp
+from snapshot import Snapshot, SnapshotTable
+
+# 新建卷的默认几何参数, 实际的块数与块大小记录在每个卷的超级块中
 BLOCK_NUM = 2 ** 10  # 块数
-BLOCK_SIZE = 4  # 每块的大小
+BLOCK_SIZE = 4  # 每块的大小(字节)
 
 FAT_FREE = -2  # 表示FAT表中此块未被使用
 FAT_END = -1  # 表示为FAT表中链表结尾
@@ -13,177 +34,2499 @@ SPACE_OCCUPY = 1  # 磁盘被占用
 SPACE_FREE = 0  # 未被占用
 
 SAVEFILE = "file_system_save.save"
+IMAGE_SUFFIX = ".img"  # 磁盘映像与存档同名, 后缀不同
+JOURNAL_SUFFIX = ".journal"  # 预写日志
+JOURNAL_LIMIT = 4 * 2 ** 20  # 日志超过这个大小就做一次检查点
+USAGE_OPS = frozenset(("create", "attr", "unlink", "rmdir", "move"))  # 会改变文件夹用量的元数据操作
+DENTRY_CACHE_SIZE = 4096  # 路径缓存的项数
+REBUILD_RUNS = 64  # 批量释放的区间超过这个数时, 直接按bitmap重建空闲区间索引
+FSCK_REPORT_LIMIT = 20  # fsck每类问题最多列出的条数
+CACHE_BYTES = 32 * 2 ** 20  # 块缓存默认的容量(字节)
+CACHE_MIN_BLOCKS = 256  # 块缓存至少容纳的块数
+CACHE_MAX_BLOCKS = 2 ** 16  # 块缓存最多容纳的块数, 块很小时限制缓存项本身的开销
+READ_AHEAD = 8  # 缓存未命中时沿FAT链预读的块数
+
+# 映像超级块: 魔数, 块数, 块大小, FAT/bitmap/数据区的偏移
+IMAGE_MAGIC = b"TJFATIMG"
+SUPERBLOCK = struct.Struct("<8sIIQQQ")
+FAT_ENTRY = struct.Struct("<i")
+# 去重卷的超级块在后面加上: 物理块数, 块映射与摘要区的偏移
+DEDUP_MAGIC = b"TJFATDDP"
+DEDUP_SUPERBLOCK = struct.Struct("<8sIIQQQIQQ")
+DEDUP_LOGICAL_FACTOR = 4  # 去重卷的逻辑块数是物理块数的几倍
+DIGEST_SIZE = 16  # 块内容的摘要(blake2b)字节数, 按摘要相同即内容相同处理, 不再比对
+NO_SLOT = -1  # 块映射中表示逻辑块没有内容
 
 
 # 文件信息
+# 文件很多时元数据的开销以FCB为主: 用__slots__, 时间存为整数时间戳(见metastore.to_stamp), 名字驻留
 class FCB:
+    __slots__ = ("file_name", "_create", "_modify", "length", "start_address", "parent", "extents", "__weakref__")
+
     def __init__(self, file_name, create_time, length, parent = None,start_address=None):
-        self.file_name = file_name
-        self.create_time = create_time
-        self.modify_time = create_time
+        self.file_name = sys.intern(file_name)
+        self._create = self._modify = to_stamp(create_time)
         self.length = length
         self.start_address = start_address
         self.parent=parent
+        # 压缩文件的段索引(见compression.ExtentIndex), 不压缩为None; 此时length是解压后的长度
+        self.extents = None
+
+    # 从元数据记录恢复, 时间已是时间戳
+    # pickle不会让相等的整数共用一个对象, 没改过的文件两个时间相等, 读入时共用, 每个文件省一个整数对象
+    @classmethod
+    def Restore(cls, parent, file_name, create, modify, length, start_address, extents=None):
+        File = cls.__new__(cls)
+        File.file_name = sys.intern(file_name)
+        File._create = create
+        File._modify = create if modify == create else modify
+        File.length = length
+        File.start_address = start_address
+        File.parent = parent
+        File.extents = extents
+        return File
+
+    # FAT链中内容的字节数
+    @property
+    def stored_length(self):
+        return self.length if self.extents is None else self.extents.stored
+
+    @property
+    def create_time(self):
+        return from_stamp(self._create)
+
+    @create_time.setter
+    def create_time(self, time):
+        self._create = to_stamp(time)
+
+    @property
+    def modify_time(self):
+        return from_stamp(self._modify)
+
+    @modify_time.setter
+    def modify_time(self, time):
+        self._modify = to_stamp(time)
+
+    # 与原来按__dict__保存的存档兼容
+    def __getstate__(self):
+        return {"file_name": self.file_name, "create_time": self.create_time, "modify_time": self.modify_time,
+                "length": self.length, "start_address": self.start_address, "parent": self.parent,
+                "extents": self.extents}
+
+    def __setstate__(self, state):
+        self.extents = None
+        for key, value in state.items():
+            setattr(self, key, value)
+
+
+# 磁盘映像: 超级块 | FAT | bitmap | 数据区, 各区按页对齐
+# 超级块, FAT与bitmap通过mmap访问, 以私有(写时复制)方式映射, 修改只留在内存中, 检查点时才用WriteBack写回文件
+# 数据区按块用pread/pwrite读写, 由Disk的块缓存决定何时写回; path为None时整个映像是一段匿名映射(纯内存)
+# 去重卷: 超级块 | FAT | bitmap | 块映射 | 摘要 | 数据区, FAT与bitmap管理逻辑块, 数据区是物理块(见DedupStore)
+class DiskImage:
+    def __init__(self, path, mm, block_num, block_size, fat_offset, bitmap_offset, data_offset, file=None,
+                 data_blocks=None, map_offset=None, digest_offset=None):
+        self.path = path
+        self.mm = mm
+        self.file = file
+        self.block_num = block_num
+        self.block_size = block_size
+        self.fat_offset = fat_offset
+        self.bitmap_offset = bitmap_offset
+        self.data_offset = data_offset
+        # 数据区的块数, 只有去重卷与block_num不同
+        self.data_blocks = block_num if data_blocks is None else data_blocks
+        self.map_offset = map_offset
+        self.digest_offset = digest_offset
+
+    @property
+    def dedup(self):
+        return self.map_offset is not None
+
+    # 私有(写时复制)映射; 支持时不预留交换空间, 大卷只为真正写过的页占用内存
+    @staticmethod
+    def _map(fileno, size):
+        if not hasattr(mmap, "MAP_PRIVATE"):
+            return mmap.mmap(fileno, size, access=mmap.ACCESS_COPY)
+        flags = mmap.MAP_PRIVATE | getattr(mmap, "MAP_NORESERVE", 0)
+        if fileno == -1:
+            flags |= mmap.MAP_ANONYMOUS
+        return mmap.mmap(fileno, size, flags=flags)
+
+    @staticmethod
+    def _align(offset):
+        return -(-offset // mmap.PAGESIZE) * mmap.PAGESIZE
+
+    # dedup时block_num是数据区的块数, 逻辑块数是它的DEDUP_LOGICAL_FACTOR倍
+    @classmethod
+    def create(cls, path=None, block_num=None, block_size=None, dedup=False):
+        block_num = BLOCK_NUM if block_num is None else block_num
+        block_size = BLOCK_SIZE if block_size is None else block_size
+        data_blocks = block_num
+        if dedup:
+            block_num *= DEDUP_LOGICAL_FACTOR
+        if block_num <= 0 or block_num % 8 != 0:
+            raise ValueError("block_num must be a positive multiple of 8")
+        if block_num >= 2 ** 31:
+            raise ValueError("block_num does not fit in a FAT entry")
+        if block_size <= 0:
+            raise ValueError("block_size must be positive")
+        fat_offset = cls._align(DEDUP_SUPERBLOCK.size if dedup else SUPERBLOCK.size)
+        bitmap_offset = cls._align(fat_offset + block_num * FAT_ENTRY.size)
+        map_offset = digest_offset = None
+        if dedup:
+            map_offset = cls._align(bitmap_offset + block_num // 8)
+            digest_offset = cls._align(map_offset + block_num * FAT_ENTRY.size)
+            data_offset = cls._align(digest_offset + data_blocks * DIGEST_SIZE)
+            superblock = DEDUP_SUPERBLOCK.pack(DEDUP_MAGIC, block_num, block_size, fat_offset, bitmap_offset,
+                                               data_offset, data_blocks, map_offset, digest_offset)
+        else:
+            data_offset = cls._align(bitmap_offset + block_num // 8)
+            superblock = SUPERBLOCK.pack(IMAGE_MAGIC, block_num, block_size, fat_offset, bitmap_offset, data_offset)
+        size = data_offset + data_blocks * block_size
+        if path is None:
+            mm = cls._map(-1, size)
+            mm[:len(superblock)] = superblock
+            image = cls(path, mm, block_num, block_size, fat_offset, bitmap_offset, data_offset, None,
+                        data_blocks, map_offset, digest_offset)
+            image.Format()
+            return image
+        # 稀疏文件, bitmap与数据区不会真正占用磁盘空间
+        with open(path, "w+b") as f:
+            f.truncate(size)
+            f.write(superblock)
+            f.seek(fat_offset)
+            f.write(FAT_ENTRY.pack(FAT_FREE) * block_num)
+            if dedup:
+                f.seek(map_offset)
+                f.write(FAT_ENTRY.pack(NO_SLOT) * block_num)
+            f.flush()
+            os.fsync(f.fileno())
+        return cls.open(path)
+
+    @classmethod
+    def open(cls, path):
+        f = open(path, "r+b")
+        superblock = f.read(DEDUP_SUPERBLOCK.size)
+        dedup = ()
+        if superblock[:len(DEDUP_MAGIC)] == DEDUP_MAGIC and len(superblock) == DEDUP_SUPERBLOCK.size:
+            magic, block_num, block_size, fat_offset, bitmap_offset, data_offset, *dedup = \
+                DEDUP_SUPERBLOCK.unpack(superblock)
+        elif superblock[:len(IMAGE_MAGIC)] == IMAGE_MAGIC and len(superblock) >= SUPERBLOCK.size:
+            magic, block_num, block_size, fat_offset, bitmap_offset, data_offset = \
+                SUPERBLOCK.unpack(superblock[:SUPERBLOCK.size])
+        else:
+            f.close()
+            raise ValueError(f"{path} is not a file system image")
+        # 只映射数据区之前的部分
+        mm = cls._map(f.fileno(), data_offset)
+        return cls(path, mm, block_num, block_size, fat_offset, bitmap_offset, data_offset, f, *dedup)
+
+    # 清空FAT与bitmap(去重卷还有块映射), 数据区不必清零
+    def Format(self):
+        self.mm[self.fat_offset:self.fat_offset + self.block_num * FAT_ENTRY.size] = \
+            FAT_ENTRY.pack(FAT_FREE) * self.block_num
+        self.mm[self.bitmap_offset:self.bitmap_offset + self.block_num // 8] = bytes(self.block_num // 8)
+        if self.dedup:
+            self.mm[self.map_offset:self.map_offset + self.block_num * FAT_ENTRY.size] = \
+                FAT_ENTRY.pack(NO_SLOT) * self.block_num
+
+    def view(self, offset, length):
+        return memoryview(self.mm)[offset:offset + length]
+
+    # 从数据区读出从block开始的count个块
+    def ReadBlocks(self, block, count):
+        offset = self.data_offset + block * self.block_size
+        if self.file is None:
+            return self.mm[offset:offset + count * self.block_size]
+        return os.pread(self.file.fileno(), count * self.block_size, offset)
+
+    # 从block开始写入若干整块
+    def WriteBlocks(self, block, data):
+        offset = self.data_offset + block * self.block_size
+        if self.file is None:
+            self.mm[offset:offset + len(data)] = data
+        else:
+            os.pwrite(self.file.fileno(), data, offset)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    # 把给定的FAT项(连同对应的bitmap字节)写回映像文件, 并与之前写入的数据块一起落盘
+    # full时整段写回FAT与bitmap区, 用于格式化与迁移
+    def WriteBack(self, fat_blocks=(), full=False):
+        if self.path is None:
+            return
+        if full:
+            fat_runs = [(0, self.block_num)]
+            bitmap_runs = [(0, self.block_num // 8)]
+        else:
+            fat_runs = _runs(sorted(fat_blocks))
+            bitmap_runs = _runs(sorted({block // 8 for block in fat_blocks}))
+        self.WriteRuns(self.fat_offset, FAT_ENTRY.size, fat_runs)
+        self.WriteRuns(self.bitmap_offset, 1, bitmap_runs)
+        os.fsync(self.file.fileno())
+
+    # 把映射区中从base开始, 每项size字节的若干段[start, end)写回文件, 不落盘
+    def WriteRuns(self, base, size, runs):
+        if self.path is None:
+            return
+        fd = self.file.fileno()
+        for start, end in runs:
+            offset = base + start * size
+            os.pwrite(fd, self.mm[offset:offset + (end - start) * size], offset)
+
+
+# 有序下标序列合并成[start, end)区间
+def _runs(indices):
+    runs = []
+    for index in indices:
+        if runs and runs[-1][1] == index:
+            runs[-1][1] = index + 1
+        else:
+            runs.append([index, index + 1])
+    return runs
+
+
+# bitarray中连续的1合并成[start, end)区间
+def _mask_runs(mask):
+    runs = []
+    pos = mask.find(1)
+    while pos != -1:
+        end = mask.find(0, pos)
+        if end == -1:
+            end = len(mask)
+        runs.append((pos, end))
+        pos = mask.find(1, end)
+    return runs
 
 
+# fsck的报告每类只保留前FSCK_REPORT_LIMIT条, 其余汇总成一条
+def _limit_report(report):
+    problems = []
+    counts = {}
+    for kind, text in report:
+        counts[kind] = counts.get(kind, 0) + 1
+        if counts[kind] <= FSCK_REPORT_LIMIT:
+            problems.append(text)
+    for kind, count in counts.items():
+        if count > FSCK_REPORT_LIMIT:
+            problems.append(f"... and {count - FSCK_REPORT_LIMIT} more {kind} problems")
+    return problems
+
+
+# FAT表: 映像中定长int数组的视图, 记录自上次保存以来改过的项
+# 有快照时每次改动先交给SnapshotTable记下旧值
 class FAT:
-    def __init__(self):
-        self.block_num = BLOCK_NUM
-        self.table = []
-        for i in range(BLOCK_NUM):
-            self.table.append(FAT_FREE)
+    def __init__(self, image: DiskImage, snapshots: SnapshotTable):
+        self.block_num = image.block_num
+        self.table = image.view(image.fat_offset, image.block_num * FAT_ENTRY.size).cast("i")
+        self.dirty = set()
+        self.snapshots = snapshots
+
+    def Set(self, block, value):
+        if self.snapshots:
+            old = self.table[block]
+            self.snapshots.Track(block, old, old == FAT_FREE, value == FAT_FREE)
+        self.table[block] = value
+        self.dirty.add(block)
+
+    # 把一段连续的项整段置为value
+    def Fill(self, start, end, value):
+        if self.snapshots:
+            for block in range(start, end):
+                self.Set(block, value)
+            return
+        self.table[start:end] = memoryview(array("i", [value]) * (end - start))
+        self.dirty.update(range(start, end))
+
+
+# 块去重: 逻辑块(FAT与bitmap管理的块)按内容映射到数据区中的物理块, 内容相同的逻辑块共用一个物理块
+# 块映射(逻辑块 -> 物理块)与每个物理块内容的摘要都在映像中, 引用计数与 摘要 -> 物理块 的索引由它们算出
+# 块写回映像时(Disk._write)才按内容找物理块: 已有相同的内容就多一个引用, 否则取一个空闲的物理块写入; 原来的物理块少一个引用
+# 没有引用的物理块(released)到检查点时才归还: 检查点时的映射用到的物理块与摘要在下个检查点之前不会被改写,
+# 崩溃后按映像中的映射与摘要重放日志, 内容相同的块仍能放心共用; 归还之前又写入相同的内容时直接再用
+# 释放的逻辑块也由Reclaim在检查点时按bitmap一起解除映射, 这时释放都已进日志
+class DedupStore:
+    def __init__(self, image: DiskImage):
+        self.image = image
+        self.map = image.view(image.map_offset, image.block_num * FAT_ENTRY.size).cast("i")
+        self.digests = image.view(image.digest_offset, image.data_blocks * DIGEST_SIZE)
+        self.Reset()
+
+    # 按映像中的块映射重算引用计数与空闲的物理块
+    def Reset(self):
+        mapping = np.asarray(self.map)
+        refs = np.bincount(mapping[mapping >= 0], minlength=self.image.data_blocks)
+        self.refs = refs.tolist()
+        # 栈顶是低地址
+        self.free_slots = np.flatnonzero(refs == 0)[::-1].tolist()
+        self.released = set()
+        self.index = None
+        self.dirty_map = set()
+        self.dirty_digests = set()
+
+    @property
+    def free_count(self):
+        return len(self.free_slots)
+
+    def _digest(self, slot):
+        return bytes(self.digests[slot * DIGEST_SIZE:(slot + 1) * DIGEST_SIZE])
+
+    # 摘要 -> 物理块, 第一次写回时才建
+    def _index(self):
+        if self.index is None:
+            self.index = {self._digest(slot): slot for slot in np.flatnonzero(np.array(self.refs)).tolist()}
+        return self.index
+
+    # 逻辑块的内容, 没有映射的是全0
+    def Read(self, blocks):
+        block_size = self.image.block_size
+        slots = [self.map[block] for block in blocks]
+        data = {}
+        for start, end in _runs(sorted({slot for slot in slots if slot != NO_SLOT})):
+            chunk = self.image.ReadBlocks(start, end - start)
+            for i in range(end - start):
+                data[start + i] = chunk[i * block_size:(i + 1) * block_size]
+        empty = bytes(block_size)
+        return [data.get(slot, empty) for slot in slots]
 
+    # 写入[(逻辑块, 整块内容)...], 返回新写入的物理块数
+    def Write(self, items):
+        index = self._index()
+        writes = {}
+        for block, data in items:
+            digest = hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+            slot = index.get(digest)
+            if slot is None:
+                # Disk.Reserve保证不会走到这里
+                if not self.free_slots:
+                    raise AssertionError("no more space")
+                slot = self.free_slots.pop()
+                index[digest] = slot
+                self.digests[slot * DIGEST_SIZE:(slot + 1) * DIGEST_SIZE] = digest
+                self.dirty_digests.add(slot)
+                writes[slot] = data
+            elif not self.refs[slot]:
+                self.released.discard(slot)
+            old = self.map[block]
+            if old == slot:
+                continue
+            self.refs[slot] += 1
+            self.map[block] = slot
+            self.dirty_map.add(block)
+            if old != NO_SLOT:
+                self._release(old)
+        for start, end in _runs(sorted(writes)):
+            self.image.WriteBlocks(start, b"".join(writes[slot] for slot in range(start, end)))
+        return len(writes)
 
-# 磁盘
+    def _release(self, slot):
+        self.refs[slot] -= 1
+        if self.refs[slot] == 0:
+            self.released.add(slot)
+
+    # 检查点时调用: bitmap中空闲的逻辑块解除映射, 然后归还没有引用的物理块
+    # 快照占着的块bitmap中是占用, 不受影响
+    def Reclaim(self, bitmap):
+        mapping = np.asarray(self.map)
+        used = np.unpackbits(np.frombuffer(bitmap, dtype=np.uint8), bitorder="little")[:len(mapping)].astype(bool)
+        stale = np.flatnonzero((mapping != NO_SLOT) & ~used).tolist()
+        for block in stale:
+            self._release(self.map[block])
+            self.map[block] = NO_SLOT
+        self.dirty_map.update(stale)
+        for slot in sorted(self.released, reverse=True):
+            if self.index is not None:
+                self.index.pop(self._digest(slot), None)
+            self.free_slots.append(slot)
+        self.released.clear()
+        return len(stale)
+
+    # 改过的映射与摘要写回映像文件, 由之后的DiskImage.WriteBack一起落盘
+    def WriteBack(self, full=False):
+        image = self.image
+        if full:
+            map_runs = [(0, image.block_num)]
+            digest_runs = [(0, image.data_blocks)]
+        else:
+            map_runs = _runs(sorted(self.dirty_map))
+            digest_runs = _runs(sorted(self.dirty_digests))
+        image.WriteRuns(image.map_offset, FAT_ENTRY.size, map_runs)
+        image.WriteRuns(image.digest_offset, DIGEST_SIZE, digest_runs)
+        self.dirty_map.clear()
+        self.dirty_digests.clear()
+
+    # 有内容的逻辑块数, 占用的物理块数与二者之比(去重率)
+    def Stats(self):
+        logical = sum(self.refs)
+        physical = len(self.refs) - len(self.free_slots)
+        return {
+            "logical_blocks": logical,
+            "physical_blocks": physical,
+            "free_physical_blocks": len(self.free_slots),
+            "dedup_ratio": logical / physical if physical else 1.0,
+        }
+
+
+# 磁盘: 映像数据区前的块缓存, 每块block_size字节, 按LRU淘汰
+# 写只改缓存; dirty是自上次保存以来写过的块, 还没进日志, 不能淘汰;
+# 已进日志但比映像新的块(unwritten)淘汰时或检查点时才写回映像, 这时崩溃重放日志会写回同样的内容
 class Disk():
-    def __init__(self):
-        # 用list代替链表指针
-        self.list = []
-        for i in range(BLOCK_NUM):
-            self.list.append("")
+    def __init__(self, image: DiskImage, fat: FAT, capacity=None, read_ahead=READ_AHEAD):
+        self.image = image
+        self.block_size = image.block_size
+        self.table = fat.table
+        if capacity is None:
+            capacity = min(max(CACHE_BYTES // self.block_size, CACHE_MIN_BLOCKS), CACHE_MAX_BLOCKS)
+        self.capacity = capacity
+        # 预读不超过容量的1/4, 免得刚读入的块马上被挤掉
+        self.read_ahead = max(1, min(read_ahead, capacity // 4))
+        self.cache = OrderedDict()
+        self.dirty = set()
+        self.unwritten = set()
+        # 去重卷的物理块, 见Reserve
+        self.dedup = DedupStore(image) if image.dedup else None
+        self.reserved = 0
+        # 不同文件的读写可以并发进行, 缓存本身的改动要互斥
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.evictions = 0
+        self.writebacks = 0
+
+    def read(self, block, length, offset=0):
+        with self.lock:
+            data = self.cache.get(block)
+            if data is None:
+                data = self._load(block)
+                self._evict()
+            else:
+                self.hits += 1
+                self.cache.move_to_end(block)
+            return bytes(data[offset:offset + length])
+
+    # new为True表示块刚分配, 原来的内容无用, 不必从映像读出
+    def write(self, block, data, offset=0, new=False):
+        with self.lock:
+            buffer = self.cache.get(block)
+            if buffer is not None:
+                self.hits += 1
+                self.cache.move_to_end(block)
+            elif new or (offset == 0 and len(data) == self.block_size):
+                buffer = self.cache[block] = bytearray(self.block_size)
+            else:
+                buffer = self._load(block)
+            buffer[offset:offset + len(data)] = data
+            self.dirty.add(block)
+            self.unwritten.add(block)
+            self._evict()
+
+    # 未命中: 连同FAT链上后面几个不在缓存中的块一起读入, 地址连续的合成一次读
+    def _load(self, block):
+        self.misses += 1
+        blocks = [block]
+        pointer = self.table[block]
+        while len(blocks) < self.read_ahead and pointer >= 0 and pointer not in self.cache:
+            blocks.append(pointer)
+            pointer = self.table[pointer]
+        self.prefetched += len(blocks) - 1
+        if self.dedup is not None:
+            for loaded, data in zip(blocks, self.dedup.Read(blocks)):
+                self.cache[loaded] = bytearray(data)
+        else:
+            for start, end in _runs(blocks):
+                data = self.image.ReadBlocks(start, end - start)
+                for i in range(end - start):
+                    self.cache[start + i] = bytearray(data[i * self.block_size:(i + 1) * self.block_size])
+        self.cache.move_to_end(block)
+        return self.cache[block]
+
+    # 超出容量时从最久未用的一端淘汰, 还没进日志的块挪到另一端
+    def _evict(self):
+        victims = []
+        while len(self.cache) > self.capacity and len(self.cache) > len(self.dirty):
+            block, data = self.cache.popitem(last=False)
+            if block in self.dirty:
+                self.cache[block] = data
+            elif block in self.unwritten:
+                victims.append((block, data))
+            else:
+                self.evictions += 1
+        if victims:
+            self.evictions += len(victims)
+            self._write(victims)
+            for block, _ in victims:
+                self.unwritten.discard(block)
+
+    def _write(self, items):
+        items.sort()
+        self.writebacks += len(items)
+        if self.dedup is not None:
+            self.dedup.Write(items)
+            return
+        blocks = [block for block, _ in items]
+        data = dict(items)
+        for start, end in _runs(blocks):
+            self.image.WriteBlocks(start, b"".join(data[block] for block in range(start, end)))
 
+    # 去重卷上写入count个块之前预留物理块: 没写回的块写回时每块最多占一个新的物理块
+    # 不够时先把已进日志的块写回, 再按内容算没写回的块实际要占的新块; 仍不够返回False
+    def Reserve(self, count):
+        with self.lock:
+            if self.dedup.free_count - len(self.unwritten) - self.reserved < count:
+                blocks = self.unwritten - self.dirty
+                if blocks:
+                    self._write([(block, self.cache[block]) for block in blocks])
+                    self.unwritten &= self.dirty
+                if self.dedup.free_count - self._pending_slots() - self.reserved < count:
+                    return False
+            self.reserved += count
+            return True
 
-# 空闲空间bitmap
+    # 没写回的块中与已有物理块都不同的内容数
+    def _pending_slots(self):
+        index = self.dedup._index()
+        digests = {hashlib.blake2b(self.cache[block], digest_size=DIGEST_SIZE).digest() for block in self.unwritten}
+        return len(digests - index.keys())
+
+    # 写入完成, 这些块已算在unwritten中
+    def Unreserve(self, count):
+        with self.lock:
+            self.reserved -= count
+
+    # 写过的块已进日志, 不再钉在缓存中
+    def Commit(self):
+        with self.lock:
+            self.dirty.clear()
+            self._evict()
+
+    # 把所有比映像新的块写回映像, 检查点时调用
+    def Flush(self):
+        with self.lock:
+            if self.unwritten:
+                self._write([(block, self.cache[block]) for block in self.unwritten])
+                self.unwritten.clear()
+
+    def Stats(self):
+        return {
+            "capacity": self.capacity,
+            "cached": len(self.cache),
+            "dirty": len(self.dirty),
+            "unwritten": len(self.unwritten),
+            "hits": self.hits,
+            "misses": self.misses,
+            "prefetched": self.prefetched,
+            "evictions": self.evictions,
+            "writebacks": self.writebacks,
+        }
+
+
+# 空闲空间bitmap, 直接映射到映像中的bitmap区
+# 同时维护空闲区间(extent)索引, 一次分配一段连续的空闲块
 class FreeSpace:
-    def __init__(self):
-        self.bitmap = bitarray(BLOCK_NUM)
-        self.bitmap.setall(0)
+    def __init__(self, image: DiskImage):
+        self.bitmap = bitarray(buffer=image.view(image.bitmap_offset, image.block_num // 8), endian="little")
+        self.RebuildExtents()
+
+    def RebuildExtents(self):
+        # 按地址有序: 起点列表 + 起点->长度
+        self.extent_starts = []
+        self.extent_length = {}
+        # 按大小有序: (长度, 起点)
+        self.extent_sizes = []
+        self.free_count = 0
+        pos = self.bitmap.find(SPACE_FREE)
+        while pos != -1:
+            end = self.bitmap.find(SPACE_OCCUPY, pos)
+            if end == -1:
+                end = len(self.bitmap)
+            self._add_extent(pos, end - pos)
+            pos = self.bitmap.find(SPACE_FREE, end)
+
+    def _add_extent(self, start, length):
+        insort(self.extent_starts, start)
+        insort(self.extent_sizes, (length, start))
+        self.extent_length[start] = length
+        self.free_count += length
+
+    def _remove_extent(self, start):
+        length = self.extent_length.pop(start)
+        del self.extent_starts[bisect_left(self.extent_starts, start)]
+        del self.extent_sizes[bisect_left(self.extent_sizes, (length, start))]
+        self.free_count -= length
+        return length
+
+    # 分配count个块, 返回[(起点, 长度), ...], 空间不足返回None
+    def Allocate(self, count):
+        if count > self.free_count:
+            return None
+        extents = []
+        while count > 0:
+            # 优先找能一次装下的最小区间, 否则取最大的区间
+            i = bisect_left(self.extent_sizes, (count, -1))
+            if i == len(self.extent_sizes):
+                i -= 1
+            length, start = self.extent_sizes[i]
+            self._remove_extent(start)
+            take = min(length, count)
+            if take < length:
+                self._add_extent(start + take, length - take)
+            self.bitmap[start:start + take] = SPACE_OCCUPY
+            extents.append((start, take))
+            count -= take
+        return extents
+
+    # 分配一段连续的count个块, 返回起点, 没有足够长的空闲区间返回None
+    # 不给before时取能装下的最小区间; 给了before时取起点在before之前的最低地址区间, 用于把文件往前挪
+    def AllocateContiguous(self, count, before=None):
+        if before is None:
+            i = bisect_left(self.extent_sizes, (count, -1))
+            if i == len(self.extent_sizes):
+                return None
+            start = self.extent_sizes[i][1]
+        else:
+            for start in self.extent_starts:
+                if start >= before:
+                    return None
+                if self.extent_length[start] >= count:
+                    break
+            else:
+                return None
+        length = self._remove_extent(start)
+        if count < length:
+            self._add_extent(start + count, length - count)
+        self.bitmap[start:start + count] = SPACE_OCCUPY
+        return start
+
+    # 释放一段连续的块, 并与相邻空闲区间合并
+    def Free(self, start, length):
+        self.bitmap[start:start + length] = SPACE_FREE
+        i = bisect_left(self.extent_starts, start)
+        if i > 0:
+            prev = self.extent_starts[i - 1]
+            if prev + self.extent_length[prev] == start:
+                length += start - prev
+                start = prev
+                self._remove_extent(prev)
+        end = start + length
+        if end in self.extent_length:
+            length += self._remove_extent(end)
+        self._add_extent(start, length)
+
+    # 批量释放mask中为1的块, runs是mask中的区间
+    # 区间少时逐段合并, 多时整段位运算清bitmap后重建索引
+    def FreeMask(self, mask, runs):
+        if len(runs) <= REBUILD_RUNS:
+            for start, end in runs:
+                self.Free(start, end - start)
+            return
+        self.bitmap &= ~mask
+        self.RebuildExtents()
 
 
 # 多级目录中的文件夹结点
 # N叉树的数据结构
+# 子结点用 名字->结点 的字典索引, 列表顺序就是索引的插入顺序;
+# 改名会打乱索引的顺序, 所以第一次改名时才另建一个按插入顺序的字典(_file_order/_dir_order)保留列表顺序
+# 从元数据文件打开的卷中, 文件夹起初只有名字和记录编号(见Stub), 第一次访问内容时才读入记录
+# 与FCB一样用__slots__与整数时间戳
+# usage是整棵子树的用量[字节数, 块数, 文件数], 由FileSystem随每次改动沿父结点逐级更新(见_account); 旧版记录中没有, 为None
 class FileTreeNode:  # dir
+    __slots__ = ("file_index", "dir_index", "_file_order", "_dir_order", "_file_list", "_dir_list",
+                 "_file_row", "_dir_row", "parent", "dir_name", "_create", "_modify", "usage", "removed", "dir_id",
+                 "_store", "__weakref__")
+    # 未读入的文件夹缺少这些属性, 访问时由__getattr__读入记录
+    LAZY_ATTRS = frozenset(("file_index", "dir_index", "_file_order", "_dir_order", "_file_list", "_dir_list",
+                            "_file_row", "_dir_row", "_create", "_modify", "usage"))
+
     def __init__(self, name: str,create_time, parent=None):
-        self.DirNode = []
-        self.FileNode = []
+        # 元数据文件中的记录编号, 还没写过时为None; 未读入时_store是记录所在的MetaStore
+        self.dir_id = None
+        self._store = None
+        self.file_index = {}
+        self.dir_index = {}
+        self._file_order = None
+        self._dir_order = None
+        self._file_list = None
+        self._dir_list = None
+        self._file_row = None
+        self._dir_row = None
         self.parent = parent
-        self.dir_name = name
-        self.create_time = create_time
-        self.modify_time = create_time
+        self.dir_name = None if name is None else sys.intern(name)
+        self._create = self._modify = to_stamp(create_time)
+        self.usage = [0, 0, 0]
+        # 已从目录树上删除(连同所在的子树)
+        self.removed = False
+
+    @classmethod
+    def Stub(cls, name, parent, dir_id, store):
+        node = cls.__new__(cls)
+        node.parent = parent
+        node.dir_name = None if name is None else sys.intern(name)
+        node.removed = False
+        node.dir_id = dir_id
+        node._store = store
+        return node
+
+    def __getattr__(self, name):
+        if name in FileTreeNode.LAZY_ATTRS and self._store is not None:
+            self._load()
+            return getattr(self, name)
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    @property
+    def loaded(self):
+        return self._store is None
+
+    @property
+    def create_time(self):
+        return from_stamp(self._create)
+
+    @create_time.setter
+    def create_time(self, time):
+        # 未读入的文件夹先读入, 免得之后被记录中的旧时间盖掉
+        self._load()
+        self._create = to_stamp(time)
+
+    @property
+    def modify_time(self):
+        return from_stamp(self._modify)
+
+    @modify_time.setter
+    def modify_time(self, time):
+        self._load()
+        self._modify = to_stamp(time)
+
+    # 读入记录: (名字, 创建时间, 修改时间, [(文件名, 创建时间, 修改时间, 长度, 起始块)...], [(文件夹名, 编号)...], 用量)
+    # 旧版的记录没有最后的用量
+    # 索引先建好再赋值, 并发访问的线程要么看到完整的索引, 要么进入_load等锁
+    def _load(self):
+        store = self._store
+        if store is None:
+            return
+        with store.lock:
+            if self._store is None:
+                return
+            name, create, modify, files, dirs, *usage = store.Read(self.dir_id)
+            # 以驻留过的名字作键, 记录中读出的字符串随即释放
+            restore = FCB.Restore
+            file_list = [restore(self, *entry) for entry in files]
+            file_index = {File.file_name: File for File in file_list}
+            dir_list = [FileTreeNode.Stub(child_name, self, child_id, store) for child_name, child_id in dirs]
+            dir_index = {child.dir_name: child for child in dir_list}
+            # 读入之前改过的名字(给未读入的文件夹改名)比记录新
+            if self.dir_name is None:
+                self.dir_name = sys.intern(name)
+            self._create = create
+            self._modify = create if modify == create else modify
+            self.usage = list(usage[0]) if usage and usage[0] is not None else None
+            self._file_list = None
+            self._dir_list = None
+            self._file_row = None
+            self._dir_row = None
+            # 改名撞上了同名的结点时, 索引中少了被挤掉的, 要另存顺序
+            self._file_order = None if len(file_index) == len(file_list) else dict.fromkeys(file_list)
+            self._dir_order = None if len(dir_index) == len(dir_list) else dict.fromkeys(dir_list)
+            self.file_index = file_index
+            self.dir_index = dir_index
+            self._store = None
+
+    # 写入元数据文件的记录, child_ids是各子文件夹的编号
+    def Record(self, child_ids):
+        return (self.dir_name, self._create, self._modify,
+                [(File.file_name, File._create, File._modify, File.length, File.start_address)
+                 if File.extents is None else
+                 (File.file_name, File._create, File._modify, File.length, File.start_address, File.extents)
+                 for File in self.FileNode],
+                [(child.dir_name, child_id) for child, child_id in zip(self.DirNode, child_ids)],
+                None if self.usage is None else tuple(self.usage))
+
+    # 旧版存档中只保存有序的子结点列表, 索引读档时重建
+    def __getstate__(self):
+        self._load()
+        return {"parent": self.parent, "dir_name": self.dir_name, "create_time": self.create_time,
+                "modify_time": self.modify_time, "removed": self.removed,
+                "FileNode": self.FileNode, "DirNode": self.DirNode}
+
+    def __setstate__(self, state):
+        files = state.pop("FileNode")
+        dirs = state.pop("DirNode")
+        self.removed = False
+        self.dir_id = None
+        self._store = None
+        self.usage = None
+        for key, value in state.items():
+            setattr(self, key, value)
+        self.file_index = {}
+        self.dir_index = {}
+        self._file_order = None
+        self._dir_order = None
+        self._file_list = None
+        self._dir_list = None
+        self._file_row = None
+        self._dir_row = None
+        for File in files:
+            self.AddFile(File)
+        for child in dirs:
+            self.AddDir(child)
+
+    # 按顺序排列的子文件/子目录, 只读, 修改请用下面的方法
+    @property
+    def FileNode(self):
+        if self._file_list is None:
+            order = self._file_order
+            self._file_list = list(self.file_index.values() if order is None else order)
+        return self._file_list
+
+    @property
+    def DirNode(self):
+        if self._dir_list is None:
+            order = self._dir_order
+            self._dir_list = list(self.dir_index.values() if order is None else order)
+        return self._dir_list
+
+    # 子结点在列表中的位置, 与列表一起缓存
+    def FileRow(self, File):
+        if self._file_row is None:
+            self._file_row = {node: row for row, node in enumerate(self.FileNode)}
+        return self._file_row[File]
+
+    def DirRow(self, child):
+        if self._dir_row is None:
+            self._dir_row = {node: row for row, node in enumerate(self.DirNode)}
+        return self._dir_row[child]
+
+    def GetFile(self, name):
+        return self.file_index.get(name)
+
+    def GetDir(self, name):
+        return self.dir_index.get(name)
+
+    # 同名的结点会从索引中挤掉原来的, 列表中两个都保留
+    def AddFile(self, File):
+        if self._file_order is None and File.file_name in self.file_index:
+            self._file_order = dict.fromkeys(self.file_index.values())
+        self.file_index[File.file_name] = File
+        if self._file_order is not None:
+            self._file_order[File] = None
+        self._file_list = None
+        self._file_row = None
+
+    def AddDir(self, child):
+        if self._dir_order is None and child.dir_name in self.dir_index:
+            self._dir_order = dict.fromkeys(self.dir_index.values())
+        self.dir_index[child.dir_name] = child
+        if self._dir_order is not None:
+            self._dir_order[child] = None
+        self._dir_list = None
+        self._dir_row = None
+
+    def RemoveFile(self, File):
+        if self.file_index.get(File.file_name) is File:
+            del self.file_index[File.file_name]
+        if self._file_order is not None:
+            del self._file_order[File]
+        self._file_list = None
+        self._file_row = None
+
+    def RemoveDir(self, child):
+        if self.dir_index.get(child.dir_name) is child:
+            del self.dir_index[child.dir_name]
+        if self._dir_order is not None:
+            del self._dir_order[child]
+        self._dir_list = None
+        self._dir_row = None
+
+    # 改名只更新名字索引, 列表顺序不变
+    def RenameFileEntry(self, File, new_name):
+        if self._file_order is None:
+            self._file_order = dict.fromkeys(self.file_index.values())
+        if self.file_index.get(File.file_name) is File:
+            del self.file_index[File.file_name]
+        File.file_name = new_name = sys.intern(new_name)
+        self.file_index[new_name] = File
+
+    def RenameDirEntry(self, child, new_name):
+        if self._dir_order is None:
+            self._dir_order = dict.fromkeys(self.dir_index.values())
+        if self.dir_index.get(child.dir_name) is child:
+            del self.dir_index[child.dir_name]
+        child.dir_name = new_name = sys.intern(new_name)
+        self.dir_index[new_name] = child
+
+# FileSystem.Locked加上的一组锁, 离开with时按相反的顺序释放
+class HeldLocks:
+    def __init__(self, locks, write):
+        self.locks = locks
+        self.write = write
+
+    def release(self):
+        self.locks[-1].release(self.write)
+        for lock in reversed(self.locks[:-1]):
+            lock.release_read()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+# 顺序读取文件内容的只读字节流, 沿FAT链按块前进; 压缩文件读出的是压缩后的内容, 见CompressedReader
+class FileReader:
+    def __init__(self, file_system, File: FCB):
+        self.fat = file_system.fat
+        self.disk = file_system.disk
+        self.block_size = file_system.disk.block_size
+        self.file = File
+        self.offset = 0
+        self.seek(0)
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.offset
+        elif whence == io.SEEK_END:
+            offset += self.size()
+        if offset < 0:
+            raise ValueError("negative seek position")
+        # 只沿FAT链跳转, 不读取前面的块
+        target = offset // self.block_size
+        if offset < self.offset or self.offset == 0:
+            self._block = self._start()
+            index = 0
+        else:
+            index = self._block_index
+        while index < target and self._block != FAT_END:
+            self._block = self.fat.table[self._block]
+            index += 1
+        self._block_index = index
+        self.offset = offset
+        return offset
+
+    def _start(self):
+        if self.file.start_address is None:
+            return FAT_END
+        return self.file.start_address
+
+    def size(self):
+        return self.file.stored_length
+
+    # 读出size个字节, size<0时读到文件末尾
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            chunk = self._read_block(size)
+            if chunk == b"":
+                break
+            parts.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(parts)
+
+    # 从当前位置读出不超过size个字节, 且不跨越块边界
+    def _read_block(self, size=-1):
+        length = self.file.stored_length
+        while self._block != FAT_END and self.offset < length:
+            pos = self.offset - self._block_index * self.block_size
+            if pos < self.block_size:
+                count = min(self.block_size - pos, length - self.offset)
+                if size >= 0:
+                    count = min(count, size)
+                self.offset += count
+                return self.disk.read(self._block, count, pos)
+            self._block = self.fat.table[self._block]
+            self._block_index += 1
+        return b""
+
+    # 按chunk_size分段产出文件内容, 默认每次一个块
+    def chunks(self, chunk_size=None):
+        if chunk_size is None:
+            chunk_size = self.block_size
+        while True:
+            chunk = self.read(chunk_size)
+            if chunk == b"":
+                return
+            yield chunk
+
+    def __iter__(self):
+        return self.chunks()
+
+
+# 压缩文件解压后的只读字节流, 接口与FileReader相同: 按段解压, 只留着当前的一段
+class CompressedReader(FileReader):
+    def __init__(self, file_system, File: FCB):
+        self.stored = FileReader(file_system, File)
+        self.file = File
+        # chunks()默认每次一段
+        self.block_size = EXTENT_SIZE
+        self.offset = 0
+        self._index = None
+        self._extent = None
+        self._data = b""
+
+    # 不读取, 用到时才解压所在的段
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.offset
+        elif whence == io.SEEK_END:
+            offset += self.size()
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.offset = offset
+        return offset
+
+    def size(self):
+        return self.file.length
+
+    def _read_block(self, size=-1):
+        index = self.file.extents
+        if self.offset >= index.length:
+            return b""
+        i = self.offset // EXTENT_SIZE
+        # 文件改写后换了新的索引, 之前解压的段作废
+        if i != self._extent or index is not self._index:
+            start, end = index.Span(i)
+            self.stored.seek(start)
+            self._data = index.Decode(i, self.stored.read(end - start))
+            self._index = index
+            self._extent = i
+        pos = self.offset - i * EXTENT_SIZE
+        count = len(self._data) - pos
+        if size >= 0:
+            count = min(count, size)
+        self.offset += count
+        return self._data[pos:pos + count]
+
 
 class FileSystem:
-    def __init__(self):
+    # save_file为None时不落盘, 整个卷只在内存中
+    # block_num, block_size只在新建卷时使用, 已有的卷按超级块中的参数打开
+    # cache_blocks是块缓存的容量, 默认按块大小换算
+    # dedup: 新建的卷按内容去重存储, 见DedupStore; 已有的卷沿用映像中的设置
+    # compression: 之后新建的文件按这种方式(zlib或lzma)压缩, 类似挂载选项, 已有的文件各自保持原样
+    # index_content: 打开卷后在后台给全部文件内容建索引, 要读遍整个卷; 默认第一次查询到的文件夹才建, 见ContentIndex
+    def __init__(self, save_file=SAVEFILE, block_num=None, block_size=None, cache_blocks=None, dedup=False,
+                 compression=None, index_content=False):
+        if compression is not None and compression not in CODECS:
+            raise ValueError(f"unknown compression: {compression}")
+        self.save_file = save_file
+        self.cache_blocks = cache_blocks
+        self.compression = compression
+        self.journal = None
+        self.journal_seq = 0
+        # 尚未写入日志的元数据操作
+        self.meta_log = []
+        # 自上次检查点以来改过的FAT项, 检查点时写回映像; 改过的块由块缓存记录
+        self.checkpoint_fat = set()
+        self.format_pending = False
+        # 目录元数据文件, 旧版存档与内存卷没有; 自上次检查点以来改过的文件夹与删掉的记录编号
+        self.meta = None
+        self.dirty_dirs = set()
+        self.dead_dirs = []
+        # 路径 -> 结点 的LRU缓存
+        self.dentry_cache = OrderedDict()
+        self.dentry_lock = threading.Lock()
+        # 文件夹/文件 -> 读写锁, 见Locked
+        self.node_locks = weakref.WeakKeyDictionary()
+        self.node_locks_mutex = threading.Lock()
+        # 整卷的读写锁, 见Locked与Exclusive
+        self.volume_lock = RWLock()
+        # 分配与释放块时锁住FreeSpace与FAT
+        self.alloc_lock = threading.RLock()
+        self.meta_lock = threading.Lock()
+        # 更新各文件夹的用量(FileTreeNode.usage)时加锁
+        self.usage_lock = threading.Lock()
+        # 文件内容的全文索引, 见SearchContent
+        self.content_index = ContentIndex(self, background=index_content)
+        # 快照, 见CreateSnapshot; 只有落盘的卷才有
+        self.snapshots = SnapshotTable()
+        if save_file is None:
+            self.image_file = None
+            self.file_tree = FileTreeNode("User",datetime.now())
+            self.Mount(DiskImage.create(None, block_num, block_size, dedup))
+            self.content_index.Start()
+            return
+
+        base = os.path.splitext(save_file)[0]
+        self.image_file = image_file = base + IMAGE_SUFFIX
+        self.journal = Journal(base + JOURNAL_SUFFIX)
         # 存在存档文件
-        if os.path.exists(SAVEFILE):
-            # 按序读出文件信息
-            with open(SAVEFILE, 'rb') as f:
+        if os.path.exists(save_file):
+            with open(save_file, 'rb') as f:
+                header = ReadHeader(f)
+                if header is not None:
+                    # 存档文件指向元数据文件中的索引, 启动时只读入根目录, 其余文件夹用到时才读
+                    version, self.journal_seq, generation, index_offset, index_count = header
+                    self.meta = MetaStore.open(base, generation, index_offset, index_count, version)
+                    self.file_tree = FileTreeNode.Stub(None, None, ROOT_ID, self.meta)
+                    self.file_tree._load()
+                    self.snapshots.Load(f.read())
+                    self.Mount(DiskImage.open(image_file))
+                    self.Replay()
+                    self.content_index.Start()
+                    return
+                # 旧版存档中是检查点时的整棵目录树, 下次检查点时改写成元数据文件
                 self.file_tree = pickle.load(f)
-                self.free_space = pickle.load(f)
-                self.disk = pickle.load(f)
-                self.fat = pickle.load(f)
+                if os.path.exists(image_file):
+                    self.journal_seq = pickle.load(f)
+                    self.Mount(DiskImage.open(image_file))
+                    self.Replay()
+                else:
+                    # 旧版存档, 目录树之后依次是bitmap, 磁盘, FAT
+                    self.Mount(DiskImage.create(image_file, block_num, block_size))
+                    self.MigrateLegacy(f)
+                    self.Checkpoint(full=True)
         # 不存在文件，自己创建一个
         else:
             self.file_tree = FileTreeNode("User",datetime.now())
-            self.free_space = FreeSpace()
-            self.disk = Disk()
-            self.fat = FAT()
+            self.Mount(DiskImage.create(image_file, block_num, block_size, dedup))
+            self.Checkpoint()
+        self.content_index.Start()
+
+    # 关闭卷: 停下后台线程, 关闭各个文件; 之前要先SaveSystemState
+    # 不叫close/move, 图形界面的窗口类同时继承QWidget, 会被QWidget.close/move遮住
+    def CloseVolume(self):
+        self.content_index.Close()
+        if self.journal is not None:
+            self.journal.close()
+        if self.meta is not None:
+            self.meta.close()
+        self.image.close()
+
+    def Mount(self, image: DiskImage):
+        self.image = image
+        self.free_space = FreeSpace(image)
+        self.fat = FAT(image, self.snapshots)
+        self.disk = Disk(image, self.fat, self.cache_blocks)
+
+    # 把旧版存档中按字符串保存的文件内容写入磁盘映像
+    def MigrateLegacy(self, f):
+        pickle.load(f)
+        disk = pickle.load(f)
+        fat = pickle.load(f)
+        stack = [self.file_tree]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.DirNode)
+            for File in node.FileNode:
+                data = []
+                pointer = File.start_address
+                while pointer is not None and pointer != FAT_END:
+                    data.append(disk.list[pointer])
+                    pointer = fat.table[pointer]
+                File.start_address = None
+                File.length = 0
+                self._write_range(File, 0, "".join(data).encode("utf-8"), truncate=True)
+
+    # 启动时重放检查点之后已提交的事务
+    # 记录: (FAT项, 块, 元数据操作, 快照表的改动), 旧版日志中没有最后一项
+    # 快照还占着的块FAT项是空闲的, bitmap中仍是占用
+    def Replay(self):
+        for seq, record in self.journal.Records():
+            if seq <= self.journal_seq:
+                continue
+            fat_items, block_items, meta_ops = record[:3]
+            if len(record) > 3:
+                self.snapshots.ApplyLog(record[3])
+            for block, value in fat_items:
+                self.fat.table[block] = value
+                self.free_space.bitmap[block] = value != FAT_FREE or block in self.snapshots.held
+                self.checkpoint_fat.add(block)
+            for block, data in block_items:
+                self.disk.write(block, data)
+            for op in meta_ops:
+                self.ApplyMeta(op)
+            self.journal_seq = seq
+        self.snapshots.log = []
+        self.disk.Commit()
+        self.free_space.RebuildExtents()
 
     def find_free_index(self):
         # 0 -> free
         return self.free_space.bitmap.find(0)
 
+    # 只把上次保存以来改动的FAT项, 块和元数据操作追加到日志
+    # 独占整卷, 日志中是一个一致的状态
     def SaveSystemState(self):
-        with open(SAVEFILE, 'wb') as f:
-            pickle.dump(self.file_tree, f)
-            pickle.dump(self.free_space, f)
-            pickle.dump(self.disk, f)
-            pickle.dump(self.fat, f)
-
-    def FormatSystem(self):
-        self.file_tree = FileTreeNode("User",datetime.now())
-        self.free_space = FreeSpace()
-        self.disk = Disk()
-        self.fat = FAT()
+        if self.journal is None:
+            return
+        with self.Exclusive():
+            if self.format_pending:
+                self.Checkpoint(full=True)
+                return
+            self._append_journal()
+            if self.journal.size > JOURNAL_LIMIT:
+                self.Checkpoint()
+
+    def _append_journal(self):
+        fat_dirty = self.fat.dirty
+        block_dirty = self.disk.dirty
+        if fat_dirty or block_dirty or self.meta_log or self.snapshots.log:
+            self.journal_seq += 1
+            self.journal.Append(self.journal_seq, (
+                [(block, self.fat.table[block]) for block in sorted(fat_dirty)],
+                # 没进日志的块不会被淘汰, 一定还在缓存中
+                [(block, bytes(self.disk.cache[block])) for block in sorted(block_dirty)],
+                self.meta_log,
+                self.snapshots.TakeLog(),
+            ))
+            self.checkpoint_fat |= fat_dirty
+            fat_dirty.clear()
+            self.disk.Commit()
+            self.meta_log = []
+
+    # 快照操作之前先把已有的改动提交, 快照操作自成一条日志记录
+    def _commit_pending(self):
+        if self.format_pending:
+            self.Checkpoint(full=True)
+        else:
+            self._append_journal()
+
+    # 检查点: 改动写回映像, 改过的文件夹写入元数据文件, 替换存档文件, 然后清空日志
+    # 任何一步中途崩溃, 重启时重放日志都能得到同样的状态
+    # 启动之后只由SaveSystemState在锁住整卷时调用
+    def Checkpoint(self, full=False):
+        self.checkpoint_fat |= self.fat.dirty
+        self.disk.Flush()
+        # 去重卷上释放的逻辑块这时才解除映射, 物理块才能再用
+        if self.disk.dedup is not None:
+            self.disk.dedup.Reclaim(self.free_space.bitmap)
+            self.disk.dedup.WriteBack(full)
+        self.image.WriteBack(self.checkpoint_fat, full)
+        old_meta = self.meta
+        if full or self.meta is None or self.meta.NeedsCompaction():
+            self._compact_meta()
+        else:
+            self._append_meta()
+        # 刚拍下的快照指向这次提交的索引, 快照表与存档文件头一起替换
+        self.snapshots.Committed(self.meta.index_location)
+        WriteHeader(self.save_file, self.journal_seq, self.meta.generation, *self.meta.index_location,
+                    self.snapshots.Dump())
+        # 存档已指向新一代的元数据文件, 旧的可以删了
+        if old_meta is not None and old_meta is not self.meta:
+            old_meta.Remove()
+        self.dirty_dirs = set()
+        self.dead_dirs = []
+        # 格式化时换了映像: 存档已是空目录树, 这里崩溃只会在旧映像上留下无主的块
+        if self.image.path != self.image_file:
+            os.replace(self.image.path, self.image_file)
+            self.image.path = self.image_file
+        self.journal.Reset()
+        self.checkpoint_fat = set()
+        self.fat.dirty.clear()
+        self.disk.Commit()
+        self.meta_log = []
+        self.snapshots.log = []
+        self.format_pending = False
+
+    # 只把改过的文件夹追加到元数据文件; 新建的文件夹随父文件夹一起写入
+    def _append_meta(self):
+        store = self.meta
+        if not self.dirty_dirs and not self.dead_dirs:
+            return
+        for dir_id in self.dead_dirs:
+            store.Release(dir_id)
+        pending = [node for node in self.dirty_dirs if not node.removed]
+        written = set()
+        while pending:
+            node = pending.pop()
+            if node in written:
+                continue
+            written.add(node)
+            if node.dir_id is None:
+                node.dir_id = store.Allocate()
+            for child in node.DirNode:
+                if child.dir_id is None:
+                    child.dir_id = store.Allocate()
+                    pending.append(child)
+            store.Write(node.dir_id, node.Record([child.dir_id for child in node.DirNode]))
+        store.Commit()
+
+    # 把整棵树写成新一代的元数据文件, 按广度优先重新编号, 去掉垃圾与删掉的子树留下的记录
+    # 已读入的文件夹从内存中取, 其余从旧文件中读出记录, 只改子文件夹的编号
+    def _compact_meta(self):
+        old = self.meta
+        base = os.path.splitext(self.save_file)[0]
+        store = MetaStore.create(base, 0 if old is None else old.generation + 1)
+        stubs = []
+        # 队列中是(新编号, 结点, 旧编号), 结点为None表示还没有读入内存
+        queue = deque([(store.Allocate(), self.file_tree, self.file_tree.dir_id)])
+        while queue:
+            dir_id, node, old_id = queue.popleft()
+            if node is not None and node.loaded:
+                children = node.DirNode
+                child_ids = [store.Allocate() for _ in children]
+                store.Write(dir_id, node.Record(child_ids))
+                queue.extend((child_id, child, child.dir_id) for child, child_id in zip(children, child_ids))
+                node.dir_id = dir_id
+                continue
+            name, create_time, modify_time, files, dirs, *usage = old.Read(old_id)
+            child_ids = [store.Allocate() for _ in dirs]
+            store.Write(dir_id, (name, create_time, modify_time, files,
+                                 [(child_name, child_id) for (child_name, _), child_id in zip(dirs, child_ids)],
+                                 *usage))
+            queue.extend((child_id, None, old_child_id) for (_, old_child_id), child_id in zip(dirs, child_ids))
+            if node is not None:
+                stubs.append((node, dir_id))
+        # 快照的索引与记录一起复制过来, 要在最后提交的索引之前(打开时索引之后的内容会被截掉)
+        copied = {}
+        locations = [(snapshot, store.CopyIndex(old, snapshot.index_location, copied))
+                     for snapshot in self.snapshots if snapshot.index_location is not None]
+        store.Commit()
+        # 未读入的结点改指向新文件, 之后才读入
+        for node, dir_id in stubs:
+            node.dir_id = dir_id
+            node._store = store
+        for snapshot, location in locations:
+            snapshot.index_location = location
+            if snapshot.store is not None:
+                snapshot.store.Repoint(store, location)
+        self.meta = store
+
+    # 可以同时改变块数与块大小
+    # 总是换一个新的映像: 先写到临时文件, 检查点时才换掉原来的映像; 块数与块大小不变时也不在原映像上格式化,
+    # 否则检查点把新的FAT写回原映像之后, 换存档文件头之前崩溃, 重启时旧目录树会落在新的FAT上
+    # 格式化时独占整卷, 等在旧目录树上的操作拿到锁后会发现树已换掉, 抛出ValueError
+    def FormatSystem(self, block_num=None, block_size=None):
+        with self.Exclusive():
+            self._mark_removed(self.file_tree)
+            self.file_tree = FileTreeNode("User",datetime.now())
+            path = None if self.image_file is None else self.image_file + ".tmp"
+            self.image.close()
+            # 去重卷的块数指数据区的物理块数
+            self.Mount(DiskImage.create(path, block_num or self.image.data_blocks,
+                                        block_size or self.image.block_size, self.image.dedup))
+            self.checkpoint_fat = set()
+            # 格式化改动了整张FAT, 下次保存直接做完整的检查点
+            self.fat.dirty.clear()
+            self.disk.dirty.clear()
+            self.meta_log = []
+            self.dirty_dirs = set()
+            self.content_index.Clear()
+            self.snapshots.Clear()
+            self.format_pending = True
+            with self.dentry_lock:
+                self.dentry_cache.clear()
         print("finish format")
 
+    # 文件夹或文件的读写锁, 第一次用到时创建, 结点删除后随之回收
+    def NodeLock(self, node):
+        lock = self.node_locks.get(node)
+        if lock is None:
+            with self.node_locks_mutex:
+                lock = self.node_locks.get(node)
+                if lock is None:
+                    lock = self.node_locks[node] = RWLock()
+        return lock
+
+    # node(文件夹或文件)是否还挂在目录树上; 删除子树与格式化时会给其中的文件夹打上removed标记
+    @staticmethod
+    def _attached(node):
+        if isinstance(node, FCB):
+            parent = node.parent
+            if parent is None or parent.GetFile(node.file_name) is not node:
+                return False
+            node = parent
+        return not node.removed
+
+    # 没读入的文件夹的子结点不在内存中, 不会被别处引用, 不必读入
+    def _mark_removed(self, node: FileTreeNode):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            node.removed = True
+            if node.dir_id is not None:
+                self.dead_dirs.append(node.dir_id)
+            if node.loaded:
+                stack.extend(node.DirNode)
+
+    # 调用者拿着的File仍是CurDir中的那个文件; 日志与_meta_*按名字找文件, 过时的File会找到同名的别的文件
+    @staticmethod
+    def _check_file(CurDir: FileTreeNode, File: FCB):
+        if CurDir.GetFile(File.file_name) is not File:
+            raise ValueError(f"{File.file_name}: no longer exists")
+
+    # 多线程访问时的加锁规则: 先给整卷加读锁, 再锁住要操作的结点
+    # 增删, 改名文件夹中的文件锁住该文件夹写; 读写文件内容给文件夹加读锁, 文件本身加读锁或写锁
+    # 按 整卷 -> 文件夹 -> 文件 的顺序加锁, 不会死锁; 锁上之后发现结点已被删除或卷已格式化时抛出ValueError
+    # 用法: with fs.Locked(node, write): ...
+    def Locked(self, node, write=False):
+        while True:
+            parent = node.parent if isinstance(node, FCB) else None
+            locks = [self.volume_lock] + ([self.NodeLock(parent)] if parent is not None else []) + [self.NodeLock(node)]
+            for lock in locks[:-1]:
+                lock.acquire_read()
+            locks[-1].acquire(write)
+            held = HeldLocks(locks, write)
+            # 等锁期间文件被挪到了别的文件夹就重新加锁
+            if parent is None or node.parent is parent:
+                if self._attached(node):
+                    return held
+                held.release()
+                name = node.file_name if isinstance(node, FCB) else node.dir_name
+                raise ValueError(f"{name}: no longer exists")
+            held.release()
+
+    # 独占整卷: 保存, 格式化, fsck, 删除子树, 文件夹改名等会影响别的文件夹或整张FAT的操作
+    @contextmanager
+    def Exclusive(self):
+        self.volume_lock.acquire_write()
+        try:
+            yield
+        finally:
+            self.volume_lock.release_write()
+
+    # 目录相对根目录的路径, 日志中用它定位目录
+    def PathOf(self, node: FileTreeNode):
+        names = []
+        while node.parent is not None:
+            names.append(node.dir_name)
+            node = node.parent
+        return tuple(reversed(names))
+
+    def FindDir(self, path):
+        node = self.file_tree
+        for name in path:
+            node = node.GetDir(name)
+            if node is None:
+                return None
+        return node
+
+    # 按路径查找结点, 路径相对根目录, 如 "/a/b" 或 ["a", "b"]
+    # 同名的文件与文件夹并存时返回文件夹, 找不到返回None
+    def resolve(self, path):
+        if isinstance(path, str):
+            path = path.split("/")
+        with self.dentry_lock:
+            return self._resolve(tuple(name for name in path if name != ""))
+
+    def _resolve(self, path):
+        node = self.dentry_cache.get(path)
+        if node is not None:
+            self.dentry_cache.move_to_end(path)
+            return node
+        if len(path) == 0:
+            return self.file_tree
+        # 父目录多半已在缓存中, 只需再查一层
+        parent = self._resolve(path[:-1])
+        if not isinstance(parent, FileTreeNode):
+            return None
+        node = parent.GetDir(path[-1])
+        if node is None:
+            node = parent.GetFile(path[-1])
+            if node is None:
+                return None
+        self.dentry_cache[path] = node
+        if len(self.dentry_cache) > DENTRY_CACHE_SIZE:
+            self.dentry_cache.popitem(last=False)
+        return node
+
+    # 删除或改名后, 去掉该路径及其下所有缓存项
+    # 要在目录树改完之后调用, 否则别的线程可能又把旧结点查进缓存
+    def InvalidatePath(self, path):
+        with self.dentry_lock:
+            if not self.dentry_cache:
+                return
+            depth = len(path)
+            for key in [key for key in self.dentry_cache if key[:depth] == path]:
+                del self.dentry_cache[key]
+
+    # 记录一条元数据操作: (操作, 目录路径, 参数...)
+    def LogMeta(self, op, curDir: FileTreeNode, *args):
+        if self.journal is not None:
+            with self.meta_lock:
+                self.meta_log.append((op, self.PathOf(curDir)) + args)
+                self._touch(op, curDir, *args)
+
+    def ApplyMeta(self, op):
+        curDir = self.FindDir(op[1])
+        getattr(self, "_meta_" + op[0])(curDir, *op[2:])
+        self._touch(op[0], curDir, *op[2:])
+
+    # 记下检查点时要重写记录的文件夹; 文件夹的名字也记在父文件夹的记录中
+    # 改变用量的操作连带各级上级文件夹的用量一起变了; 挪动还改了目标文件夹及其上级
+    def _touch(self, op, curDir: FileTreeNode, *args):
+        self.dirty_dirs.add(curDir)
+        if op == "rename_dir" and curDir.parent is not None:
+            self.dirty_dirs.add(curDir.parent)
+        elif op in USAGE_OPS:
+            nodes = [curDir.parent]
+            if op == "move":
+                nodes.append(self.FindDir(args[2]))
+            for node in nodes:
+                while node is not None:
+                    self.dirty_dirs.add(node)
+                    node = node.parent
+
+    # 文件的(字节数, 块数)
+    def _file_usage(self, File: FCB):
+        return File.length, -(-File.stored_length // self.disk.block_size)
+
+    # 文件夹node及其各级上级的用量加上变化量; 没有用量的(旧版记录)跳过, 查询时再整棵算出
+    def _account(self, node: FileTreeNode, size, blocks, files=0):
+        if not (size or blocks or files):
+            return
+        with self.usage_lock:
+            while node is not None:
+                usage = node.usage
+                if usage is not None:
+                    usage[0] += size
+                    usage[1] += blocks
+                    usage[2] += files
+                node = node.parent
+
+    # 子树的用量, 没有的自下而上算出并记在结点上; 算出的只留在内存中, 以后有改动时随记录写入
+    # 调用者要保证期间子树不变
+    def _subtree_usage(self, node: FileTreeNode):
+        if node.usage is not None:
+            return node.usage
+        order = []
+        stack = [node]
+        while stack:
+            child = stack.pop()
+            order.append(child)
+            stack.extend(grand for grand in child.DirNode if grand.usage is None)
+        for child in reversed(order):
+            usage = [0, 0, len(child.FileNode)]
+            for File in child.FileNode:
+                size, blocks = self._file_usage(File)
+                usage[0] += size
+                usage[1] += blocks
+            for grand in child.DirNode:
+                usage[0] += grand.usage[0]
+                usage[1] += grand.usage[1]
+                usage[2] += grand.usage[2]
+            child.usage = usage
+        return node.usage
+
+    # 以下只改目录树, 正常操作与日志重放共用
+    def _meta_mkdir(self, curDir: FileTreeNode, name, time):
+        child = FileTreeNode(name, time, curDir)
+        # 挂上目录树之前登记, 挂上之后别的线程就可能在其中建文件
+        self.content_index.DirCreated(child)
+        curDir.AddDir(child)
+        curDir.modify_time = time
+        # 新文件夹会遮住缓存里的同名文件
+        if self.dentry_cache:
+            with self.dentry_lock:
+                self.dentry_cache.pop(self.PathOf(curDir) + (name,), None)
+        return child
+
+    def _meta_create(self, curDir: FileTreeNode, name, time, codec=None):
+        File = FCB(name, time, 0, curDir)
+        if codec is not None:
+            File.extents = ExtentIndex(codec)
+        curDir.AddFile(File)
+        curDir.modify_time = time
+        self._account(curDir, 0, 0, 1)
+        self.content_index.Changed(File)
+        return File
+
+    def _meta_attr(self, curDir: FileTreeNode, name, start_address, length, time, extents=None):
+        File = curDir.GetFile(name)
+        size, blocks = self._file_usage(File)
+        File.start_address = start_address
+        File.length = length
+        File.extents = extents
+        File.modify_time = time
+        new_size, new_blocks = self._file_usage(File)
+        self._account(curDir, new_size - size, new_blocks - blocks)
+        self.content_index.Changed(File)
+
+    def _meta_unlink(self, curDir: FileTreeNode, name, time):
+        File = curDir.GetFile(name)
+        curDir.RemoveFile(File)
+        size, blocks = self._file_usage(File)
+        self._account(curDir, -size, -blocks, -1)
+        self.content_index.Removed([File])
+        curDir.modify_time = time
+        self.InvalidatePath(self.PathOf(curDir) + (name,))
+
+    def _meta_rmdir(self, curDir: FileTreeNode, name, time):
+        child = curDir.GetDir(name)
+        size, blocks, files = self._subtree_usage(child)
+        curDir.RemoveDir(child)
+        self._account(curDir, -size, -blocks, -files)
+        self._mark_removed(child)
+        self.InvalidatePath(self.PathOf(curDir) + (name,))
+
+    def _meta_rename_file(self, curDir: FileTreeNode, name, new_name, time):
+        File = curDir.GetFile(name)
+        curDir.RenameFileEntry(File, new_name)
+        File.modify_time = time
+        curDir.modify_time = time
+        self.InvalidatePath(self.PathOf(curDir) + (name,))
+
+    def _meta_rename_dir(self, curDir: FileTreeNode, new_name, time):
+        path = self.PathOf(curDir)
+        if curDir.parent is None:
+            curDir.dir_name = new_name
+        else:
+            curDir.parent.RenameDirEntry(curDir, new_name)
+        curDir.modify_time = time
+        self.InvalidatePath(path)
+        with self.dentry_lock:
+            self.dentry_cache.pop(path[:-1] + (new_name,), None)
+
+    # 把curDir中的name(is_file区分文件与文件夹)挂到路径为dst_path的文件夹下, 改名为new_name
+    # 结点本身连同子树原样搬过去, 数据块不动
+    def _meta_move(self, curDir: FileTreeNode, name, is_file, dst_path, new_name, time):
+        dstDir = self.FindDir(dst_path)
+        if is_file:
+            node = curDir.GetFile(name)
+            size, blocks = self._file_usage(node)
+            files = 1
+            curDir.RemoveFile(node)
+            node.file_name = sys.intern(new_name)
+            node.parent = dstDir
+            dstDir.AddFile(node)
+            self.content_index.Moved(node)
+        else:
+            node = curDir.GetDir(name)
+            size, blocks, files = self._subtree_usage(node)
+            curDir.RemoveDir(node)
+            node.dir_name = sys.intern(new_name)
+            node.parent = dstDir
+            dstDir.AddDir(node)
+            self.content_index.DirMoved(node)
+        self._account(curDir, -size, -blocks, -files)
+        self._account(dstDir, size, blocks, files)
+        curDir.modify_time = time
+        dstDir.modify_time = time
+        self.InvalidatePath(self.PathOf(curDir) + (name,))
+        # 挪过来的结点可能遮住缓存里目标处的同名文件
+        with self.dentry_lock:
+            self.dentry_cache.pop(dst_path + (new_name,), None)
+        return node
+
+    # 创建成功返回新结点, 重名返回False
     def createDir(self, curDir: FileTreeNode, Dirname, Curtime):
-        for file in curDir.DirNode:
-            if file.dir_name == Dirname:
+        with self.Locked(curDir, write=True):
+            if curDir.GetDir(Dirname) is not None:
                 print("name exist")
                 return False
-        curDir.DirNode.append(FileTreeNode(Dirname,Curtime,curDir))
-        curDir.modify_time = Curtime
-        return True
+            # 先记日志: 新结点一出现别的线程就可能在其中操作, 它们的日志要排在后面
+            self.LogMeta("mkdir", curDir, Dirname, Curtime)
+            return self._meta_mkdir(curDir, Dirname, Curtime)
 
+    # 同名的文件或文件夹已存在时返回False: 按路径查找时文件夹优先, 与文件夹同名的文件无法按路径找到
     def createFile(self, curDir: FileTreeNode, Filename, Curtime):
-        for file in curDir.FileNode:
-            if file.file_name == Filename:
+        with self.Locked(curDir, write=True):
+            if curDir.GetFile(Filename) is not None or curDir.GetDir(Filename) is not None:
                 print("File exist")
                 return False
 
-        curDir.modify_time = Curtime
-        curDir.FileNode.append(FCB(Filename, Curtime, 0,curDir))
+            self.LogMeta("create", curDir, Filename, Curtime, self.compression)
+            return self._meta_create(curDir, Filename, Curtime, self.compression)
 
+    # 覆盖写: 复用原有的FAT链, 只改动内容变化的块, 多退少补
+    # data为str时按utf-8编码, 长度与偏移都以字节计
     def WriteFile(self, File: FCB, data):
-        File.modify_time = datetime.now()
-        File_Pointer = -1
-
-        # 将data逐元素读入
-        while data !="":
-            # 找到第一个空的块
-            next_point = self.find_free_index()
-            if next_point == -1:
-                # 满了
+        with self.Locked(File, write=True):
+            File.modify_time = datetime.now()
+            self._write_file(File, 0, self._encode(data), truncate=True)
+
+    # 从offset处写入data, offset不能超过文件末尾; truncate时写完截断到offset+len(data), 与写入是同一次操作
+    def WriteAt(self, File: FCB, offset, data, truncate=False):
+        with self.Locked(File, write=True):
+            if offset < 0 or offset > File.length:
+                raise ValueError("write offset out of range")
+            File.modify_time = datetime.now()
+            self._write_file(File, offset, self._encode(data), truncate=truncate)
+
+    # 文件长度在锁内读取, 并发的追加不会互相覆盖
+    def AppendFile(self, File: FCB, data):
+        with self.Locked(File, write=True):
+            File.modify_time = datetime.now()
+            self._write_file(File, File.length, self._encode(data), truncate=False)
+
+    # 截断到length, 多出的块归还
+    def TruncateFile(self, File: FCB, length):
+        with self.Locked(File, write=True):
+            if length < 0 or length > File.length:
+                raise ValueError("truncate length out of range")
+            File.modify_time = datetime.now()
+            self._write_file(File, length, b"", truncate=True)
+
+    # 改变文件的压缩方式: 按codec(zlib或lzma)压缩, codec为None时解压成普通文件
+    def SetCompression(self, File: FCB, codec):
+        with self.Locked(File, write=True):
+            index = None if codec is None else ExtentIndex(codec)
+            data = self.OpenFile(File).read()
+            if index is not None:
+                packed = [index.Encode(data[i:i + EXTENT_SIZE]) for i in range(0, len(data), EXTENT_SIZE)]
+                index = index.Replace(0, packed, 0, len(data))
+                data = b"".join(packed)
+            self._write_range(File, 0, data, truncate=True, extent_index=index)
+
+    @staticmethod
+    def _encode(data):
+        if isinstance(data, str):
+            return data.encode("utf-8")
+        return data
+
+    def _write_file(self, File: FCB, offset, data, truncate):
+        if File.extents is None:
+            self._write_range(File, offset, data, truncate)
+        else:
+            self._write_extents(File, offset, data, truncate)
+
+    # 压缩文件: 重新压缩涉及的段, 从第一个改动的段起写入FAT链, 段长变了时后面的段原样后移
+    def _write_extents(self, File: FCB, offset, data, truncate):
+        index = File.extents
+        end = offset + len(data)
+        length = end if truncate else max(index.length, end)
+        # 涉及的段[first, keep), 截断时一直到末尾
+        first = offset // EXTENT_SIZE
+        keep = len(index) if truncate else max(min(-(-end // EXTENT_SIZE), len(index)), first)
+        old = self._read_extents(File, first, keep)
+        base = first * EXTENT_SIZE
+        content = old[:offset - base] + data
+        if not truncate:
+            content += old[end - base:]
+        packed = [index.Encode(content[i:i + EXTENT_SIZE]) for i in range(0, len(content), EXTENT_SIZE)]
+        new_index = index.Replace(first, packed, keep, length)
+        start = index.ends[first - 1] if first else 0
+        stored = b"".join(packed)
+        tail = index.ends[keep - 1] if keep else 0
+        if keep == len(index):
+            self._write_range(File, start, stored, truncate=True, extent_index=new_index)
+        elif start + len(stored) == tail:
+            self._write_range(File, start, stored, truncate=False, extent_index=new_index)
+        else:
+            rest = self._read_stored(File, tail, index.stored)
+            self._write_range(File, start, stored + rest, truncate=True, extent_index=new_index)
+
+    # 解压第first到keep段(不含)
+    def _read_extents(self, File: FCB, first, keep):
+        index = File.extents
+        if first >= keep:
+            return b""
+        start = index.Span(first)[0]
+        stored = self._read_stored(File, start, index.ends[keep - 1])
+        return b"".join(index.Decode(i, stored[index.Span(i)[0] - start:index.ends[i] - start])
+                        for i in range(first, keep))
+
+    # FAT链中[start, end)的内容
+    def _read_stored(self, File: FCB, start, end):
+        reader = FileReader(self, File)
+        reader.seek(start)
+        return reader.read(end - start)
+
+    # 按字节写入FAT链, 压缩文件写的是压缩后的内容, extent_index是写入之后的段索引
+    def _write_range(self, File: FCB, offset, data, truncate, extent_index=None):
+        block_size = self.disk.block_size
+        stored_length = File.stored_length
+        old_usage = self._file_usage(File)
+        end = offset + len(data)
+        new_length = end if truncate else max(stored_length, end)
+        block_count = -(-new_length // block_size)
+        # 变长时先把多出来的块分配好, 空间不足就什么都不写, 避免写到一半失败
+        # 有快照时要改写的块中被快照引用的要复制到新块, 也一起分配
+        grow = max(block_count - -(-stored_length // block_size), 0)
+        cow = self._shared_blocks(File, offset, end) if self.snapshots else 0
+        new_blocks = []
+        spare = []
+        if grow + cow > 0:
+            with self.alloc_lock:
+                extents = self.free_space.Allocate(grow + cow)
+            if extents is None:
+                print("no more free space")
+                raise AssertionError("no more space")
+            blocks = [block for start, length in extents for block in range(start, start + length)]
+            new_blocks = blocks[:grow]
+            spare = blocks[grow:]
+        # 去重卷上还要为写入的块预留物理块: 新块全要写, 已有的块只写[offset, end)中的
+        reserved = 0
+        if self.disk.dedup is not None:
+            old_count = -(-stored_length // block_size)
+            reserved = grow + max(min(-(-end // block_size), old_count) - offset // block_size, 0) if data else grow
+            if reserved and not self.disk.Reserve(reserved):
+                with self.alloc_lock:
+                    for block in new_blocks + spare:
+                        self.free_space.Free(block, 1)
                 print("no more free space")
                 raise AssertionError("no more space")
-            if File_Pointer == -1:
-                # 第一个块的位置
-                File.start_address = next_point
-            else:
-                self.fat.table[File_Pointer] = next_point
 
-            self.disk.list[next_point] = data[:BLOCK_SIZE]
-            data = data[BLOCK_SIZE:]
-            self.free_space.bitmap[next_point] = SPACE_OCCUPY
+        # 沿FAT链跳到offset所在的块
+        prev = None
+        pointer = FAT_END if File.start_address is None else File.start_address
+        index = 0
+        while index < offset // block_size and pointer != FAT_END:
+            prev = pointer
+            pointer = self.fat.table[pointer]
+            index += 1
 
-            File_Pointer = next_point
-            self.fat.table[File_Pointer] = FAT_END
-            File.length += BLOCK_SIZE
+        # 覆盖已有的块, 内容不变的块不写
+        while index < block_count and pointer != FAT_END:
+            block_start = index * block_size
+            if block_start >= end and not truncate:
+                break
+            lo = max(offset, block_start) - block_start
+            hi = min(end, block_start + block_size) - block_start
+            if lo < hi:
+                part = data[block_start + lo - offset:block_start + hi - offset]
+                if self.disk.read(pointer, hi - lo, lo) != part:
+                    if self.snapshots.Shared(pointer):
+                        pointer = self._copy_block(File, prev, pointer, spare.pop(), lo, part)
+                    else:
+                        self.disk.write(pointer, part, lo)
+            prev = pointer
+            pointer = self.fat.table[pointer]
+            index += 1
 
+        if index == block_count and pointer != FAT_END and truncate:
+            # 变短了, 归还剩余的块
+            with self.alloc_lock:
+                if prev is None:
+                    File.start_address = None
+                else:
+                    self.fat.Set(prev, FAT_END)
+                self.FreeChain(pointer)
+        elif new_blocks:
+            # 变长了, 把预先分配的块接到链尾再写入
+            with self.alloc_lock:
+                for block in new_blocks:
+                    if prev is None:
+                        File.start_address = block
+                    else:
+                        self.fat.Set(prev, block)
+                    prev = block
+                self.fat.Set(prev, FAT_END)
+            for block in new_blocks:
+                block_start = index * block_size
+                self.disk.write(block, data[block_start - offset:min(block_start + block_size, new_length) - offset],
+                                new=True)
+                index += 1
+        # 内容没变的块不必复制, 多分配的退回
+        if spare:
+            with self.alloc_lock:
+                for block in spare:
+                    self.free_space.Free(block, 1)
+        if reserved:
+            self.disk.Unreserve(reserved)
+        File.extents = extent_index
+        File.length = new_length if extent_index is None else extent_index.length
+        new_size, new_blocks = self._file_usage(File)
+        self._account(File.parent, new_size - old_usage[0], new_blocks - old_usage[1])
+        self.LogMeta("attr", File.parent, File.file_name, File.start_address, File.length, File.modify_time,
+                     File.extents)
+        self.content_index.Changed(File)
 
-    def DeleteFile(self,CurDir: FileTreeNode,File:FCB):
-        # 删去记录
-        CurDir.modify_time = datetime.now()
-        CurDir.FileNode.remove(File)
-        pointer = File.start_address
-        if pointer is None:
-            return False
-        # 在位图中将相关的记录都删掉
-        while self.fat.table[pointer] != FAT_END:
-            self.free_space.bitmap[pointer]=SPACE_FREE
+    # [offset, end)中已有的, 被快照引用的块数, 即写入时最多要复制的块数
+    def _shared_blocks(self, File: FCB, offset, end):
+        block_size = self.disk.block_size
+        last = min(-(-end // block_size), -(-File.stored_length // block_size))
+        count = 0
+        index = 0
+        pointer = FAT_END if File.start_address is None else File.start_address
+        while index < last and pointer != FAT_END:
+            if index >= offset // block_size and self.snapshots.Shared(pointer):
+                count += 1
             pointer = self.fat.table[pointer]
-        self.free_space.bitmap[pointer] = SPACE_FREE
-        return True
+            index += 1
+        return count
+
+    # 写时复制: 块pointer被快照引用, 把改过的内容写到新块block, 链中换成新块, 返回新块
+    # 原来的块在FAT中释放, 由快照继续占用
+    def _copy_block(self, File: FCB, prev, pointer, block, offset, part):
+        content = bytearray(self.disk.read(pointer, self.disk.block_size))
+        content[offset:offset + len(part)] = part
+        self.disk.write(block, content, new=True)
+        with self.alloc_lock:
+            self.fat.Set(block, self.fat.table[pointer])
+            if prev is None:
+                File.start_address = block
+            else:
+                self.fat.Set(prev, block)
+            self.fat.Set(pointer, FAT_FREE)
+        return block
+
+    # 释放从pointer开始的整条FAT链, 连续的块合并成区间一起释放
+    # 被快照引用的块只在FAT中释放, bitmap中仍占用
+    def FreeChain(self, pointer):
+        with self.alloc_lock:
+            run_start = pointer
+            run_length = 0
+            while pointer != FAT_END:
+                next_pointer = self.fat.table[pointer]
+                shared = self.snapshots.Shared(pointer)
+                self.fat.Set(pointer, FAT_FREE)
+                if shared:
+                    pass
+                elif pointer == run_start + run_length:
+                    run_length += 1
+                else:
+                    if run_length > 0:
+                        self.free_space.Free(run_start, run_length)
+                    run_start = pointer
+                    run_length = 1
+                pointer = next_pointer
+            if run_length > 0:
+                self.free_space.Free(run_start, run_length)
+
+    # File已被删除(或CurDir中的同名文件已换成别的)时抛出ValueError, 不能按名字删掉别的文件, 也不能再释放它原来的块
+    def DeleteFile(self,CurDir: FileTreeNode,File:FCB):
+        with self.Locked(CurDir, write=True):
+            self._check_file(CurDir, File)
+            # 删去记录
+            Curtime = datetime.now()
+            self._meta_unlink(CurDir, File.file_name, Curtime)
+            self.LogMeta("unlink", CurDir, File.file_name, Curtime)
+            pointer = File.start_address
+            if pointer is None:
+                return False
+            # 在位图中将相关的记录都删掉
+            self.FreeChain(pointer)
+            return True
 
-    # 为递归清空文件夹提供函数
+    # 整棵子树一次删除: 先收集子树中所有文件的块, 再按区间批量改FAT和bitmap
+    # 子树直接从父目录摘下, 其中的文件不再逐个删除
+    # 被快照引用的块只在FAT中逐个释放, 不归还
+    # 调用者要独占整卷(见deleteDir)
     def ClearDir(self,CurDir:FileTreeNode, DeleteDir:FileTreeNode):
-        # 清空当前目录下的文件
-        for file in DeleteDir.FileNode:
-            self.DeleteFile(DeleteDir,file)
-        # 递归清空当前目录下的子目录
-        while len(DeleteDir.DirNode) >0:
-            ChildDir = DeleteDir.DirNode[0]
-            self.ClearDir(DeleteDir,ChildDir)
-        CurDir.DirNode.remove(DeleteDir)
+        table = self.fat.table
+        freed = zeros(len(self.free_space.bitmap), endian="little")
+        kept = []
+        shared = self.snapshots.Shared if self.snapshots else None
+        # 反正要走遍整棵子树, 顺便数出用量
+        size = blocks = files = 0
+        stack = [DeleteDir]
+        while stack:
+            node = stack.pop()
+            node.removed = True
+            if node.dir_id is not None:
+                self.dead_dirs.append(node.dir_id)
+            stack.extend(node.DirNode)
+            self.content_index.Removed(node.FileNode)
+            files += len(node.FileNode)
+            for File in node.FileNode:
+                file_size, file_blocks = self._file_usage(File)
+                size += file_size
+                blocks += file_blocks
+                pointer = File.start_address
+                while pointer is not None and pointer != FAT_END:
+                    if shared is not None and shared(pointer):
+                        kept.append(pointer)
+                    else:
+                        freed[pointer] = 1
+                    pointer = table[pointer]
+        CurDir.RemoveDir(DeleteDir)
+        self._account(CurDir, -size, -blocks, -files)
+        runs = _mask_runs(freed)
+        with self.alloc_lock:
+            for block in kept:
+                self.fat.Set(block, FAT_FREE)
+            for start, end in runs:
+                self.fat.Fill(start, end, FAT_FREE)
+            self.free_space.FreeMask(freed, runs)
+    # 文件夹已被删除时抛出ValueError, 子树中的块可能已分给了别的文件
     def deleteDir(self, DeleteDir:FileTreeNode):
-        pointer = DeleteDir.parent
-        self.ClearDir(pointer,DeleteDir)
+        with self.Exclusive():
+            pointer = DeleteDir.parent
+            if pointer is None or not self._attached(DeleteDir):
+                raise ValueError(f"{DeleteDir.dir_name}: no longer exists")
+            path = self.PathOf(DeleteDir)
+            self.ClearDir(pointer,DeleteDir)
+            self.InvalidatePath(path)
+            self.LogMeta("rmdir", pointer, DeleteDir.dir_name, datetime.now())
+
+    # node(默认根目录)之下内容含有pattern的文件, 按路径排序; pattern为str时按utf-8编码
+    # 用三元组索引找出候选文件, 再读出核对, 不必读遍所有文件
+    def SearchContent(self, pattern, node: FileTreeNode = None):
+        if node is None:
+            node = self.file_tree
+        files = self.content_index.Search(self._encode(pattern), node)
+        return sorted(files, key=lambda File: (self.PathOf(File.parent), File.file_name))
+
+    # 多线程时读的过程中要持有 Locked(File)
+    def OpenFile(self, File: FCB):
+        if File.extents is not None:
+            return CompressedReader(self, File)
+        return FileReader(self, File)
+
+    def ReadAt(self, File: FCB, offset, size=-1):
+        with self.Locked(File):
+            reader = self.OpenFile(File)
+            reader.seek(offset)
+            return reader.read(size)
+
+    # 逐块收集后只拼接一次, 解码为文本
+    def read_all(self, File: FCB):
+        with self.Locked(File):
+            data = b"".join(self.OpenFile(File).chunks())
+        return data.decode("utf-8", errors="replace")
 
     def ReadFile(self,File:FCB):
-        pointer = File.start_address
-        if pointer is None:
-            AssertionError("Open File which start addr is none")
-        data = ""
-        while pointer != FAT_END:
-            data += self.disk.list[pointer]
-            pointer=self.fat.table[pointer]
-        return data
+        return self.read_all(File)
 
     def RenameFile(self,File:FCB, NewName:str, CurDir:FileTreeNode):
-        File.file_name = NewName
-        File.modify_time=datetime.now()
-        CurDir.modify_time=datetime.now()
+        with self.Locked(CurDir, write=True):
+            self._check_file(CurDir, File)
+            Curtime = datetime.now()
+            self.LogMeta("rename_file", CurDir, File.file_name, NewName, Curtime)
+            self._meta_rename_file(CurDir, File.file_name, NewName, Curtime)
 
+    # 子树中所有结点的路径都变了, 独占整卷
     def RenameDir(self, NewName:str, CurDir:FileTreeNode):
-        CurDir.modify_time = datetime.now()
-        CurDir.dir_name = NewName
\ No newline at end of file
+        with self.Exclusive():
+            Curtime = datetime.now()
+            self.LogMeta("rename_dir", CurDir, NewName, Curtime)
+            self._meta_rename_dir(CurDir, NewName, Curtime)
+
+    # 把文件或文件夹(连同整棵子树)挪到dstDir下, new_name不为None时同时改名; 只改目录树, 不读写数据块
+    # 目标文件夹中已有同名的文件或文件夹时返回False; 挪动根目录或把文件夹挪进自己的子树抛出ValueError
+    # 涉及两个文件夹且子树中的路径都变了, 独占整卷; 日志中是一条操作, 重放时整体生效
+    def Move(self, node, dstDir: FileTreeNode, new_name=None):
+        with self.Exclusive():
+            is_file = isinstance(node, FCB)
+            name = node.file_name if is_file else node.dir_name
+            if new_name is None:
+                new_name = name
+            curDir = node.parent
+            if curDir is None:
+                raise ValueError("cannot move the root directory")
+            if not self._attached(node) or not self._attached(dstDir):
+                raise ValueError(f"{name}: no longer exists")
+            if not is_file:
+                ancestor = dstDir
+                while ancestor is not None:
+                    if ancestor is node:
+                        raise ValueError(f"{name}: cannot move a directory into itself")
+                    ancestor = ancestor.parent
+            if dstDir is curDir and new_name == name:
+                return True
+            if dstDir.GetFile(new_name) is not None or dstDir.GetDir(new_name) is not None:
+                print("name exist")
+                return False
+            Curtime = datetime.now()
+            dst_path = self.PathOf(dstDir)
+            self.LogMeta("move", curDir, name, is_file, dst_path, new_name, Curtime)
+            self._meta_move(curDir, name, is_file, dst_path, new_name, Curtime)
+            return True
+
+    # 按路径挪动, dst_dir是目标文件夹的路径或结点, 见Move
+    def MovePath(self, src_path, dst_dir, new_name=None):
+        node = self.resolve(src_path)
+        if node is None:
+            raise ValueError(f"{src_path}: no such file or directory")
+        if not isinstance(dst_dir, FileTreeNode):
+            dst_dir = self.resolve(dst_dir)
+            if not isinstance(dst_dir, FileTreeNode):
+                raise ValueError("destination is not a directory")
+        return self.Move(node, dst_dir, new_name)
+
+    # 快照: 整卷在某一时刻的只读副本, 可以挂载读取(MountSnapshot)或把整卷回滚过去; 只有落盘的卷才有
+    # 拍快照只在快照表末尾加一项并做一次检查点, 花费只与上次检查点以来的改动有关, 与卷的大小无关
+    # 之后被改写的块写时复制(见_copy_block), 被释放的块由快照继续占用, 快照占的空间与之后的改动量成正比
+    # 删除与回滚各是一条日志记录, 随即做检查点
+    def CreateSnapshot(self, name):
+        with self.Exclusive():
+            if self.journal is None:
+                raise ValueError("snapshots need a volume saved to a file")
+            if self.snapshots.Find(name) is not None:
+                raise ValueError(f"snapshot {name} already exists")
+            self._commit_pending()
+            self.snapshots.Add(Snapshot(name, to_stamp(datetime.now())))
+            self.Checkpoint()
+
+    # [(名字, 拍下的时间, 只由它占着的块数), ...], 按拍下的先后
+    def ListSnapshots(self):
+        with self.Exclusive():
+            return [(snapshot.name, from_stamp(snapshot.created), len(snapshot.dead)) for snapshot in self.snapshots]
+
+    def DeleteSnapshot(self, name):
+        with self.Exclusive():
+            self._find_snapshot(name)
+            self._commit_pending()
+            self.LogMeta("snapshot_delete", self.file_tree, name)
+            self._meta_snapshot_delete(self.file_tree, name)
+            self._append_journal()
+            self.Checkpoint()
+
+    # 整卷回到拍下快照时的状态, 之后拍的快照一并删除, 这个快照保留
+    # 原来的目录树作废, 与格式化一样, 等在旧结点上的操作会抛出ValueError
+    def RollbackSnapshot(self, name):
+        with self.Exclusive():
+            self._find_snapshot(name)
+            self._commit_pending()
+            self.LogMeta("snapshot_rollback", self.file_tree, name)
+            self._meta_snapshot_rollback(self.file_tree, name)
+            self._append_journal()
+            self.Checkpoint()
+
+    # 只读挂载, 返回SnapshotVolume
+    def MountSnapshot(self, name):
+        with self.Exclusive():
+            snapshot = self._find_snapshot(name)
+            if snapshot.store is None:
+                snapshot.store = self.meta.View(snapshot.index_location)
+            return SnapshotVolume(self, snapshot)
+
+    def _find_snapshot(self, name):
+        snapshot = self.snapshots.Find(name)
+        if snapshot is None:
+            raise ValueError(f"snapshot {name} does not exist")
+        return snapshot
+
+    def _meta_snapshot_delete(self, curDir: FileTreeNode, name):
+        self._drop_snapshot(self.snapshots.Find(name))
+
+    # 删掉快照, 只由它占着的块归还
+    def _drop_snapshot(self, snapshot: Snapshot):
+        freed = self.snapshots.Remove(snapshot)
+        if not freed:
+            return
+        mask = zeros(len(self.free_space.bitmap), endian="little")
+        for block in freed:
+            mask[block] = 1
+        with self.alloc_lock:
+            self.free_space.FreeMask(mask, _mask_runs(mask))
+        # bitmap的改动随对应的FAT项一起进日志与检查点
+        self.fat.dirty.update(freed)
+
+    # FAT改回拍下时的值, 之后分配的块归还, 目录树换成快照的索引指向的那棵
+    def _meta_snapshot_rollback(self, curDir: FileTreeNode, name):
+        snapshot = self.snapshots.Find(name)
+        while self.snapshots.snapshots[-1] is not snapshot:
+            self._drop_snapshot(self.snapshots.snapshots[-1])
+        restored, fresh = self.snapshots.Restore(snapshot)
+        table = self.fat.table
+        bitmap = self.free_space.bitmap
+        with self.alloc_lock:
+            for block, value in restored.items():
+                table[block] = value
+            for block in fresh:
+                table[block] = FAT_FREE
+                bitmap[block] = SPACE_FREE
+            self.fat.dirty.update(restored)
+            self.fat.dirty.update(fresh)
+            self.free_space.RebuildExtents()
+        self._mark_removed(self.file_tree)
+        self.dirty_dirs = set()
+        self.dead_dirs = []
+        self.meta.ResetIndex(self.meta.ReadIndex(snapshot.index_location))
+        self.meta.Commit()
+        self.file_tree = FileTreeNode.Stub(None, None, ROOT_ID, self.meta)
+        self.file_tree._load()
+        self.content_index.Clear()
+        with self.dentry_lock:
+            self.dentry_cache.clear()
+
+    # 文件占用的连续区间 [(起点, 长度), ...], 按链的顺序
+    def Extents(self, File: FCB):
+        extents = []
+        pointer = FAT_END if File.start_address is None else File.start_address
+        while pointer != FAT_END:
+            if extents and extents[-1][0] + extents[-1][1] == pointer:
+                extents[-1][1] += 1
+            else:
+                extents.append([pointer, 1])
+            pointer = self.fat.table[pointer]
+        return [tuple(extent) for extent in extents]
+
+    # 碎片程度: 平均每个文件分成几段连续区间
+    # 每条链的段数是1加上链中不指向下一个相邻块的项数, 整张FAT一次数出来(假定没有无主的块)
+    def Fragmentation(self):
+        with self.Exclusive():
+            files = 0
+            stack = [self.file_tree]
+            while stack:
+                node = stack.pop()
+                stack.extend(node.DirNode)
+                files += sum(1 for File in node.FileNode if File.start_address is not None)
+            if files == 0:
+                return 0.0
+            fat = np.asarray(self.fat.table)
+            breaks = np.count_nonzero((fat >= 0) & (fat != np.arange(1, len(fat) + 1, dtype=fat.dtype)))
+            return (files + breaks) / files
+
+    # 文件或文件夹(整棵子树)的用量: (字节数, 块数, 文件数), 文件夹的用量随改动逐级维护, 查询不必遍历
+    # 旧版记录中没有用量的文件夹第一次查询时独占整卷算一遍
+    def DiskUsage(self, node):
+        with self.Locked(node):
+            if isinstance(node, FCB):
+                return self._file_usage(node) + (1,)
+            usage = node.usage
+            if usage is not None:
+                with self.usage_lock:
+                    return tuple(usage)
+        with self.Exclusive():
+            return tuple(self._subtree_usage(node))
+
+    # 整卷的空间, 已用块数直接数bitmap中的1(popcount)
+    def DiskFree(self):
+        bitmap = self.free_space.bitmap
+        used = bitmap.count(SPACE_OCCUPY)
+        return {
+            "blocks": len(bitmap),
+            "used": used,
+            "free": len(bitmap) - used,
+            "snapshot_held": len(self.snapshots.held),
+            "block_size": self.disk.block_size,
+        }
+
+    # 用指针倍增求出每个块沿FAT链走到链尾的情况, 每轮都是整张表的数组运算
+    # 返回 (FAT, 合法项, 已用块, 链长, 成环, 链上有交汇点, 链上有指向空闲/非法项的块, 能从链头走到)
+    def _scan_chains(self, heads):
+        block_num = self.image.block_num
+        fat = np.asarray(self.fat.table)
+        valid = (fat == FAT_FREE) | (fat == FAT_END) | ((fat >= 0) & (fat < block_num))
+        used = fat != FAT_FREE
+        nxt = np.where(valid & (fat >= 0), fat, block_num).astype(np.int32)
+        # 指向空闲块或非法值的项
+        broken = used & (~valid | ((nxt < block_num) & ~used[np.minimum(nxt, block_num - 1)]))
+        nxt[broken] = block_num
+        # 文件的链头也算一条入边, 两个文件指向同一块或链头被别的链指向都会被当成交汇
+        ok = (heads >= 0) & (heads < block_num)
+        indegree = np.bincount(np.concatenate([nxt[used], heads[ok]]), minlength=block_num + 1)[:block_num]
+
+        # 下标block_num是链尾之后的哨兵
+        jump = np.append(nxt, block_num)
+        length = np.append(used, False).astype(np.int32)
+        merged = np.append(indegree > 1, False)
+        bad = np.append(broken, False)
+        # 从文件链头出发能走到的块: 第k轮后包含距链头不到2**k步的所有块
+        reachable = np.zeros(block_num + 1, dtype=bool)
+        reachable[heads[ok]] = True
+        for _ in range(max(1, int(block_num).bit_length())):
+            reachable[jump[reachable]] = True
+            length += length[jump]
+            # 成环的链长度会一直翻倍, 截住以免溢出
+            np.minimum(length, block_num + 1, out=length)
+            merged |= merged[jump]
+            bad |= bad[jump]
+            jump = jump[jump]
+        cyclic = jump[:block_num] != block_num
+        reachable = reachable[:block_num] & used
+        return fat, valid, used, length[:block_num], cyclic, merged[:block_num], bad[:block_num], reachable
+
+    # 一致性检查: 核对目录树中的文件, FAT与bitmap, FAT链用数组运算整体求出
+    # repair时修复: 有问题的文件截断到出问题之前的块, 无主的块释放, bitmap按FAT重写
+    # 返回发现的问题列表, 没有问题时为空; 检查期间独占整卷
+    def Fsck(self, repair=False):
+        with self.Exclusive():
+            return self._fsck(repair)
+
+    def _fsck(self, repair):
+        block_num = self.image.block_num
+        block_size = self.disk.block_size
+        files = []
+        names = []
+        stack = [self.file_tree]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.DirNode)
+            path = "/".join(self.PathOf(node))
+            for File in node.FileNode:
+                files.append(File)
+                names.append(f"/{path}/{File.file_name}" if path else "/" + File.file_name)
+        heads = np.array([-1 if F.start_address is None else F.start_address for F in files], dtype=np.int64)
+        expected = -(-np.array([F.stored_length for F in files], dtype=np.int64) // block_size)
+        fat, valid, used, length, cyclic, merged, bad, reachable = self._scan_chains(heads)
+
+        report = []
+        in_range = (heads >= 0) & (heads < block_num)
+        safe = np.where(in_range, heads, 0)
+        for i in np.flatnonzero((heads != -1) & ~in_range):
+            report.append(("range", f"{names[i]}: start block {heads[i]} out of range"))
+        for i in np.flatnonzero(in_range & ~used[safe]):
+            report.append(("free", f"{names[i]}: start block {heads[i]} is free"))
+        for i in np.flatnonzero(in_range & used[safe] & cyclic[safe]):
+            report.append(("cycle", f"{names[i]}: FAT chain loops"))
+        for i in np.flatnonzero(in_range & used[safe] & merged[safe]):
+            report.append(("cross", f"{names[i]}: chain is cross-linked with another chain"))
+        for i in np.flatnonzero(in_range & used[safe] & bad[safe]):
+            report.append(("broken", f"{names[i]}: chain runs into a free or invalid FAT entry"))
+        count = np.where(in_range & used[safe] & ~cyclic[safe], length[safe], 0)
+        for i in np.flatnonzero((count != expected) & ~(in_range & cyclic[safe])):
+            report.append(("length", f"{names[i]}: {count[i]} blocks for length {files[i].stored_length}, expected {expected[i]}"))
+        damaged = sorted({int(i) for i in np.flatnonzero(
+            (heads != -1) & ~in_range | in_range & (~used[safe] | cyclic[safe] | merged[safe] | bad[safe])
+            | (count != expected))})
+
+        leaked = np.flatnonzero(used & ~reachable)
+        for block in leaked:
+            report.append(("leak", f"block {block} allocated but not referenced"))
+        for block in np.flatnonzero(~valid):
+            report.append(("invalid", f"block {block} has invalid FAT entry {fat[block]}"))
+        bitmap = np.unpackbits(np.frombuffer(self.free_space.bitmap, dtype=np.uint8),
+                               bitorder="little")[:block_num].astype(bool)
+        for block in np.flatnonzero(used & ~bitmap):
+            report.append(("bitmap", f"block {block} has a FAT entry but is free in bitmap"))
+        # 快照占着的块FAT项是空闲的, bitmap中要是占用
+        held = self._held_mask()
+        for block in np.flatnonzero(~used & bitmap & ~held):
+            report.append(("bitmap", f"block {block} is marked used in bitmap but has no FAT entry"))
+        for block in np.flatnonzero(held & ~bitmap):
+            report.append(("bitmap", f"block {block} is held by a snapshot but free in bitmap"))
+        for block in np.flatnonzero(held & used):
+            report.append(("snapshot", f"block {block} is held by a snapshot but also in use"))
+        if self.free_space.free_count != int(np.count_nonzero(~bitmap)):
+            report.append(("extent", f"free extents hold {self.free_space.free_count} blocks, "
+                                     f"bitmap has {int(np.count_nonzero(~bitmap))}"))
+
+        if repair and report:
+            self._repair(files, damaged)
+        return _limit_report(report)
+
+    # 有问题的文件沿链走到第一个越界/空闲/已被别的文件占用的块为止, 保留前面的块;
+    # 再次扫描后释放所有无主的块, bitmap与FAT对齐, 重建空闲区间
+    def _repair(self, files, damaged):
+        block_num = self.image.block_num
+        block_size = self.disk.block_size
+        table = self.fat.table
+        claimed = set()
+        for i in damaged:
+            File = files[i]
+            size, blocks = self._file_usage(File)
+            limit = -(-File.stored_length // block_size)
+            chain = []
+            pointer = FAT_END if File.start_address is None else File.start_address
+            while len(chain) < limit and 0 <= pointer < block_num and table[pointer] != FAT_FREE \
+                    and pointer not in claimed:
+                claimed.add(pointer)
+                chain.append(pointer)
+                pointer = table[pointer]
+            # 压缩文件只留下完整的段, 之后的块随未引用的块一起释放
+            if File.extents is not None:
+                File.extents = File.extents.Cut(len(chain) * block_size)
+                del chain[-(-File.extents.stored // block_size):]
+            if not chain:
+                File.start_address = None
+            elif table[chain[-1]] != FAT_END:
+                self.fat.Set(chain[-1], FAT_END)
+            if File.extents is None:
+                File.length = min(File.length, len(chain) * block_size)
+            else:
+                File.length = File.extents.length
+            new_size, new_blocks = self._file_usage(File)
+            self._account(File.parent, new_size - size, new_blocks - blocks)
+            self.LogMeta("attr", File.parent, File.file_name, File.start_address, File.length, File.modify_time,
+                         File.extents)
+            self.content_index.Changed(File)
+
+        heads = np.array([-1 if F.start_address is None else F.start_address for F in files], dtype=np.int64)
+        fat, valid, used, length, cyclic, merged, bad, reachable = self._scan_chains(heads)
+        leaked = np.flatnonzero(used & ~reachable)
+        if self.snapshots:
+            # 被快照引用的要记下旧值
+            for block in leaked.tolist():
+                self.fat.Set(block, FAT_FREE)
+        else:
+            fat_view = np.asarray(table)
+            fat_view[leaked] = FAT_FREE
+            self.fat.dirty.update(leaked.tolist())
+        used[leaked] = False
+        used |= self._held_mask()
+
+        bitmap_bytes = np.frombuffer(self.free_space.bitmap, dtype=np.uint8)
+        bitmap = np.unpackbits(bitmap_bytes, bitorder="little")[:block_num].astype(bool)
+        # bitmap的改动随对应的FAT项一起记入日志和检查点
+        self.fat.dirty.update(np.flatnonzero(bitmap != used).tolist())
+        bitmap_bytes[:] = np.packbits(used, bitorder="little")
+        self.free_space.RebuildExtents()
+
+    # 快照占着的块
+    def _held_mask(self):
+        held = np.zeros(self.image.block_num, dtype=bool)
+        if self.snapshots.held:
+            held[np.fromiter(self.snapshots.held, dtype=np.int64, count=len(self.snapshots.held))] = True
+        return held
+
+
+# 挂载快照时的FAT: 依次查这个快照及之后各快照记下的旧值, 都没有就是当前的值
+# 先读当前的值再查旧值: FAT.Set先记旧值再改表, 与当前卷上并发的写入交错时也不会读到改过的值
+class SnapshotFAT:
+    def __init__(self, file_system: FileSystem, snapshot: Snapshot):
+        self.fs = file_system
+        self.snapshot = snapshot
+        self.saved = []
+        # FileReader按fat.table[block]沿链前进
+        self.table = self
+
+    # 快照表的结构在删除, 回滚快照时才变, 每次加锁后重取
+    def Refresh(self):
+        snapshots = self.fs.snapshots.snapshots
+        i = next(i for i, s in enumerate(snapshots) if s is self.snapshot)
+        self.saved = [s.fat for s in snapshots[i:]]
+
+    def __getitem__(self, block):
+        value = self.fs.fat.table[block]
+        for saved in self.saved:
+            if block in saved:
+                return saved[block]
+        return value
+
+
+# 挂载的快照: 只读的卷, 与当前卷共用映像与块缓存, 目录树从快照的元数据索引读入
+# 读文件时给当前卷加读锁, 快照已被删除(或回滚时丢弃)时抛出ValueError
+class SnapshotVolume:
+    def __init__(self, file_system: FileSystem, snapshot: Snapshot):
+        self.volume = file_system
+        self.snapshot = snapshot
+        self.name = snapshot.name
+        self.image = file_system.image
+        self.disk = file_system.disk
+        self.free_space = file_system.free_space
+        self.fat = SnapshotFAT(file_system, snapshot)
+        self.fat.Refresh()
+        self.file_tree = FileTreeNode.Stub(None, None, ROOT_ID, snapshot.store)
+        self.file_tree._load()
+        self.content_index = ContentIndex(self)
+
+    def Locked(self, node, write=False):
+        if write:
+            self._read_only()
+        lock = self.volume.volume_lock
+        lock.acquire_read()
+        if self.snapshot not in self.volume.snapshots:
+            lock.release_read()
+            raise ValueError(f"snapshot {self.name} no longer exists")
+        self.fat.Refresh()
+        return HeldLocks([lock], False)
+
+    def resolve(self, path):
+        if isinstance(path, str):
+            path = path.split("/")
+        node = self.file_tree
+        for name in path:
+            if name == "":
+                continue
+            if not isinstance(node, FileTreeNode):
+                return None
+            child = node.GetDir(name)
+            node = node.GetFile(name) if child is None else child
+            if node is None:
+                return None
+        return node
+
+    PathOf = FileSystem.PathOf
+    FindDir = FileSystem.FindDir
+    OpenFile = FileSystem.OpenFile
+    ReadAt = FileSystem.ReadAt
+    read_all = FileSystem.read_all
+    ReadFile = FileSystem.ReadFile
+    SearchContent = FileSystem.SearchContent
+    _file_usage = FileSystem._file_usage
+    _subtree_usage = FileSystem._subtree_usage
+
+    # 快照中的目录树不会变, 读锁下即可补算没有记下的用量
+    def DiskUsage(self, node):
+        with self.Locked(node):
+            if isinstance(node, FCB):
+                return self._file_usage(node) + (1,)
+            return tuple(self._subtree_usage(node))
+    _encode = staticmethod(FileSystem._encode)
+
+    def _read_only(self, *args, **kwargs):
+        raise ValueError(f"snapshot {self.name} is read-only")
+
+    createDir = createFile = WriteFile = WriteAt = AppendFile = TruncateFile = DeleteFile = deleteDir = \
+        RenameFile = RenameDir = Move = MovePath = FormatSystem = SaveSystemState = Fsck = Fragmentation = Exclusive = _read_only
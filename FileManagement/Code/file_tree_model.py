@@ -0,0 +1,202 @@
+import weakref
+
+from PyQt5.QtCore import QAbstractItemModel, QModelIndex, Qt
+from PyQt5.QtGui import QIcon
+
+import file_system_components
+
+FETCH_BATCH = 1000  # 每次展开/滚动最多取出的子结点数
+
+
+# 直接以FileTreeNode为数据的树模型
+# 子结点在展开时才分批取出, 增删改只发出对应行的信号, 不再整棵重建
+# 每个文件夹下先列文件再列子文件夹, 与中间的列表视图一致
+class FileTreeModel(QAbstractItemModel):
+    def __init__(self, root: file_system_components.FileTreeNode, parent=None):
+        super().__init__(parent)
+        self.root = root
+        # 文件夹 -> 已经交给视图的行数
+        self.fetched = weakref.WeakKeyDictionary()
+        # 视图在收到增删信号时可能再次调用fetchMore, 行数变化的过程中不再取数
+        self.changing = False
+        self.file_icon = QIcon('picture/File.png')
+        self.dir_icon = QIcon('picture/NoContentFileDir.png')
+
+    @staticmethod
+    def _total(node):
+        return len(node.file_index) + len(node.dir_index)
+
+    def RowOf(self, node):
+        if node is self.root:
+            return 0
+        parent = node.parent
+        if isinstance(node, file_system_components.FCB):
+            return parent.FileRow(node)
+        return len(parent.FileNode) + parent.DirRow(node)
+
+    def IndexOf(self, node):
+        return self.createIndex(self.RowOf(node), 0, node)
+
+    def NodeOf(self, index: QModelIndex):
+        return index.internalPointer() if index.isValid() else None
+
+    def index(self, row, column, parent=QModelIndex()):
+        if column != 0 or row < 0:
+            return QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(0, 0, self.root) if row == 0 else QModelIndex()
+        node = parent.internalPointer()
+        if row >= self.rowCount(parent):
+            return QModelIndex()
+        files = node.FileNode
+        if row < len(files):
+            return self.createIndex(row, 0, files[row])
+        dirs = node.DirNode
+        if row - len(files) < len(dirs):
+            return self.createIndex(row, 0, dirs[row - len(files)])
+        return QModelIndex()
+
+    def parent(self, index=QModelIndex()):
+        if not index.isValid():
+            return QModelIndex()
+        node = index.internalPointer()
+        if node is self.root or node.parent is None:
+            return QModelIndex()
+        return self.IndexOf(node.parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return 1
+        node = parent.internalPointer()
+        if isinstance(node, file_system_components.FCB):
+            return 0
+        return self.fetched.get(node, 0)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 1
+
+    def hasChildren(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return True
+        node = parent.internalPointer()
+        if isinstance(node, file_system_components.FCB):
+            return False
+        return self._total(node) > 0
+
+    def canFetchMore(self, parent):
+        if self.changing or not parent.isValid():
+            return False
+        node = parent.internalPointer()
+        if isinstance(node, file_system_components.FCB):
+            return False
+        return self.fetched.get(node, 0) < self._total(node)
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        node = parent.internalPointer()
+        fetched = self.fetched.get(node, 0)
+        count = min(self._total(node) - fetched, FETCH_BATCH)
+        if count <= 0:
+            return
+        self.changing = True
+        self.beginInsertRows(parent, fetched, fetched + count - 1)
+        self.fetched[node] = fetched + count
+        self.endInsertRows()
+        self.changing = False
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        node = index.internalPointer()
+        is_file = isinstance(node, file_system_components.FCB)
+        if role == Qt.DisplayRole:
+            return node.file_name if is_file else node.dir_name
+        if role == Qt.DecorationRole:
+            return self.file_icon if is_file else self.dir_icon
+        return None
+
+    # 结点是否已经出现在视图中
+    def _exposed(self, node):
+        if node is self.root:
+            return True
+        fetched = self.fetched.get(node.parent)
+        return fetched is not None and self.RowOf(node) < fetched
+
+    # 新文件排在已有文件之后, 新文件夹排在最后; 先通知视图再由create真正创建
+    def InsertNode(self, parent, is_file, create):
+        fetched = self.fetched.get(parent)
+        row = len(parent.FileNode) if is_file else self._total(parent)
+        if fetched is None:
+            # 空文件夹视图不会去取子结点, 已经显示出来的就当作取完
+            if self._total(parent) != 0 or not self._exposed(parent):
+                return create()
+            fetched = 0
+        if row > fetched:
+            return create()
+        self.changing = True
+        self.beginInsertRows(self.IndexOf(parent), row, row)
+        node = create()
+        if node:
+            self.fetched[parent] = fetched + 1
+        self.endInsertRows()
+        self.changing = False
+        return node
+
+    # 先通知视图再由remove真正删除, 视图不会访问到已删除的结点
+    def RemoveNode(self, node, remove):
+        parent = node.parent
+        fetched = self.fetched.get(parent)
+        row = self.RowOf(node)
+        if fetched is None or row >= fetched:
+            remove()
+            return
+        self.changing = True
+        self.beginRemoveRows(self.IndexOf(parent), row, row)
+        remove()
+        self.fetched[parent] = fetched - 1
+        self.endRemoveRows()
+        self.changing = False
+
+    # 挪到另一个文件夹target之下, 由move真正挪动; 两处都已显示时发出移动信号, 只有一处显示时按删除或新建通知
+    # move要么挪动成功要么什么都不改, 调用者要事先排除重名等情况
+    def MoveNode(self, node, target, move):
+        parent = node.parent
+        fetched = self.fetched.get(parent)
+        row = self.RowOf(node)
+        src_shown = fetched is not None and row < fetched
+        # 挪过去后排在同类结点的最后
+        dst_row = len(target.FileNode) if isinstance(node, file_system_components.FCB) else self._total(target)
+        dst_fetched = self.fetched.get(target)
+        if dst_fetched is None and self._total(target) == 0 and self._exposed(target):
+            dst_fetched = 0
+        dst_shown = dst_fetched is not None and dst_row <= dst_fetched
+        if not dst_shown:
+            self.RemoveNode(node, move)
+            return
+        self.changing = True
+        if src_shown:
+            self.beginMoveRows(self.IndexOf(parent), row, row, self.IndexOf(target), dst_row)
+        else:
+            self.beginInsertRows(self.IndexOf(target), dst_row, dst_row)
+        move()
+        self.fetched[target] = dst_fetched + 1
+        if src_shown:
+            self.fetched[parent] = fetched - 1
+            self.endMoveRows()
+        else:
+            self.endInsertRows()
+        self.changing = False
+
+    def NodeChanged(self, node):
+        if not self._exposed(node):
+            return
+        index = self.IndexOf(node)
+        self.dataChanged.emit(index, index)
+
+    # 格式化后整棵树换掉
+    def SetRoot(self, root):
+        self.beginResetModel()
+        self.root = root
+        self.fetched = weakref.WeakKeyDictionary()
+        self.endResetModel()
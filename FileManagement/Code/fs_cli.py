@@ -0,0 +1,414 @@
+import argparse
+import cmd
+import shlex
+import sys
+from datetime import datetime
+
+import file_system_components
+from compression import CODECS
+from defrag import Defragmenter
+from file_system_components import FCB, FileTreeNode
+
+
+class CommandError(Exception):
+    pass
+
+
+# 不依赖图形界面的命令行, 可交互使用, 也可从文件或标准输入批量执行
+# 路径以 / 开头时相对根目录, 否则相对当前目录
+class FileSystemShell(cmd.Cmd):
+    intro = None
+    prompt = "fs> "
+
+    def __init__(self, file_system, stdin=None, stdout=None):
+        super().__init__(stdin=stdin, stdout=stdout)
+        self.fs = file_system
+        # 挂载快照时fs换成只读的SnapshotVolume, volume总是原来的卷
+        self.volume = file_system
+        self.cwd = ()
+        self.errors = 0
+        # 未做完的碎片整理, 下次defrag接着做
+        self.defragmenter = None
+        # 批量执行时不回显提示符
+        if stdin is not None:
+            self.use_rawinput = False
+
+    def Run(self, lines):
+        for line in lines:
+            if self.onecmd(line.rstrip("\n")):
+                break
+        return self.errors
+
+    def Print(self, text):
+        self.stdout.write(text + "\n")
+
+    def Error(self, text):
+        self.errors += 1
+        self.stdout.write("error: " + text + "\n")
+
+    def onecmd(self, line):
+        try:
+            return super().onecmd(line)
+        # 空间不足与偏移越界由FileSystem抛出AssertionError/ValueError
+        except (CommandError, AssertionError, ValueError) as e:
+            self.Error(str(e))
+        return False
+
+    def emptyline(self):
+        return False
+
+    def default(self, line):
+        if line.lstrip().startswith("#"):
+            return False
+        raise CommandError(f"unknown command: {line.split()[0]}")
+
+    # 路径 -> 相对根目录的名字元组
+    def Split(self, path):
+        names = list(self.cwd) if not path.startswith("/") else []
+        for name in path.split("/"):
+            if name == "" or name == ".":
+                continue
+            if name == "..":
+                if names:
+                    names.pop()
+            else:
+                names.append(name)
+        return tuple(names)
+
+    def Lookup(self, path):
+        node = self.fs.resolve(self.Split(path))
+        if node is None:
+            raise CommandError(f"{path}: no such file or directory")
+        return node
+
+    def LookupDir(self, path):
+        node = self.Lookup(path)
+        if not isinstance(node, FileTreeNode):
+            raise CommandError(f"{path}: not a directory")
+        return node
+
+    def LookupFile(self, path):
+        names = self.Split(path)
+        if not names:
+            raise CommandError(f"{path}: is a directory")
+        parent = self.fs.resolve(names[:-1])
+        File = parent.GetFile(names[-1]) if isinstance(parent, FileTreeNode) else None
+        if File is None:
+            raise CommandError(f"{path}: no such file")
+        return File
+
+    # 返回(父目录, 名字), 父目录必须存在
+    def Parent(self, path):
+        names = self.Split(path)
+        if not names:
+            raise CommandError(f"{path}: invalid path")
+        parent = self.fs.resolve(names[:-1])
+        if not isinstance(parent, FileTreeNode):
+            raise CommandError(f"{path}: parent directory does not exist")
+        return parent, names[-1]
+
+    @staticmethod
+    def Args(arg, count):
+        args = shlex.split(arg)
+        if len(args) != count:
+            raise CommandError("wrong number of arguments")
+        return args
+
+    def do_mkdir(self, arg):
+        """mkdir [-p] PATH...  创建文件夹"""
+        args = shlex.split(arg)
+        parents = "-p" in args
+        for path in [a for a in args if a != "-p"]:
+            names = self.Split(path)
+            for depth in range(1 if parents else len(names), len(names) + 1):
+                parent, name = self.Parent("/" + "/".join(names[:depth]))
+                if parent.GetDir(name) is not None:
+                    if depth == len(names) and not parents:
+                        raise CommandError(f"{path}: directory exists")
+                    continue
+                self.fs.createDir(parent, name, datetime.now())
+
+    def do_touch(self, arg):
+        """touch PATH...  创建空文件, 已存在则不变"""
+        for path in shlex.split(arg):
+            parent, name = self.Parent(path)
+            if parent.GetDir(name) is not None:
+                raise CommandError(f"{path}: is a directory")
+            if parent.GetFile(name) is None:
+                self.fs.createFile(parent, name, datetime.now())
+
+    # write/append: 第一个参数是路径, 其余整行原样作为内容, \n 表示换行
+    def _write(self, arg, append):
+        path, _, text = arg.strip().partition(" ")
+        if not path:
+            raise CommandError("missing path")
+        parent, name = self.Parent(path)
+        if parent.GetDir(name) is not None:
+            raise CommandError(f"{path}: is a directory")
+        File = parent.GetFile(name)
+        if File is None:
+            File = self.fs.createFile(parent, name, datetime.now())
+        text = text.replace("\\n", "\n")
+        if append:
+            self.fs.AppendFile(File, text)
+        else:
+            self.fs.WriteFile(File, text)
+
+    def do_write(self, arg):
+        """write PATH TEXT  覆盖写入文件, 不存在则创建"""
+        self._write(arg, append=False)
+
+    def do_append(self, arg):
+        """append PATH TEXT  追加到文件末尾"""
+        self._write(arg, append=True)
+
+    def do_truncate(self, arg):
+        """truncate PATH LENGTH  截断文件"""
+        path, length = self.Args(arg, 2)
+        self.fs.TruncateFile(self.LookupFile(path), int(length))
+
+    def do_compress(self, arg):
+        """compress PATH [zlib|lzma|none]  显示或改变文件的压缩方式"""
+        args = shlex.split(arg)
+        if not 1 <= len(args) <= 2:
+            raise CommandError("wrong number of arguments")
+        File = self.LookupFile(args[0])
+        if len(args) == 2:
+            codec = None if args[1] == "none" else args[1]
+            if codec is not None and codec not in CODECS:
+                raise CommandError(f"unknown compression: {codec}")
+            self.fs.SetCompression(File, codec)
+        codec = "none" if File.extents is None else File.extents.codec
+        ratio = File.length / File.stored_length if File.stored_length else 1.0
+        self.Print(f"{codec}  length {File.length}  stored {File.stored_length}  ratio {ratio:.2f}")
+
+    def do_cat(self, arg):
+        """cat PATH...  输出文件内容"""
+        for path in shlex.split(arg):
+            self.stdout.write(self.fs.read_all(self.LookupFile(path)))
+        self.stdout.write("\n")
+
+    def do_grep(self, arg):
+        """grep PATTERN [PATH]  列出PATH(默认当前目录)之下内容含有PATTERN的文件"""
+        args = shlex.split(arg)
+        if not 1 <= len(args) <= 2:
+            raise CommandError("wrong number of arguments")
+        node = self.LookupDir(args[1] if len(args) > 1 else ".")
+        for File in self.fs.SearchContent(args[0], node):
+            self.Print("/" + "/".join(self.fs.PathOf(File.parent) + (File.file_name,)))
+
+    def do_rm(self, arg):
+        """rm [-r] PATH...  删除文件, -r 递归删除文件夹"""
+        args = shlex.split(arg)
+        recursive = "-r" in args
+        for path in [a for a in args if a != "-r"]:
+            node = self.Lookup(path)
+            if isinstance(node, FCB):
+                self.fs.DeleteFile(node.parent, node)
+            elif not recursive:
+                raise CommandError(f"{path}: is a directory")
+            elif node.parent is None:
+                raise CommandError("cannot remove the root directory")
+            else:
+                self.fs.deleteDir(node)
+                names = self.Split(path)
+                if self.cwd[:len(names)] == names:
+                    self.cwd = names[:-1]
+
+    def do_mv(self, arg):
+        """mv SRC DST  挪动或改名, DST是已有的文件夹时挪到其中, 不复制数据"""
+        src, dst = self.Args(arg, 2)
+        node = self.Lookup(src)
+        if node.parent is None:
+            raise CommandError("cannot move the root directory")
+        target = self.fs.resolve(self.Split(dst))
+        if isinstance(target, FileTreeNode) and target is not node:
+            parent, name = target, node.file_name if isinstance(node, FCB) else node.dir_name
+        else:
+            parent, name = self.Parent(dst)
+        if not self.fs.Move(node, parent, name):
+            raise CommandError(f"{dst}: already exists")
+        # 当前目录在挪走的子树中时跟着挪
+        if not isinstance(node, FCB):
+            names = self.Split(src)
+            if self.cwd[:len(names)] == names:
+                self.cwd = self.fs.PathOf(node) + self.cwd[len(names):]
+
+    def do_ls(self, arg):
+        """ls [PATH]  列出文件夹内容, 文件夹名后加 /"""
+        args = shlex.split(arg)
+        node = self.Lookup(args[0] if args else ".")
+        if isinstance(node, FCB):
+            self.Print(f"{node.length:>10}  {node.file_name}")
+            return
+        for File in node.FileNode:
+            self.Print(f"{File.length:>10}  {File.file_name}")
+        for child in node.DirNode:
+            self.Print(f"{self.fs.DiskUsage(child)[0]:>10}  {child.dir_name}/")
+
+    def do_cd(self, arg):
+        """cd [PATH]  切换当前目录"""
+        args = shlex.split(arg)
+        path = args[0] if args else "/"
+        self.LookupDir(path)
+        self.cwd = self.Split(path)
+
+    def do_pwd(self, arg):
+        """pwd  显示当前目录"""
+        self.Print("/" + "/".join(self.cwd))
+
+    def do_du(self, arg):
+        """du [PATH...]  显示文件或文件夹(整棵子树)的字节数, 块数与文件数, 默认当前目录"""
+        for path in shlex.split(arg) or ["."]:
+            size, blocks, files = self.fs.DiskUsage(self.Lookup(path))
+            self.Print(f"{size:>10}  {blocks:>8} blocks  {files:>6} files  {path}")
+
+    def do_df(self, arg):
+        """df  显示磁盘使用情况"""
+        stats = self.fs.DiskFree()
+        self.Print(f"blocks {stats['blocks']}  used {stats['used']}  free {stats['free']}  "
+                   f"block size {stats['block_size']}  used {stats['used'] / stats['blocks']:.1%}")
+        if stats["snapshot_held"]:
+            self.Print(f"held by snapshots {stats['snapshot_held']}")
+        dedup = self.fs.disk.dedup
+        if dedup is not None:
+            stats = dedup.Stats()
+            self.Print(f"dedup  logical {stats['logical_blocks']}  physical {stats['physical_blocks']}  "
+                       f"free physical {stats['free_physical_blocks']}  ratio {stats['dedup_ratio']:.2f}  "
+                       f"pending {len(self.fs.disk.unwritten)}")
+
+    def do_cache(self, arg):
+        """cache  显示块缓存的命中, 未命中与淘汰次数"""
+        stats = self.fs.disk.Stats()
+        self.Print("  ".join(f"{key} {value}" for key, value in stats.items()))
+
+    def do_fsck(self, arg):
+        """fsck [-r]  检查FAT, bitmap与目录树是否一致, -r 同时修复"""
+        problems = self.fs.Fsck(repair="-r" in shlex.split(arg))
+        for problem in problems:
+            self.Error(problem)
+        if not problems:
+            self.Print("clean")
+
+    def do_defrag(self, arg):
+        """defrag [STEPS]  碎片整理, 给出STEPS时只做这么多步, 下次接着做"""
+        args = shlex.split(arg)
+        steps = int(args[0]) if args else None
+        before = self.fs.Fragmentation()
+        if self.defragmenter is None:
+            self.defragmenter = Defragmenter(self.fs)
+        more = True
+        while more and (steps is None or steps > 0):
+            more = self.defragmenter.step()
+            if steps is not None:
+                steps -= 1
+        self.Print(f"extents per file {before:.2f} -> {self.fs.Fragmentation():.2f}, "
+                   f"moved {self.defragmenter.moved_blocks} blocks in {self.defragmenter.moved_files} files"
+                   + ("" if more else ", done"))
+        if not more:
+            self.defragmenter = None
+
+    def do_snapshot(self, arg):
+        """snapshot create|delete|rollback|mount NAME, snapshot list|umount  快照: 创建, 列出, 删除, 回滚, 只读挂载"""
+        args = shlex.split(arg)
+        if not args:
+            raise CommandError("missing subcommand")
+        command, names = args[0], args[1:]
+        if command in ("list", "umount"):
+            if names:
+                raise CommandError("wrong number of arguments")
+        elif command in ("create", "delete", "rollback", "mount"):
+            if len(names) != 1:
+                raise CommandError("wrong number of arguments")
+        else:
+            raise CommandError(f"unknown subcommand: {command}")
+        if command == "list":
+            for name, created, blocks in self.volume.ListSnapshots():
+                self.Print(f"{name}  {created:%Y-%m-%d %H:%M:%S}  {blocks} blocks")
+        elif command == "create":
+            self.volume.CreateSnapshot(names[0])
+        elif command == "delete":
+            self.volume.DeleteSnapshot(names[0])
+        elif command == "rollback":
+            self.volume.RollbackSnapshot(names[0])
+            self._mount(self.volume, FileSystemShell.prompt)
+        elif command == "mount":
+            self._mount(self.volume.MountSnapshot(names[0]), f"fs@{names[0]}> ")
+        else:
+            self._mount(self.volume, FileSystemShell.prompt)
+
+    def _mount(self, file_system, prompt):
+        self.fs = file_system
+        self.prompt = prompt
+        self.cwd = ()
+        self.defragmenter = None
+
+    def do_save(self, arg):
+        """save  提交到日志"""
+        self.fs.SaveSystemState()
+
+    def do_format(self, arg):
+        """format [BLOCK_NUM [BLOCK_SIZE]]  格式化, 可同时改变块数与块大小"""
+        geometry = [int(a) for a in shlex.split(arg)]
+        if len(geometry) > 2:
+            raise CommandError("wrong number of arguments")
+        self.fs.FormatSystem(*geometry)
+        self.cwd = ()
+        self.defragmenter = None
+
+    def do_exit(self, arg):
+        """exit  保存并退出"""
+        return True
+
+    do_quit = do_exit
+
+    def do_EOF(self, arg):
+        return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FAT file system command line")
+    parser.add_argument("-f", "--save-file", default=file_system_components.SAVEFILE,
+                        help="存档文件, 磁盘映像与日志与它同名")
+    parser.add_argument("-n", "--block-num", type=int,
+                        help="新建卷的块数")
+    parser.add_argument("-b", "--block-size", type=int,
+                        help="新建卷的块大小(字节)")
+    parser.add_argument("--compress", choices=sorted(CODECS),
+                        help="之后新建的文件按这种方式压缩")
+    parser.add_argument("--dedup", action="store_true",
+                        help="新建卷按块内容去重存储, 块数指物理块数")
+    parser.add_argument("--index-content", action="store_true",
+                        help="打开卷后在后台给全部文件内容建索引, grep第一次就快, 但要读遍整个卷")
+    parser.add_argument("-c", "--command", action="append", default=[],
+                        help="执行一条命令, 可重复")
+    parser.add_argument("script", nargs="?",
+                        help="批量执行的命令文件, - 表示标准输入")
+    args = parser.parse_args(argv)
+
+    fs = file_system_components.FileSystem(args.save_file, args.block_num, args.block_size,
+                                           dedup=args.dedup, compression=args.compress,
+                                           index_content=args.index_content)
+    try:
+        if args.command:
+            shell = FileSystemShell(fs)
+            errors = shell.Run(args.command)
+        elif args.script == "-":
+            shell = FileSystemShell(fs, stdin=sys.stdin)
+            errors = shell.Run(sys.stdin)
+        elif args.script is not None:
+            with open(args.script, encoding="utf-8") as f:
+                shell = FileSystemShell(fs, stdin=f)
+                errors = shell.Run(f)
+        else:
+            shell = FileSystemShell(fs)
+            shell.cmdloop()
+            errors = 0
+        fs.SaveSystemState()
+    finally:
+        fs.CloseVolume()
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,212 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+import file_system_components
+from benchmark import payload, percentile
+from fs_protocol import (DELETE_RECURSIVE, FLAG_ARGS, HANDLE_ARGS, HEADER, LENGTH_RESULT, MAX_RESULT, MKDIR_PARENTS,
+                         OP_CLOSE, OP_DELETE, OP_LIST, OP_MKDIR, OP_OPEN, OP_READ, OP_SYNC, OP_WRITE, OPEN_ARGS,
+                         OPEN_CREATE, OPEN_RESULT, READ_ARGS, STATUS_OK, WRITE_ARGS, WRITE_TRUNCATE, RemoteError,
+                         decode_entries, frame, read_frame)
+from fs_server import FileServer
+
+PIPELINE = 16  # 客户端默认最多同时等待的请求数
+
+
+# fs_server的客户端: 每个请求编一个号, 不必等前一个响应就可以继续发送, 响应按编号交给对应的调用
+class FileClient:
+    def __init__(self, reader, writer, pipeline=PIPELINE):
+        self.reader = reader
+        self.writer = writer
+        self.slots = asyncio.Semaphore(pipeline)
+        self.pending = {}
+        self.next_id = 0
+        self.receiver = asyncio.create_task(self._receive())
+
+    @classmethod
+    async def connect(cls, host="127.0.0.1", port=9000, pipeline=PIPELINE):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer, pipeline)
+
+    async def _receive(self):
+        try:
+            while True:
+                payload = await read_frame(self.reader)
+                if payload is None:
+                    break
+                request_id, status = HEADER.unpack_from(payload)
+                future = self.pending.pop(request_id, None)
+                if future is None or future.done():
+                    continue
+                if status == STATUS_OK:
+                    future.set_result(payload[HEADER.size:])
+                else:
+                    future.set_exception(RemoteError(status, payload[HEADER.size:].decode("utf-8", "replace")))
+        except (ValueError, ConnectionError) as e:
+            error = e
+        else:
+            error = ConnectionError("connection closed by server")
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+
+    async def request(self, op, body=b""):
+        async with self.slots:
+            if self.receiver.done():
+                raise ConnectionError("connection closed")
+            self.next_id = (self.next_id + 1) % 2 ** 32
+            request_id = self.next_id
+            future = asyncio.get_running_loop().create_future()
+            self.pending[request_id] = future
+            self.writer.write(frame(request_id, op, body))
+            await self.writer.drain()
+            return await future
+
+    # 返回(句柄, 文件长度)
+    async def open(self, path, create=False):
+        result = await self.request(OP_OPEN, OPEN_ARGS.pack(OPEN_CREATE if create else 0) + path.encode("utf-8"))
+        return OPEN_RESULT.unpack(result)
+
+    async def close(self, handle):
+        await self.request(OP_CLOSE, HANDLE_ARGS.pack(handle))
+
+    # size < 0 读到末尾; 服务器一次最多返回MAX_RESULT字节, 更多的按offset分几次读
+    async def read(self, handle, offset=0, size=-1):
+        chunks = []
+        while True:
+            want = MAX_RESULT if size < 0 else min(size, MAX_RESULT)
+            data = await self.request(OP_READ, READ_ARGS.pack(handle, offset, want))
+            chunks.append(data)
+            offset += len(data)
+            if size >= 0:
+                size -= len(data)
+            if len(data) < want or size == 0:
+                return b"".join(chunks)
+
+    # 返回写完后的文件长度
+    async def write(self, handle, data, offset=0, truncate=False):
+        result = await self.request(OP_WRITE, WRITE_ARGS.pack(handle, offset, WRITE_TRUNCATE if truncate else 0) + data)
+        return LENGTH_RESULT.unpack(result)[0]
+
+    # 返回[(类型, 大小, 名字), ...], 类型见fs_protocol.KIND_*
+    async def list(self, path="/"):
+        return decode_entries(await self.request(OP_LIST, path.encode("utf-8")))
+
+    async def mkdir(self, path, parents=False):
+        await self.request(OP_MKDIR, FLAG_ARGS.pack(MKDIR_PARENTS if parents else 0) + path.encode("utf-8"))
+
+    async def delete(self, path, recursive=False):
+        await self.request(OP_DELETE, FLAG_ARGS.pack(DELETE_RECURSIVE if recursive else 0) + path.encode("utf-8"))
+
+    async def sync(self):
+        await self.request(OP_SYNC)
+
+    async def disconnect(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+        await self.receiver
+
+
+# 负载生成: clients个连接, 每个在自己的文件夹下有files个文件, 随机读写整个文件,
+# 每个连接同时最多有pipeline个请求在途; 统计吞吐量与延迟分位数
+async def load(host, port, clients=16, requests=2000, size=4096, files=8, pipeline=8, write_ratio=0.3, seed=0):
+    async def client(n, latencies):
+        rng = random.Random(seed * 1000 + n)
+        conn = await FileClient.connect(host, port, pipeline)
+        await conn.mkdir(f"/load/c{n}", parents=True)
+        handles = []
+        for i in range(files):
+            handle, _ = await conn.open(f"/load/c{n}/f{i}", create=True)
+            await conn.write(handle, payload(rng, size), truncate=True)
+            handles.append(handle)
+
+        async def one():
+            handle = rng.choice(handles)
+            start = time.perf_counter()
+            if rng.random() < write_ratio:
+                await conn.write(handle, payload(rng, size), truncate=True)
+            else:
+                await conn.read(handle)
+            latencies.append(time.perf_counter() - start)
+
+        # 同时发出pipeline个请求, 哪个完成就补上一个
+        tasks = set()
+        for _ in range(requests):
+            if len(tasks) >= pipeline:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+            tasks.add(asyncio.create_task(one()))
+        if tasks:
+            for task in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(task, Exception):
+                    raise task
+        await conn.delete(f"/load/c{n}", recursive=True)
+        await conn.disconnect()
+
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(client(n, latencies) for n in range(clients)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "clients": clients,
+        "requests": len(latencies),
+        "size": size,
+        "pipeline": pipeline,
+        "write_ratio": write_ratio,
+        "wall_s": elapsed,
+        "requests_per_sec": len(latencies) / elapsed,
+        "mb_per_sec": len(latencies) * size / elapsed / 2 ** 20,
+        "p50_us": percentile(latencies, 0.50) * 1e6,
+        "p90_us": percentile(latencies, 0.90) * 1e6,
+        "p99_us": percentile(latencies, 0.99) * 1e6,
+        "max_us": latencies[-1] * 1e6,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FAT file server load generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="服务器端口, 不给时在本进程中起一个内存卷的服务器")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=2000, help="每个客户端的请求数")
+    parser.add_argument("--size", type=int, default=4096, help="每个文件的字节数")
+    parser.add_argument("--files", type=int, default=8, help="每个客户端的文件数")
+    parser.add_argument("--pipeline", type=int, default=8, help="每个连接在途的请求数")
+    parser.add_argument("--write-ratio", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-n", "--block-num", type=int, default=2 ** 18, help="本进程服务器的块数")
+    parser.add_argument("-b", "--block-size", type=int, default=512, help="本进程服务器的块大小")
+    args = parser.parse_args(argv)
+
+    async def run():
+        server = None
+        port = args.port
+        if port is None:
+            server = FileServer(file_system_components.FileSystem(None, args.block_num, args.block_size))
+            await server.start(args.host, 0)
+            port = server.port
+        try:
+            return await load(args.host, port, args.clients, args.requests, args.size, args.files,
+                              args.pipeline, args.write_ratio, args.seed)
+        finally:
+            if server is not None:
+                await server.close()
+
+    report = asyncio.run(run())
+    print(json.dumps(report, indent=2))
+    print(f"{report['requests_per_sec']:.0f} req/s  {report['mb_per_sec']:.1f} MB/s  "
+          f"p50 {report['p50_us']:.0f}us  p99 {report['p99_us']:.0f}us", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+import struct
+
+# 网络协议: 每帧是4字节小端长度加负载
+# 请求负载: 请求号(u32) 操作码(u8) 参数; 响应负载: 请求号(u32) 状态(u8) 结果
+# 同一连接上的请求按顺序执行, 客户端不必等上一个响应就可以接着发(流水线), 响应按请求号对应
+FRAME = struct.Struct("<I")
+HEADER = struct.Struct("<IB")
+MAX_FRAME = 64 * 2 ** 20  # 单帧的上限, 超过就断开连接
+MAX_RESULT = MAX_FRAME - HEADER.size  # 一个响应的结果最多这么长, 读文件一次最多读这么多
+
+# 操作码, 参数中的路径与数据总在最后, 占满负载的剩余部分
+OP_OPEN = 1  # flags(u8) path -> handle(u32) length(u64); flags & OPEN_CREATE 时不存在就创建
+OP_CLOSE = 2  # handle(u32) ->
+OP_READ = 3  # handle(u32) offset(u64) size(i64) -> data; size < 0 读到末尾; 最多读MAX_RESULT字节, 其余按offset接着读
+OP_WRITE = 4  # handle(u32) offset(u64) flags(u8) data -> length(u64); flags & WRITE_TRUNCATE 时写完截断
+OP_LIST = 5  # path -> [kind(u8) size(u64) name_len(u16) name]...
+OP_MKDIR = 6  # flags(u8) path -> ; flags & MKDIR_PARENTS 时逐级创建
+OP_DELETE = 7  # flags(u8) path -> ; flags & DELETE_RECURSIVE 时可删非空文件夹
+OP_SYNC = 8  # -> ; 提交到日志
+
+OPEN_CREATE = 1
+WRITE_TRUNCATE = 1
+MKDIR_PARENTS = 1
+DELETE_RECURSIVE = 1
+
+KIND_FILE = 0
+KIND_DIR = 1
+
+# 状态, 出错时结果是utf-8的错误信息
+STATUS_OK = 0
+STATUS_NOT_FOUND = 1
+STATUS_EXISTS = 2
+STATUS_INVALID = 3
+STATUS_NO_SPACE = 4
+STATUS_BAD_REQUEST = 5
+STATUS_ERROR = 6
+
+OPEN_ARGS = struct.Struct("<B")
+OPEN_RESULT = struct.Struct("<IQ")
+HANDLE_ARGS = struct.Struct("<I")
+READ_ARGS = struct.Struct("<IQq")
+WRITE_ARGS = struct.Struct("<IQB")
+LENGTH_RESULT = struct.Struct("<Q")
+FLAG_ARGS = struct.Struct("<B")
+ENTRY = struct.Struct("<BQH")
+
+
+class RemoteError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def frame(request_id, code, body=b""):
+    return FRAME.pack(HEADER.size + len(body)) + HEADER.pack(request_id, code) + body
+
+
+# 读出一帧的负载, 连接正常关闭时返回None; 在一帧的中间断开时抛出ConnectionError
+async def read_frame(reader):
+    try:
+        length, = FRAME.unpack(await reader.readexactly(FRAME.size))
+    except EOFError:
+        return None
+    if length < HEADER.size or length > MAX_FRAME:
+        raise ValueError(f"bad frame length {length}")
+    try:
+        return await reader.readexactly(length)
+    except EOFError:
+        raise ConnectionError("connection closed in the middle of a frame") from None
+
+
+def encode_entries(entries):
+    parts = []
+    for kind, size, name in entries:
+        name = name.encode("utf-8")
+        parts.append(ENTRY.pack(kind, size, len(name)) + name)
+    return b"".join(parts)
+
+
+def decode_entries(data):
+    entries = []
+    pos = 0
+    while pos < len(data):
+        kind, size, length = ENTRY.unpack_from(data, pos)
+        pos += ENTRY.size
+        entries.append((kind, size, data[pos:pos + length].decode("utf-8")))
+        pos += length
+    return entries
@@ -0,0 +1,279 @@
+import argparse
+import asyncio
+import struct
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import file_system_components
+from file_system_components import FCB, FileTreeNode
+from fs_protocol import (DELETE_RECURSIVE, FLAG_ARGS, HANDLE_ARGS, HEADER, KIND_DIR, KIND_FILE, LENGTH_RESULT,
+                         MAX_RESULT, MKDIR_PARENTS, OP_CLOSE, OP_DELETE, OP_LIST, OP_MKDIR, OP_OPEN, OP_READ, OP_SYNC,
+                         OP_WRITE, OPEN_ARGS, OPEN_CREATE, OPEN_RESULT, READ_ARGS, STATUS_BAD_REQUEST, STATUS_ERROR,
+                         STATUS_EXISTS, STATUS_INVALID, STATUS_NO_SPACE, STATUS_NOT_FOUND, STATUS_OK, WRITE_ARGS,
+                         WRITE_TRUNCATE, encode_entries, frame, read_frame)
+
+MAX_INFLIGHT = 64  # 每个连接已读入但未回复的请求数上限, 满了就不再读socket
+SAVE_INTERVAL = 1.0  # 定期提交日志的间隔(秒)
+
+
+# 一个连接的状态: 打开的文件
+class Session:
+    def __init__(self):
+        self.handles = {}
+        self.next_handle = 1
+
+
+# 基于asyncio的文件服务器, 多个客户端共享同一个卷
+# 网络收发在事件循环中, 文件系统操作放到线程池执行(FileSystem是线程安全的)
+# 同一连接的请求排队依次执行, 不同连接并发; 队列满或客户端不读响应时停止读取, 背压传回客户端
+class FileServer:
+    def __init__(self, file_system, max_inflight=MAX_INFLIGHT, workers=None, save_interval=SAVE_INTERVAL):
+        self.fs = file_system
+        self.max_inflight = max_inflight
+        self.executor = ThreadPoolExecutor(workers)
+        self.save_interval = save_interval
+        self.server = None
+        self.saver = None
+        self.connections = 0
+        self.requests = 0
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self.Serve, host, port)
+        if self.save_interval:
+            self.saver = asyncio.create_task(self._save_loop())
+        return self.server
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        if self.saver is not None:
+            self.saver.cancel()
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.fs.SaveSystemState)
+        self.executor.shutdown()
+
+    async def _save_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.save_interval)
+            await loop.run_in_executor(self.executor, self.fs.SaveSystemState)
+
+    # 一个连接: 读请求放入有界队列, 另一个协程按顺序执行并回复
+    async def Serve(self, reader, writer):
+        self.connections += 1
+        queue = asyncio.Queue(self.max_inflight)
+        worker = asyncio.create_task(self._work(queue, writer))
+        try:
+            while not worker.done():
+                payload = await read_frame(reader)
+                if payload is None:
+                    break
+                await queue.put(payload)
+        except (ValueError, ConnectionError):
+            pass
+        finally:
+            await queue.put(None)
+            await worker
+            writer.close()
+            self.connections -= 1
+
+    async def _work(self, queue, writer):
+        loop = asyncio.get_running_loop()
+        session = Session()
+        broken = False
+        while True:
+            payload = await queue.get()
+            if payload is None:
+                return
+            # 连接断了之后只把队列取空, 读请求的一方不会卡在队列上
+            if broken:
+                continue
+            request_id, op = HEADER.unpack_from(payload)
+            status, result = await loop.run_in_executor(
+                self.executor, self.Dispatch, session, op, memoryview(payload)[HEADER.size:])
+            self.requests += 1
+            try:
+                writer.write(frame(request_id, status, result))
+                await writer.drain()
+            except ConnectionError:
+                broken = True
+                writer.close()
+
+    # 在线程池中执行一个请求, 返回(状态, 结果)
+    def Dispatch(self, session, op, body):
+        try:
+            handler = self.HANDLERS.get(op)
+            if handler is None:
+                return STATUS_BAD_REQUEST, f"unknown operation {op}".encode()
+            result = handler(self, session, body)
+            # 别的操作的结果(很大的文件夹的列表)超过一帧时同样只报错, 不发出客户端收不下的帧
+            if len(result) > MAX_RESULT:
+                raise ValueError(f"result of {len(result)} bytes does not fit in a frame")
+            return STATUS_OK, result
+        except FileNotFoundError as e:
+            return STATUS_NOT_FOUND, str(e).encode()
+        except FileExistsError as e:
+            return STATUS_EXISTS, str(e).encode()
+        except struct.error as e:
+            return STATUS_BAD_REQUEST, str(e).encode()
+        # 空间不足由FileSystem抛出AssertionError
+        except AssertionError as e:
+            return STATUS_NO_SPACE, str(e).encode()
+        except (ValueError, UnicodeDecodeError) as e:
+            return STATUS_INVALID, str(e).encode()
+        except Exception as e:
+            return STATUS_ERROR, repr(e).encode()
+
+    @staticmethod
+    def Split(path):
+        return tuple(name for name in path.split("/") if name not in ("", "."))
+
+    def Lookup(self, path):
+        node = self.fs.resolve(self.Split(path))
+        if node is None:
+            raise FileNotFoundError(f"{path}: no such file or directory")
+        return node
+
+    def Parent(self, path):
+        names = self.Split(path)
+        if not names:
+            raise ValueError(f"{path}: invalid path")
+        parent = self.fs.resolve(names[:-1])
+        if not isinstance(parent, FileTreeNode):
+            raise FileNotFoundError(f"{path}: parent directory does not exist")
+        return parent, names[-1]
+
+    @staticmethod
+    def Handle(session, handle):
+        File = session.handles.get(handle)
+        if File is None:
+            raise ValueError(f"bad handle {handle}")
+        return File
+
+    def do_open(self, session, body):
+        flags, = OPEN_ARGS.unpack_from(body)
+        path = bytes(body[OPEN_ARGS.size:]).decode("utf-8")
+        parent, name = self.Parent(path)
+        File = parent.GetFile(name)
+        if File is None:
+            if not flags & OPEN_CREATE:
+                raise FileNotFoundError(f"{path}: no such file")
+            # 另一个连接可能同时创建了同名文件; 同名的是文件夹时不创建
+            File = self.fs.createFile(parent, name, datetime.now()) or parent.GetFile(name)
+            if not File:
+                raise FileExistsError(f"{path}: is a directory")
+        handle = session.next_handle
+        session.next_handle += 1
+        session.handles[handle] = File
+        return OPEN_RESULT.pack(handle, File.length)
+
+    def do_close(self, session, body):
+        handle, = HANDLE_ARGS.unpack_from(body)
+        self.Handle(session, handle)
+        del session.handles[handle]
+        return b""
+
+    # 超过一帧的响应客户端收不下, 会断开整个连接, 读的大小截到MAX_RESULT
+    def do_read(self, session, body):
+        handle, offset, size = READ_ARGS.unpack_from(body)
+        if size < 0 or size > MAX_RESULT:
+            size = MAX_RESULT
+        return self.fs.ReadAt(self.Handle(session, handle), offset, size)
+
+    def do_write(self, session, body):
+        handle, offset, flags = WRITE_ARGS.unpack_from(body)
+        File = self.Handle(session, handle)
+        data = bytes(body[WRITE_ARGS.size:])
+        self.fs.WriteAt(File, offset, data, truncate=bool(flags & WRITE_TRUNCATE))
+        return LENGTH_RESULT.pack(File.length)
+
+    def do_list(self, session, body):
+        node = self.Lookup(bytes(body).decode("utf-8"))
+        if isinstance(node, FCB):
+            return encode_entries([(KIND_FILE, node.length, node.file_name)])
+        with self.fs.Locked(node):
+            entries = [(KIND_FILE, File.length, File.file_name) for File in node.FileNode]
+            entries += [(KIND_DIR, 0, child.dir_name) for child in node.DirNode]
+        return encode_entries(entries)
+
+    def do_mkdir(self, session, body):
+        flags, = FLAG_ARGS.unpack_from(body)
+        path = bytes(body[FLAG_ARGS.size:]).decode("utf-8")
+        names = self.Split(path)
+        for depth in range(1 if flags & MKDIR_PARENTS else len(names), len(names) + 1):
+            parent, name = self.Parent("/".join(names[:depth]))
+            if not self.fs.createDir(parent, name, datetime.now()):
+                if depth == len(names) and not flags & MKDIR_PARENTS:
+                    raise FileExistsError(f"{path}: directory exists")
+        return b""
+
+    def do_delete(self, session, body):
+        flags, = FLAG_ARGS.unpack_from(body)
+        path = bytes(body[FLAG_ARGS.size:]).decode("utf-8")
+        node = self.Lookup(path)
+        if isinstance(node, FCB):
+            self.fs.DeleteFile(node.parent, node)
+        elif node.parent is None:
+            raise ValueError("cannot remove the root directory")
+        elif not flags & DELETE_RECURSIVE and (node.FileNode or node.DirNode):
+            raise ValueError(f"{path}: directory not empty")
+        else:
+            self.fs.deleteDir(node)
+        return b""
+
+    def do_sync(self, session, body):
+        self.fs.SaveSystemState()
+        return b""
+
+    HANDLERS = {
+        OP_OPEN: do_open,
+        OP_CLOSE: do_close,
+        OP_READ: do_read,
+        OP_WRITE: do_write,
+        OP_LIST: do_list,
+        OP_MKDIR: do_mkdir,
+        OP_DELETE: do_delete,
+        OP_SYNC: do_sync,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FAT file system network server")
+    parser.add_argument("-f", "--save-file", default=file_system_components.SAVEFILE,
+                        help="存档文件, 磁盘映像与日志与它同名")
+    parser.add_argument("-n", "--block-num", type=int, help="新建卷的块数")
+    parser.add_argument("-b", "--block-size", type=int, help="新建卷的块大小(字节)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--workers", type=int, help="执行文件系统操作的线程数")
+    parser.add_argument("--index-content", action="store_true",
+                        help="打开卷后在后台给全部文件内容建索引, 要读遍整个卷")
+    args = parser.parse_args(argv)
+
+    fs = file_system_components.FileSystem(args.save_file, args.block_num, args.block_size,
+                                           index_content=args.index_content)
+
+    async def run():
+        server = FileServer(fs, workers=args.workers)
+        await server.start(args.host, args.port)
+        print(f"serving on {args.host}:{server.port}", file=sys.stderr)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fs.CloseVolume()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
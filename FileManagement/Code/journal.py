@@ -0,0 +1,58 @@
+import os
+import pickle
+import struct
+import zlib
+
+JOURNAL_MAGIC = b"TJWL"
+# 每条事务的头: 魔数, 序号, 负载长度, 负载crc32
+RECORD_HEADER = struct.Struct("<4sQII")
+
+
+# 预写日志: 每次保存追加一条事务, 只记录这段时间内改动过的FAT项, 块和元数据操作
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a+b")
+        self.file.seek(0, os.SEEK_END)
+        self.size = self.file.tell()
+
+    # 依次读出完整的事务, 尾部残缺(写到一半崩溃)的部分直接截掉
+    def Records(self):
+        records = []
+        self.file.seek(0)
+        valid = 0
+        while True:
+            header = self.file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            magic, seq, length, crc = RECORD_HEADER.unpack(header)
+            if magic != JOURNAL_MAGIC:
+                break
+            payload = self.file.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            records.append((seq, pickle.loads(payload)))
+            valid = self.file.tell()
+        if valid < self.size:
+            self.file.truncate(valid)
+            self.size = valid
+        return records
+
+    # 追加一条事务, 落盘之后才算提交
+    def Append(self, seq, record):
+        payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        self.file.write(RECORD_HEADER.pack(JOURNAL_MAGIC, seq, len(payload), zlib.crc32(payload)))
+        self.file.write(payload)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.size += RECORD_HEADER.size + len(payload)
+
+    # 检查点完成后清空日志
+    def Reset(self):
+        self.file.truncate(0)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.size = 0
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,62 @@
+import threading
+
+
+# 读写锁: 读者可以并发, 写者独占
+# 有写者在等时新来的读者也要等, 写者不会被源源不断的读者饿死; 不可重入
+# 没有竞争时只加一次互斥锁, 条件变量等到第一次需要等待时才创建
+class RWLock:
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._cond = None
+        self._readers = 0
+        self._writer = False
+        self._waiting = 0
+        self._waiting_writers = 0
+
+    def _wait(self):
+        if self._cond is None:
+            self._cond = threading.Condition(self._mutex)
+        self._waiting += 1
+        self._cond.wait()
+        self._waiting -= 1
+
+    def _wake(self):
+        if self._waiting:
+            self._cond.notify_all()
+
+    def acquire_read(self):
+        with self._mutex:
+            while self._writer or self._waiting_writers:
+                self._wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._mutex:
+            self._readers -= 1
+            if self._readers == 0:
+                self._wake()
+
+    def acquire_write(self):
+        with self._mutex:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._wait()
+            self._waiting_writers -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._mutex:
+            self._writer = False
+            self._wake()
+
+    def acquire(self, write=False):
+        if write:
+            self.acquire_write()
+        else:
+            self.acquire_read()
+
+    def release(self, write=False):
+        if write:
+            self.release_write()
+        else:
+            self.release_read()
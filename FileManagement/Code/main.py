@@ -1,6 +1,7 @@
 import sys
 import MainWindow
 import file_system_components
+from file_tree_model import FileTreeModel
 from datetime import datetime
 
 from PyQt5 import QtCore
@@ -24,10 +25,6 @@ class FileSystem(QMainWindow,QWidget,file_system_components.FileSystem):
         self.cur_selected_file = None
         self.cur_selected_dir = None
 
-        # HeadNode
-        self.Head = file_system_components.FileTreeNode("head",datetime.now())
-        self.Head.DirNode.append(self.file_tree)
-
         # 右键菜单
         self.ui.treeView.setContextMenuPolicy(Qt.CustomContextMenu)
         self.ui.treeView.customContextMenuRequested.connect(self.rightclick)
@@ -36,6 +33,7 @@ class FileSystem(QMainWindow,QWidget,file_system_components.FileSystem):
 
 
     def setui(self):
+        self.SetupTreeView()
         self.UpdateUI()
         self.ui.filecontent.setWordWrapMode(QTextOption.WrapAnywhere)
         # 记录connect
@@ -79,29 +77,12 @@ class FileSystem(QMainWindow,QWidget,file_system_components.FileSystem):
             print(f"curent file:{self.cur_selected_file.file_name}")
         else:
             print("curent file is None")
-    def dfsBuildTreeModel(self,model:QStandardItemModel,file_tree_node:file_system_components.FileTreeNode):
-        for file in file_tree_node.FileNode:
-            Item = QStandardItem(file.file_name)
-            Item.setIcon(QIcon('picture/File.png'))
-            model.appendRow(Item)
-
-        for dirnode in file_tree_node.DirNode:
-            child_model = QStandardItem(dirnode.dir_name)
-            child_model.setIcon(QIcon('picture/NoContentFileDir.png'))
-            self.dfsBuildTreeModel(child_model,dirnode)
-            model.appendRow(child_model)
-
-
-    def BuildTreeModel(self)-> QStandardItemModel:
-        root_item = QStandardItem(self.file_tree.dir_name)
-        self.dfsBuildTreeModel(root_item,self.file_tree)
-        model = QStandardItemModel()
-        model.appendRow(root_item)
-        return model
-
-    def UpdateTreeView(self):
-        self.ui.treeView.setModel(self.BuildTreeModel())
-        self.ui.treeView.expandAll()
+    # 树模型只建一次, 之后的增删改由模型发出局部更新
+    def SetupTreeView(self):
+        self.tree_model = FileTreeModel(self.file_tree, self)
+        self.ui.treeView.setModel(self.tree_model)
+        self.ui.treeView.setUniformRowHeights(True)
+        self.ui.treeView.expand(self.tree_model.IndexOf(self.file_tree))
         # 点击事件
         self.ui.treeView.selectionModel().currentChanged.connect(self.ClickTreeItem)
         # 不可修改
@@ -113,6 +94,14 @@ class FileSystem(QMainWindow,QWidget,file_system_components.FileSystem):
         self.ui.treeView.verticalScrollBar().setEnabled(True)
         self.ui.treeView.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarPolicy.ScrollBarAlwaysOn)
 
+    def UpdateTreeView(self):
+        self.ui.treeView.viewport().update()
+
+    # 删除前先清掉树上的当前项, 避免视图把选中项挪到相邻结点上
+    def RemoveTreeNode(self, node, remove):
+        self.ui.treeView.setCurrentIndex(QModelIndex())
+        self.tree_model.RemoveNode(node, remove)
+
     def rightclick(self):
         if self.cur_selected_dir is None and self.cur_selected_file is None:
             return
@@ -120,13 +109,18 @@ class FileSystem(QMainWindow,QWidget,file_system_components.FileSystem):
         if self.cur_selected_file is not None:
             SelectMenu.addAction("删除文件",self.sys_delete_file)
             SelectMenu.addAction("重命名文件",self.sys_rename_file)
+            SelectMenu.addAction("移动文件",self.sys_move)
         elif self.cur_selected_dir is not None:
             SelectMenu.addAction("创建文件",self.sys_create_file)
             SelectMenu.addAction("创建文件夹",self.sys_create_dir)
             SelectMenu.addAction("重命名文件夹",self.sys_rename_dir)
+            SelectMenu.addAction("移动文件夹",self.sys_move)
             SelectMenu.addAction("删除文件夹",self.sys_delete_dir)
+            SelectMenu.addAction("搜索文件内容",self.sys_search_content)
         SelectMenu.addAction("保存系统状态",self.sys_SaveSys)
         SelectMenu.addAction("格式化",self.sys_format)
+        SelectMenu.addAction("创建快照",self.sys_create_snapshot)
+        SelectMenu.addAction("回滚到快照",self.sys_rollback_snapshot)
         SelectMenu.popup(QCursor.pos())
 
     def bulidListView(self) ->QStandardItemModel:
@@ -177,7 +171,7 @@ class FileSystem(QMainWindow,QWidget,file_system_components.FileSystem):
             msg= ""
             self.ui.filecontent.setReadOnly(False)
         else:
-            msg = self.ReadFile(self.cur_selected_file)
+            msg = self.read_all(self.cur_selected_file)
             self.ui.filecontent.setReadOnly(False)
         self.ui.filecontent.setPlainText(msg)
 
@@ -210,6 +204,12 @@ class FileSystem(QMainWindow,QWidget,file_system_components.FileSystem):
                 f"创建时间: {str(self.cur_selected_dir.create_time).ljust(20)} "
                 f"子文件个数: {str(len(self.cur_selected_dir.FileNode) + len(self.cur_selected_dir.DirNode)).ljust(5)}\n"
             )
+            size, blocks, files = self.DiskUsage(self.cur_selected_dir)
+            stats = self.DiskFree()
+            msg += (
+                f"总大小: {str(size).ljust(10)}B 占用块数: {str(blocks).ljust(8)} 文件总数: {files}\n"
+                f"磁盘已用: {stats['used']}/{stats['blocks']}块\n"
+            )
         if self.cur_selected_file is not None:
             msg += (
                 f"当前文件: {str(self.cur_selected_file.file_name).ljust(10)} "
@@ -217,6 +217,9 @@ class FileSystem(QMainWindow,QWidget,file_system_components.FileSystem):
                 f"最近更新时间: {str(self.cur_selected_file.modify_time).ljust(20)} "
                 f"文件大小: {str(self.cur_selected_file.length).ljust(5)}B"
             )
+            extents = self.cur_selected_file.extents
+            if extents is not None:
+                msg += f" ({extents.codec}压缩, 占用{extents.stored}B)"
         if self.cur_selected_dir is None and self.cur_selected_file is None:
             msg = "未选择文件"
 
@@ -225,6 +228,8 @@ class FileSystem(QMainWindow,QWidget,file_system_components.FileSystem):
 
 
     def ClickTreeItem(self,Item:QModelIndex):
+        if not Item.isValid():
+            return
         # 记录当前index
         record = Item
         # 更新当前路径
@@ -238,22 +243,14 @@ class FileSystem(QMainWindow,QWidget,file_system_components.FileSystem):
             path = path +str(pathname)+'/'
         self.cur_path = path
 
-        # 更新当前信息
-        # 首先搜索到这一信息块
-        pointer = self.Head
-        # 第一个一定是根节点,因为要判断类型所以搜索到倒数第二个
-        for i in range(0,len(pathlist)-1):
-            for childdir in pointer.DirNode:
-                if childdir.dir_name == pathlist[i]:
-                    pointer = childdir
-                    break
-        # 前面是文件后面是文件夹,根据索引判断是文件还是文件夹
-        if Item.row() > len(pointer.FileNode)-1:
-            self.cur_selected_dir = pointer.DirNode[Item.row()-len(pointer.FileNode)]
-            self.cur_selected_file = None
+        # 更新当前信息, 模型的每一项直接指向对应的结点
+        node = self.tree_model.NodeOf(Item)
+        if isinstance(node, file_system_components.FCB):
+            self.cur_selected_file = node
+            self.cur_selected_dir = node.parent
         else:
-            self.cur_selected_file = pointer.FileNode[Item.row()]
-            self.cur_selected_dir = pointer
+            self.cur_selected_dir = node
+            self.cur_selected_file = None
         print("ClickEvent:")
         self.SysStatusLog()
 
@@ -272,8 +269,8 @@ class FileSystem(QMainWindow,QWidget,file_system_components.FileSystem):
             self.cur_selected_dir=None
             self.cur_path = "User/"
             print(self.file_tree.DirNode)
-            self.Head.DirNode.clear()
-            self.Head.DirNode.append(self.file_tree)
+            self.tree_model.SetRoot(self.file_tree)
+            self.ui.treeView.expand(self.tree_model.IndexOf(self.file_tree))
             self.UpdateUI()
 
     def sys_SaveSys(self):
@@ -287,10 +284,11 @@ class FileSystem(QMainWindow,QWidget,file_system_components.FileSystem):
                 QMessageBox.warning(self,"Warning","文件夹名为空！")
             elif self.cur_selected_dir is None:
                 QMessageBox.warning(self, "Warning", "未选定创建路径！")
-            elif len([i for i in self.cur_selected_dir.DirNode if i.dir_name == dir_name])>0:
+            elif self.cur_selected_dir.GetDir(dir_name) is not None:
                 QMessageBox.warning(self,"Warning","文件夹已存在！")
             else:
-                self.createDir(self.cur_selected_dir,dir_name,datetime.now())
+                self.tree_model.InsertNode(self.cur_selected_dir, False,
+                                           lambda: self.createDir(self.cur_selected_dir,dir_name,datetime.now()))
                 self.UpdateUI()
     def sys_create_file(self):
         new_file_name, ok = QInputDialog.getText(self, '创建文件', '输入创建文件名：')
@@ -299,17 +297,20 @@ class FileSystem(QMainWindow,QWidget,file_system_components.FileSystem):
                 QMessageBox.warning(self, "Warning", "文件名为空！")
             elif self.cur_selected_dir is None:
                 QMessageBox.warning(self, "Warning", "未选定文件所在文件夹！")
-            elif len([x for x in self.cur_selected_dir.DirNode if x.dir_name == new_file_name]) > 0:
+            elif self.cur_selected_dir.GetFile(new_file_name) is not None or self.cur_selected_dir.GetDir(new_file_name) is not None:
                 QMessageBox.warning(self, "Warning", "已有重复文件名！")
             else:
-                self.createFile(self.cur_selected_dir,new_file_name,datetime.now())
+                self.tree_model.InsertNode(self.cur_selected_dir, True,
+                                           lambda: self.createFile(self.cur_selected_dir,new_file_name,datetime.now()))
                 self.UpdateUI()
     def sys_delete_file(self):
         if self.cur_selected_file is None:
             QMessageBox.warning(self,"Warning","未选定删除的文件！")
             return
-        self.DeleteFile(self.cur_selected_dir,self.cur_selected_file)
+        File, CurDir = self.cur_selected_file, self.cur_selected_dir
+        self.RemoveTreeNode(File, lambda: self.DeleteFile(CurDir, File))
         self.cur_selected_file = None
+        self.cur_selected_dir = CurDir
         self.UpdateUI()
 
     def sys_delete_dir(self):
@@ -319,7 +320,8 @@ class FileSystem(QMainWindow,QWidget,file_system_components.FileSystem):
         elif self.cur_selected_dir == self.file_tree:
             QMessageBox.warning(self,"Warning","不能删去根文件夹！")
             return
-        self.deleteDir(self.cur_selected_dir)
+        DeleteDir = self.cur_selected_dir
+        self.RemoveTreeNode(DeleteDir, lambda: self.deleteDir(DeleteDir))
         self.cur_selected_dir = None
         self.cur_selected_file = None
         self.UpdateUI()
@@ -332,10 +334,12 @@ class FileSystem(QMainWindow,QWidget,file_system_components.FileSystem):
         if check:
             if new_name == "":
                 QMessageBox.warning(self, "Warning", "文件名为空！")
-            elif len([i for i in self.cur_selected_dir.FileNode if i.file_name == new_name])>0:
+            elif self.cur_selected_dir.GetFile(new_name) is not None or \
+                    self.cur_selected_dir.GetDir(new_name) is not None:
                 QMessageBox.warning(self, "Warning", "已有重复文件名！")
             else:
                 self.RenameFile(self.cur_selected_file,new_name,self.cur_selected_dir)
+                self.tree_model.NodeChanged(self.cur_selected_file)
                 self.UpdateUI()
 
     def sys_rename_dir(self):
@@ -349,13 +353,87 @@ class FileSystem(QMainWindow,QWidget,file_system_components.FileSystem):
         if check:
             if new_name == "":
                 QMessageBox.warning(self, "Warning", "文件夹名为空！")
-            elif len([i for i in self.cur_selected_dir.parent.FileNode if i.file_name == new_name])>0:
+            elif self.cur_selected_dir.parent.GetDir(new_name) is not None or \
+                    self.cur_selected_dir.parent.GetFile(new_name) is not None:
                 QMessageBox.warning(self, "Warning", "存在相同文件名！")
             else:
                 self.RenameDir(new_name,self.cur_selected_dir)
+                self.tree_model.NodeChanged(self.cur_selected_dir)
                 self.UpdateUI()
+    # 选中的文件或文件夹挪到另一个文件夹下, 不复制数据
+    def sys_move(self):
+        node = self.cur_selected_file if self.cur_selected_file is not None else self.cur_selected_dir
+        if node is None:
+            QMessageBox.warning(self, "Warning", "未选中文件或文件夹！")
+            return
+        elif node == self.file_tree:
+            QMessageBox.warning(self, "Warning", "不能移动根文件夹！")
+            return
+        path, check = QInputDialog.getText(self, "移动", "输入目标文件夹路径(如 /a/b):")
+        if check:
+            target = self.resolve(path)
+            name = node.file_name if node is self.cur_selected_file else node.dir_name
+            if not isinstance(target, file_system_components.FileTreeNode):
+                QMessageBox.warning(self, "Warning", "目标文件夹不存在！")
+                return
+            if target is node.parent:
+                return
+            if target.GetFile(name) is not None or target.GetDir(name) is not None:
+                QMessageBox.warning(self, "Warning", "目标文件夹中已有同名文件！")
+                return
+            ancestor = target
+            while ancestor is not None:
+                if ancestor is node:
+                    QMessageBox.warning(self, "Warning", "不能移动到自己的子文件夹中！")
+                    return
+                ancestor = ancestor.parent
+            self.ui.treeView.setCurrentIndex(QModelIndex())
+            self.tree_model.MoveNode(node, target, lambda: self.Move(node, target))
+            self.cur_selected_file = None
+            self.cur_selected_dir = target
+            self.UpdateUI()
+    def sys_search_content(self):
+        if self.cur_selected_dir is None:
+            QMessageBox.warning(self, "Warning", "未选中文件夹！")
+            return
+        pattern, check = QInputDialog.getText(self, "搜索文件内容", "输入要搜索的内容:")
+        if check:
+            if pattern == "":
+                QMessageBox.warning(self, "Warning", "搜索内容为空！")
+                return
+            files = self.SearchContent(pattern, self.cur_selected_dir)
+            paths = ["/" + "/".join(self.PathOf(File.parent) + (File.file_name,)) for File in files]
+            QMessageBox.information(self, "搜索结果", "\n".join(paths) if paths else "没有找到")
+    def sys_create_snapshot(self):
+        name, check = QInputDialog.getText(self, "创建快照", "输入快照名:")
+        if check:
+            if name == "":
+                QMessageBox.warning(self, "Warning", "快照名为空！")
+                return
+            try:
+                self.CreateSnapshot(name)
+            except ValueError as e:
+                QMessageBox.warning(self, "Warning", str(e))
+                return
+            QMessageBox.information(self, "消息", "已创建快照 " + name)
+
+    def sys_rollback_snapshot(self):
+        names = [name for name, created, blocks in self.ListSnapshots()]
+        if not names:
+            QMessageBox.warning(self, "Warning", "没有快照！")
+            return
+        name, check = QInputDialog.getItem(self, "回滚到快照", "选择快照(之后的改动与快照都将丢弃):", names, len(names) - 1, False)
+        if check:
+            self.RollbackSnapshot(name)
+            self.cur_selected_file = None
+            self.cur_selected_dir = None
+            self.cur_path = "User/"
+            self.tree_model.SetRoot(self.file_tree)
+            self.ui.treeView.expand(self.tree_model.IndexOf(self.file_tree))
+            self.UpdateUI()
     def closeEvent(self, Event) -> None:
         self.sys_SaveSys()
+        self.CloseVolume()
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
@@ -0,0 +1,210 @@
+import os
+import pickle
+import struct
+import threading
+from array import array
+from datetime import datetime, timedelta
+
+SAVE_MAGIC = b"TJFATSAV"
+# 存档文件: 魔数, 版本, 日志序号, 元数据文件的代数, 索引的偏移与项数; 之后是快照表(见SnapshotTable.Dump)
+SAVE_HEADER = struct.Struct("<8sIQIQQ")
+SAVE_VERSION = 3  # 版本3在文件头之后加了快照表
+STAMP_VERSION = 2  # 版本1的记录中时间是datetime对象, 从版本2起是整数时间戳
+META_SUFFIX = ".meta"
+COMPACT_MIN_BYTES = 2 ** 20  # 垃圾超过这个大小且多于有效数据时整理
+ROOT_ID = 0
+
+# 时间戳: 自1970-01-01起的微秒数, 按本地时间计, 不带时区, 与datetime可以精确互换
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def to_stamp(time):
+    return None if time is None else (time - EPOCH) // MICROSECOND
+
+
+def from_stamp(stamp):
+    return None if stamp is None else EPOCH + stamp * MICROSECOND
+
+
+# 把版本1的记录换成当前的格式
+def _upgrade_record(record):
+    name, create_time, modify_time, files, dirs = record
+    return (name, to_stamp(create_time), to_stamp(modify_time),
+            [(file_name, to_stamp(file_create), to_stamp(file_modify), length, start_address)
+             for file_name, file_create, file_modify, length, start_address in files], dirs)
+
+
+# 读出存档文件头, 不是这种格式(旧版的pickle存档)时返回None并把文件位置退回开头
+def ReadHeader(f):
+    data = f.read(SAVE_HEADER.size)
+    if len(data) < SAVE_HEADER.size or data[:len(SAVE_MAGIC)] != SAVE_MAGIC:
+        f.seek(0)
+        return None
+    magic, version, seq, generation, index_offset, index_count = SAVE_HEADER.unpack(data)
+    if not 1 <= version <= SAVE_VERSION:
+        raise ValueError(f"unsupported save file version {version}")
+    return version, seq, generation, index_offset, index_count
+
+
+# 先写临时文件再替换, 存档文件本身不会写坏; extra(快照表)跟在文件头之后, 与它一起替换
+def WriteHeader(path, seq, generation, index_offset, index_count, extra=b""):
+    temp_file = path + ".tmp"
+    with open(temp_file, "wb") as f:
+        f.write(SAVE_HEADER.pack(SAVE_MAGIC, SAVE_VERSION, seq, generation, index_offset, index_count))
+        f.write(extra)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, path)
+
+
+# 目录元数据文件: 每个文件夹一条记录(pickle), 按编号索引, 启动时只读索引, 文件夹第一次被访问时才读它的记录
+# 日志结构: 检查点时只追加改动过的文件夹的新记录和新索引, 旧记录成为垃圾;
+# 存档文件指向最新的索引, 替换存档文件之前崩溃, 旧索引与旧记录都还在
+# 垃圾多于有效数据时由FileSystem整理成新一代的文件, 见FileSystem._compact_meta
+# 旧版本的文件读出记录时转换格式, 下次检查点时整个重写
+# 快照指向某次检查点时的索引, 那时的记录不会被覆盖; 整理时把快照的索引与记录一起复制过去, 见CopyIndex
+class MetaStore:
+    def __init__(self, base, generation, file, index, version=SAVE_VERSION):
+        self.base = base
+        self.generation = generation
+        self.version = version
+        self.file = file
+        # 编号 -> 记录的(偏移, 长度), 两项一组; 偏移为-1表示空号
+        self.index = index
+        self.free_ids = [dir_id for dir_id in range(len(index) // 2) if index[2 * dir_id] < 0]
+        self.index_location = (0, 0)
+        self.size = os.fstat(file.fileno()).st_size
+        self.live = sum(index[1::2])
+        # 快照的索引与记录占的字节数, 上次整理时算出, 不算作垃圾
+        self.held = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def Path(base, generation):
+        return f"{base}.{generation}{META_SUFFIX}"
+
+    @classmethod
+    def create(cls, base, generation):
+        return cls(base, generation, open(cls.Path(base, generation), "w+b"), array("q"))
+
+    @classmethod
+    def open(cls, base, generation, index_offset, index_count, version=SAVE_VERSION):
+        f = open(cls.Path(base, generation), "r+b")
+        index = array("q")
+        index.frombytes(os.pread(f.fileno(), index_count * 2 * index.itemsize, index_offset))
+        store = cls(base, generation, f, index, version)
+        store.index_location = (index_offset, index_count)
+        # 索引之后的内容是写到一半的检查点留下的, 截掉
+        end = index_offset + len(index) * index.itemsize
+        if store.size > end:
+            f.truncate(end)
+            store.size = end
+        return store
+
+    def __len__(self):
+        return len(self.index) // 2
+
+    def Read(self, dir_id):
+        record = pickle.loads(self.ReadRaw(dir_id))
+        if self.version < STAMP_VERSION:
+            record = _upgrade_record(record)
+        return record
+
+    def ReadRaw(self, dir_id):
+        offset, length = self.index[2 * dir_id], self.index[2 * dir_id + 1]
+        if offset < 0:
+            raise KeyError(f"directory record {dir_id} does not exist")
+        return os.pread(self.file.fileno(), length, offset)
+
+    def ReadIndex(self, location):
+        index_offset, index_count = location
+        index = array("q")
+        index.frombytes(os.pread(self.file.fileno(), index_count * 2 * index.itemsize, index_offset))
+        return index
+
+    # 按location处的索引读记录的只读视图(用于快照), 与本文件共用文件对象, 不要关闭
+    def View(self, location):
+        return MetaStore(self.base, self.generation, self.file, self.ReadIndex(location), self.version)
+
+    # 整理之后视图改指向新一代文件中的索引
+    def Repoint(self, store, location):
+        with self.lock:
+            self.index = store.ReadIndex(location)
+            self.file = store.file
+            self.generation = store.generation
+            self.version = store.version
+
+    # 整个换掉索引(回滚到快照), 记录都还在文件中
+    def ResetIndex(self, index):
+        self.index = index
+        self.free_ids = [dir_id for dir_id in range(len(index) // 2) if index[2 * dir_id] < 0]
+        self.live = sum(index[1::2])
+
+    def Allocate(self):
+        if self.free_ids:
+            return self.free_ids.pop()
+        self.index.extend((-1, 0))
+        return len(self.index) // 2 - 1
+
+    def Release(self, dir_id):
+        if self.index[2 * dir_id] >= 0:
+            self.live -= self.index[2 * dir_id + 1]
+            self.index[2 * dir_id] = -1
+            self.index[2 * dir_id + 1] = 0
+            self.free_ids.append(dir_id)
+
+    # 追加一条记录, 取代该编号原来的记录
+    def Write(self, dir_id, record):
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        self.live += len(data) - self.index[2 * dir_id + 1]
+        os.pwrite(self.file.fileno(), data, self.size)
+        self.index[2 * dir_id] = self.size
+        self.index[2 * dir_id + 1] = len(data)
+        self.size += len(data)
+
+    def _append(self, data):
+        offset = self.size
+        os.pwrite(self.file.fileno(), data, offset)
+        self.size += len(data)
+        return offset
+
+    # 把source中location处的索引连同它指向的记录复制过来, 返回新的索引位置
+    # copied是已复制的记录 旧偏移 -> 新偏移, 几个快照共用的记录只复制一次
+    def CopyIndex(self, source, location, copied):
+        index = source.ReadIndex(location)
+        for i in range(0, len(index), 2):
+            offset, length = index[i], index[i + 1]
+            if offset < 0:
+                continue
+            new_offset = copied.get(offset)
+            if new_offset is None:
+                new_offset = copied[offset] = self._append(os.pread(source.file.fileno(), length, offset))
+                self.held += length
+            index[i] = new_offset
+        data = index.tobytes()
+        self.held += len(data)
+        return self._append(data), len(index) // 2
+
+    # 追加索引并落盘, 之后由存档文件指向它
+    def Commit(self):
+        data = self.index.tobytes()
+        os.pwrite(self.file.fileno(), data, self.size)
+        self.index_location = (self.size, len(self))
+        self.size += len(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.index_location
+
+    def NeedsCompaction(self):
+        if self.version < STAMP_VERSION:
+            return True
+        garbage = self.size - self.live - self.held
+        return garbage > COMPACT_MIN_BYTES and garbage > self.live
+
+    def close(self):
+        self.file.close()
+
+    def Remove(self):
+        self.close()
+        os.remove(self.Path(self.base, self.generation))
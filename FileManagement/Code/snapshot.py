@@ -0,0 +1,174 @@
+import pickle
+
+
+# 快照: 整卷在某一时刻的只读副本, 与当前卷共用没改过的块, FAT项与目录记录
+class Snapshot:
+    __slots__ = ("name", "created", "index_location", "fat", "dead", "born", "store")
+
+    def __init__(self, name, created, index_location=None):
+        self.name = name
+        # 时间戳, 见metastore.to_stamp
+        self.created = created
+        # 元数据文件中这一时刻的索引(偏移, 项数), 拍下时的检查点提交之后才有
+        self.index_location = index_location
+        # 拍下之后(到下一个快照之前)改过的FAT项 -> 拍下时的值
+        self.fat = {}
+        # 属于这个快照, 但下一个快照(或当前卷)已不再用的块
+        self.dead = set()
+        # 上一个快照之后分配, 拍下时还在用的块; 最早的快照为None
+        self.born = None
+        # 挂载时读目录记录用的MetaStore视图
+        self.store = None
+
+
+# 所有快照与写时复制的记录, 按拍下的先后排列
+# 最新的快照之后分配的块(fresh)只属于当前卷, 可以原地改写, 释放时直接归还;
+# 其余在用的块都被最新的快照引用: 内容要改时复制到新块(见FileSystem._copy_block), 释放时记入最新快照的dead,
+# 在bitmap中保持占用(held), 删除快照时才归还; FAT项第一次改动前的值记入最新快照的fat
+# 读快照时, FAT项依次查这个快照及之后各快照的fat, 都没有就是当前的值
+# 拍快照只是在列表末尾加一项并清空fresh, 与卷的大小无关; 占用的空间与之后的改动量成正比
+class SnapshotTable:
+    def __init__(self):
+        self.snapshots = []
+        self.fresh = set()
+        # 各快照dead的并集
+        self.held = set()
+        # 上次保存以来的改动, 随日志一起落盘, 重放时用ApplyLog恢复: [(类别, 块, 值)...]
+        self.log = []
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def __iter__(self):
+        return iter(self.snapshots)
+
+    def __contains__(self, snapshot):
+        return any(s is snapshot for s in self.snapshots)
+
+    def Find(self, name):
+        for snapshot in self.snapshots:
+            if snapshot.name == name:
+                return snapshot
+        return None
+
+    # 块是否被快照引用, 是的话不能原地改写, 也不能直接释放
+    def Shared(self, block):
+        return bool(self.snapshots) and block not in self.fresh
+
+    def Add(self, snapshot):
+        if self.snapshots:
+            snapshot.born = self.fresh
+        self.snapshots.append(snapshot)
+        self.fresh = set()
+
+    # 检查点提交了元数据索引, 刚拍下的快照指向它
+    def Committed(self, index_location):
+        for snapshot in self.snapshots:
+            if snapshot.index_location is None:
+                snapshot.index_location = index_location
+
+    # FAT项block将从old改掉; was_free/now_free表示改之前/之后是否空闲, 由FAT.Set在改之前调用
+    def Track(self, block, old, was_free, now_free):
+        if was_free:
+            if not now_free:
+                self.fresh.add(block)
+                self.log.append(("fresh", block, None))
+            return
+        if block in self.fresh:
+            if now_free:
+                self.fresh.discard(block)
+                self.log.append(("freed", block, None))
+            return
+        latest = self.snapshots[-1]
+        if block not in latest.fat:
+            latest.fat[block] = old
+            self.log.append(("saved", block, old))
+        if now_free:
+            latest.dead.add(block)
+            self.held.add(block)
+            self.log.append(("dead", block, None))
+
+    def TakeLog(self):
+        log = self.log
+        self.log = []
+        return log
+
+    def ApplyLog(self, log):
+        for kind, block, value in log:
+            if kind == "fresh":
+                self.fresh.add(block)
+            elif kind == "freed":
+                self.fresh.discard(block)
+            elif kind == "saved":
+                self.snapshots[-1].fat.setdefault(block, value)
+            else:
+                self.snapshots[-1].dead.add(block)
+                self.held.add(block)
+
+    # 删除快照, 返回可以归还的块
+    # dead中的块前一个快照也有(不是这个快照的born)时转给前一个快照, 否则只属于这个快照, 归还
+    # 拍下之后改过的FAT项旧值并入前一个快照(前一个快照自己记过的优先); born并入下一个快照或fresh
+    def Remove(self, snapshot):
+        i = next(i for i, s in enumerate(self.snapshots) if s is snapshot)
+        prev = self.snapshots[i - 1] if i > 0 else None
+        following = self.snapshots[i + 1] if i + 1 < len(self.snapshots) else None
+        freed = []
+        for block in snapshot.dead:
+            if prev is not None and block not in snapshot.born:
+                prev.dead.add(block)
+            else:
+                freed.append(block)
+                self.held.discard(block)
+        if prev is not None:
+            # born中的块在前一个快照时是空闲的, 前一个快照用不到它们的旧值, 回滚时也不能改回去
+            born = snapshot.born
+            for block, value in snapshot.fat.items():
+                if block not in born:
+                    prev.fat.setdefault(block, value)
+            survivors = snapshot.born - snapshot.dead
+            if following is not None:
+                following.born |= survivors
+            else:
+                self.fresh |= survivors
+        elif following is not None:
+            following.born = None
+        else:
+            self.fresh = set()
+        del self.snapshots[i]
+        return freed
+
+    # 回滚到最新的快照: 返回要改回的FAT项(块 -> 拍下时的值)与拍下之后分配的块, 回滚后当前卷与快照相同
+    def Restore(self, snapshot):
+        assert self.snapshots and self.snapshots[-1] is snapshot
+        restored, fresh = snapshot.fat, self.fresh
+        self.held -= snapshot.dead
+        snapshot.fat = {}
+        snapshot.dead = set()
+        self.fresh = set()
+        return restored, fresh
+
+    def Clear(self):
+        self.snapshots = []
+        self.fresh = set()
+        self.held = set()
+        self.log = []
+
+    # 存档中的快照表, 检查点时与存档文件头一起写入, 没有快照时为空
+    def Dump(self):
+        if not self.snapshots:
+            return b""
+        return pickle.dumps(([(s.name, s.created, s.index_location, s.fat, s.dead, s.born) for s in self.snapshots],
+                             self.fresh), pickle.HIGHEST_PROTOCOL)
+
+    def Load(self, data):
+        self.Clear()
+        if not data:
+            return
+        entries, self.fresh = pickle.loads(data)
+        for name, created, index_location, fat, dead, born in entries:
+            snapshot = Snapshot(name, created, index_location)
+            snapshot.fat = fat
+            snapshot.dead = dead
+            snapshot.born = born
+            self.snapshots.append(snapshot)
+            self.held |= dead